@@ -0,0 +1,227 @@
+"""
+Memory-mapped and compressed artifacts for the churn random forest.
+
+joblib.load rebuilds every tree of a pickled forest in private memory, even
+with mmap_mode, because scikit-learn copies the node arrays into each Tree.
+export_forest therefore also writes the nodes of all trees as flat .npy
+arrays. MappedForest loads them with np.load(mmap_mode='r') and predicts with
+numpy, so scoring processes share the pages of one file. A compressed joblib
+copy is written for storage, and benchmark_load compares the load times.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import joblib
+import numpy as np
+
+ARRAYS_DIR = './models/rfc_model_arrays'
+COMPRESSED_PTH = './models/rfc_model_compressed.joblib'
+ARRAY_NAMES = ('children_left', 'children_right', 'feature', 'threshold',
+               'value', 'roots')
+
+
+def export_forest(forest, arrays_dir=ARRAYS_DIR, compressed_pth=None,
+                  compress=3):
+    '''
+    store the nodes of every tree in forest as flat arrays for mmap loading
+    and optionally a compressed joblib copy of the forest
+
+    input:
+            forest: fitted RandomForestClassifier
+            arrays_dir: directory for the .npy arrays and meta.json
+            compressed_pth: path of the compressed joblib file, None skips it
+            compress: joblib compression level
+    output:
+            None
+    '''
+    trees = [estimator.tree_ for estimator in forest.estimators_]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+
+    def global_children(children, offset):
+        return np.where(children == -1, -1, children + offset)
+
+    values = [tree.value[:, 0, :] for tree in trees]
+    arrays = {
+        'children_left': np.concatenate(
+            [global_children(tree.children_left, offset)
+             for tree, offset in zip(trees, offsets)]).astype(np.int64),
+        'children_right': np.concatenate(
+            [global_children(tree.children_right, offset)
+             for tree, offset in zip(trees, offsets)]).astype(np.int64),
+        'feature': np.concatenate(
+            [tree.feature for tree in trees]).astype(np.int64),
+        'threshold': np.concatenate([tree.threshold for tree in trees]),
+        # class counts become the class probabilities predict_proba returns
+        'value': np.concatenate(
+            [value / value.sum(axis=1, keepdims=True) for value in values]),
+        'roots': offsets[:-1].astype(np.int64),
+    }
+    os.makedirs(arrays_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(arrays_dir, f'{name}.npy'),
+                np.ascontiguousarray(array))
+    meta = {
+        'classes': forest.classes_.tolist(),
+        'n_features': int(forest.n_features_in_),
+        'feature_names': [str(name) for name in
+                          getattr(forest, 'feature_names_in_', [])],
+        'n_trees': len(trees),
+    }
+    with open(os.path.join(arrays_dir, 'meta.json'), 'w',
+              encoding='utf-8') as file:
+        json.dump(meta, file, indent=2)
+    logging.info("SUCCESS: Exported %(trees)d trees with %(nodes)d nodes to \
+%(dir)s", {'trees': len(trees), 'nodes': int(offsets[-1]),
+           'dir': arrays_dir})
+    if compressed_pth is not None:
+        joblib.dump(forest, compressed_pth, compress=compress)
+        logging.info("SUCCESS: Stored compressed forest at %s",
+                     compressed_pth)
+
+
+class MappedForest:
+    '''
+    Random forest predictor over memory-mapped node arrays written by
+    export_forest. Its probabilities match RandomForestClassifier.
+
+    attributes:
+            classes_: numpy array of class labels
+            feature_names_in_: feature names seen while fitting, if any
+            n_trees: number of trees in the forest
+    '''
+
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.classes_ = np.array(meta['classes'])
+        self.n_features_in_ = meta['n_features']
+        self.feature_names_in_ = np.array(meta['feature_names'], dtype=object)
+        self.n_trees = meta['n_trees']
+
+    @classmethod
+    def load(cls, arrays_dir=ARRAYS_DIR, mmap_mode='r'):
+        '''
+        returns a MappedForest over the arrays in arrays_dir
+
+        input:
+                arrays_dir: directory written by export_forest
+                mmap_mode: np.load mmap_mode, None reads into memory
+        output:
+                forest: MappedForest
+        '''
+        arrays = {name: np.load(os.path.join(arrays_dir, f'{name}.npy'),
+                                mmap_mode=mmap_mode)
+                  for name in ARRAY_NAMES}
+        with open(os.path.join(arrays_dir, 'meta.json'),
+                  encoding='utf-8') as file:
+            meta = json.load(file)
+        return cls(arrays, meta)
+
+    def _matrix(self, x_data):
+        '''
+        returns x_data as float32 in the column order seen while fitting
+        '''
+        if len(self.feature_names_in_) and hasattr(x_data, 'columns'):
+            x_data = x_data[list(self.feature_names_in_)]
+        return np.asarray(x_data, dtype=np.float32)
+
+    def predict_proba(self, x_data, chunk_size=2048):
+        '''
+        returns the mean class probabilities of every tree for x_data
+
+        input:
+                x_data: features as a dataframe or array
+                chunk_size: rows routed through the trees at once
+        output:
+                proba: numpy array of shape (rows, classes)
+        '''
+        x_matrix = self._matrix(x_data)
+        left = self.arrays['children_left']
+        right = self.arrays['children_right']
+        feature = self.arrays['feature']
+        threshold = self.arrays['threshold']
+        roots = np.asarray(self.arrays['roots'])
+        proba = np.empty((len(x_matrix), len(self.classes_)))
+        for start in range(0, len(x_matrix), chunk_size):
+            chunk = x_matrix[start:start + chunk_size]
+            rows = np.repeat(np.arange(len(chunk)), len(roots))
+            nodes = np.tile(roots, len(chunk))
+            active = np.flatnonzero(left[nodes] != -1)
+            while active.size:
+                current = nodes[active]
+                go_left = chunk[rows[active], feature[current]] <= \
+                    threshold[current]
+                nodes[active] = np.where(go_left, left[current],
+                                         right[current])
+                active = active[left[nodes[active]] != -1]
+            leaf_values = self.arrays['value'][nodes].reshape(
+                len(chunk), len(roots), -1)
+            proba[start:start + len(chunk)] = leaf_values.mean(axis=1)
+        return proba
+
+    def predict(self, x_data):
+        '''
+        returns the predicted class of each row of x_data
+        '''
+        return self.classes_.take(np.argmax(self.predict_proba(x_data),
+                                            axis=1))
+
+
+def benchmark_load(model_pth='./models/rfc_model.pkl',
+                   compressed_pth=COMPRESSED_PTH, arrays_dir=ARRAYS_DIR,
+                   repeat=3):
+    '''
+    time a cold load of each forest artifact and report its size on disk
+
+    input:
+            model_pth: plain joblib pickle of the forest
+            compressed_pth: compressed joblib file of the forest
+            arrays_dir: directory written by export_forest
+            repeat: loads per artifact, the fastest is reported
+    output:
+            results: dict of artifact name -> {'seconds', 'megabytes'}
+    '''
+    def dir_size(pth):
+        return sum(os.path.getsize(os.path.join(pth, name))
+                   for name in os.listdir(pth))
+
+    loaders = {
+        'pickle': (lambda: joblib.load(model_pth), model_pth,
+                   os.path.getsize),
+        'compressed': (lambda: joblib.load(compressed_pth), compressed_pth,
+                       os.path.getsize),
+        'mmap': (lambda: MappedForest.load(arrays_dir, mmap_mode='r'),
+                 arrays_dir, dir_size),
+    }
+    results = {}
+    for name, (loader, pth, size) in loaders.items():
+        if not os.path.exists(pth):
+            logging.info("SKIP: %s artifact not found at %s", name, pth)
+            continue
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            loader()
+            timings.append(time.perf_counter() - start)
+        results[name] = {'seconds': min(timings),
+                         'megabytes': size(pth) / 1e6}
+        logging.info("Load %(name)s: %(seconds).4fs, %(mb).1f MB",
+                     {'name': name, 'seconds': min(timings),
+                      'mb': size(pth) / 1e6})
+    return results
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Compare load times of the stored forest artifacts")
+    PARSER.add_argument('--model', default='./models/rfc_model.pkl')
+    PARSER.add_argument('--compressed', default=COMPRESSED_PTH)
+    PARSER.add_argument('--arrays', default=ARRAYS_DIR)
+    PARSER.add_argument('--repeat', type=int, default=3)
+    ARGS = PARSER.parse_args()
+    for artifact, stats in benchmark_load(ARGS.model, ARGS.compressed,
+                                          ARGS.arrays, ARGS.repeat).items():
+        print(f"{artifact:<12}{stats['seconds']:>10.4f}s"
+              f"{stats['megabytes']:>10.1f} MB")
@@ -0,0 +1,432 @@
+"""
+Benchmark suite of the churn library on synthetic bank data.
+
+synthetic_bank_data draws a seeded dataset with the columns, types and
+category frequencies of bank_data.csv. run_benchmarks times the library
+functions on growing sizes of it, reading the wall time, CPU time, peak RSS
+and rows per second from the churn_profiling records, and compare_to_baseline
+lines the results up against a stored baseline. Every function runs inside a
+scratch directory, so the figures and models it writes never replace the
+ones of the project. logging_overhead times the logging calls of per-column
+loops with a synchronous file handler and with the queue of churn_logging.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from churn_library import (PROFILER, SEARCH_CONFIG, SHAP_CONFIG,
+                           encoder_helper, import_data, perform_eda,
+                           perform_feature_engineering, train_models)
+from churn_logging import LOG_FORMAT, queue_logging
+
+BENCHMARK_DIR = './data/benchmark'
+BASELINE_PTH = './benchmarks/baseline.json'
+BENCHMARK_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+# largest number of rows each stage is run on. train_models runs the full
+# hyperparameter search, which does not finish in benchmark time on more rows.
+STAGE_MAX_ROWS = {'train_models': 10_000}
+# a stage is flagged when it is this many times slower than the baseline
+SLOWDOWN_THRESHOLD = 1.25
+# modules a scoring process imports, each with the modules it must not load:
+# the plotting and explainability stack, and for the scorer scikit-learn
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'shap']
+SCORING_MODULES = {
+    'churn_library': HEAVY_MODULES,
+    'churn_scoring': HEAVY_MODULES + ['sklearn'],
+}
+
+# levels and frequencies of the categorical columns in bank_data.csv
+CATEGORY_LEVELS = {
+    'Gender': {'F': 0.529, 'M': 0.471},
+    'Education_Level': {'Graduate': 0.309, 'High School': 0.199,
+                        'Unknown': 0.15, 'Uneducated': 0.147,
+                        'College': 0.1, 'Post-Graduate': 0.051,
+                        'Doctorate': 0.044},
+    'Marital_Status': {'Married': 0.463, 'Single': 0.389, 'Unknown': 0.074,
+                       'Divorced': 0.074},
+    'Income_Category': {'Less than $40K': 0.352, '$40K - $60K': 0.177,
+                        '$80K - $120K': 0.152, '$60K - $80K': 0.138,
+                        'Unknown': 0.11, '$120K +': 0.071},
+    'Card_Category': {'Blue': 0.932, 'Silver': 0.055, 'Gold': 0.011,
+                      'Platinum': 0.002},
+}
+
+
+def _categories(rng, column, rows):
+    '''
+    returns rows draws of the levels of a categorical column
+    '''
+    levels = CATEGORY_LEVELS[column]
+    probs = np.array(list(levels.values()))
+    return rng.choice(list(levels), size=rows, p=probs / probs.sum())
+
+
+def synthetic_bank_data(rows, seed=42, start=0):
+    '''
+    returns a dataframe with the columns of bank_data.csv drawn at random.
+    Churn is more likely for customers with few transactions, so the models
+    have a signal to learn.
+
+    input:
+            rows: number of rows
+            seed: seed of the random generator
+            start: index of the first row, used to draw a file in chunks
+    output:
+            dff: pandas dataframe
+    '''
+    rng = np.random.default_rng([seed, start])
+    credit_limit = np.clip(rng.lognormal(8.7, 0.8, rows), 1438.3, 34516.0)
+    revolving = rng.integers(0, 2518, rows)
+    trans_ct = np.clip(rng.normal(65, 23, rows), 10, 139).astype(int)
+    ct_change = np.clip(rng.normal(0.71, 0.24, rows), 0, 3.714)
+    churn_logit = -1.6 - 0.06 * (trans_ct - 65) - 3 * (ct_change - 0.71)
+    churn = rng.random(rows) < 1 / (1 + np.exp(-churn_logit))
+    return pd.DataFrame({
+        'Unnamed: 0': np.arange(start, start + rows),
+        'CLIENTNUM': 708_000_000 + np.arange(start, start + rows),
+        'Attrition_Flag': np.where(churn, 'Attrited Customer',
+                                   'Existing Customer'),
+        'Customer_Age': np.clip(rng.normal(46, 8, rows), 26, 73).astype(int),
+        'Gender': _categories(rng, 'Gender', rows),
+        'Dependent_count': rng.integers(0, 6, rows),
+        'Education_Level': _categories(rng, 'Education_Level', rows),
+        'Marital_Status': _categories(rng, 'Marital_Status', rows),
+        'Income_Category': _categories(rng, 'Income_Category', rows),
+        'Card_Category': _categories(rng, 'Card_Category', rows),
+        'Months_on_book': np.clip(rng.normal(36, 8, rows), 13, 56
+                                  ).astype(int),
+        'Total_Relationship_Count': rng.integers(1, 7, rows),
+        'Months_Inactive_12_mon': rng.integers(0, 7, rows),
+        'Contacts_Count_12_mon': rng.integers(0, 7, rows),
+        'Credit_Limit': credit_limit.round(1),
+        'Total_Revolving_Bal': revolving,
+        'Avg_Open_To_Buy': np.maximum(credit_limit - revolving, 3).round(1),
+        'Total_Amt_Chng_Q4_Q1': np.clip(rng.normal(0.76, 0.22, rows), 0,
+                                        3.397).round(3),
+        'Total_Trans_Amt': np.clip(trans_ct * rng.normal(65, 20, rows), 510,
+                                   18484).astype(int),
+        'Total_Trans_Ct': trans_ct,
+        'Total_Ct_Chng_Q4_Q1': ct_change.round(3),
+        'Avg_Utilization_Ratio': (revolving / credit_limit).clip(0, 0.999
+                                                                 ).round(3),
+    })
+
+
+def write_synthetic_csv(rows, seed=42, data_dir=BENCHMARK_DIR,
+                        chunk_rows=1_000_000):
+    '''
+    write a synthetic csv of rows rows in chunks and return its path. A file
+    drawn earlier with the same size and seed is reused.
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    pth = os.path.abspath(os.path.join(data_dir,
+                                       f'synthetic_{rows}_{seed}.csv'))
+    if os.path.exists(pth):
+        return pth
+    partial = f'{pth}.partial'
+    for start in range(0, rows, chunk_rows):
+        synthetic_bank_data(min(chunk_rows, rows - start), seed, start).to_csv(
+            partial, mode='a' if start else 'w', header=not start,
+            index=False)
+    os.replace(partial, pth)
+    logging.info("SUCCESS: Wrote %(rows)d synthetic rows to %(pth)s",
+                 {'rows': rows, 'pth': pth})
+    return pth
+
+
+@contextlib.contextmanager
+def _scratch_directory(pth):
+    '''
+    run the enclosed code inside pth, with the sub directories the library
+    writes its figures, models and logs to
+    '''
+    for sub_dir in ('images/eda', 'images/results', 'models', 'logs'):
+        os.makedirs(os.path.join(pth, sub_dir), exist_ok=True)
+    previous = os.getcwd()
+    os.chdir(pth)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _benchmark_stages(csv_pth):
+    '''
+    returns the stages of one benchmark as (name, function) pairs. Each
+    function updates the dict of values passed between stages.
+    '''
+    def run_import(state):
+        state['dff'] = import_data(csv_pth, 'churn', cache_dir=None)
+
+    def run_eda(state):
+        perform_eda(state['dff'], manifest_pth=None)
+
+    def run_encoder(state):
+        dff = state['dff']
+        encoder_helper(dff.copy(),
+                       dff.select_dtypes(['object', 'category']).columns,
+                       'churn', encoder_pth=None)
+
+    def run_feature_engineering(state):
+        state['splits'] = perform_feature_engineering(state['dff'].copy(),
+                                                      'churn')
+
+    def run_training(state):
+        # the seeded data would hit the search and SHAP caches of the
+        # previous run, so every run fits and explains from scratch
+        train_models(*state['splits'],
+                     search_config={**SEARCH_CONFIG, 'cache_dir': None},
+                     shap_config={**SHAP_CONFIG, 'cache_dir': None})
+
+    return [('import_data', run_import), ('perform_eda', run_eda),
+            ('encoder_helper', run_encoder),
+            ('perform_feature_engineering', run_feature_engineering),
+            ('train_models', run_training)]
+
+
+def run_benchmarks(sizes=None, seed=42, stages=None, max_rows=None,
+                   work_dir=BENCHMARK_DIR):
+    '''
+    time the library functions on synthetic data of each size
+
+    input:
+            sizes: list of row counts, defaults to BENCHMARK_SIZES
+            seed: seed of the synthetic data
+            stages: names of the functions to time, defaults to all. The
+            stages they need for their input run as well.
+            max_rows: dict of stage -> largest size it runs on, defaults to
+            STAGE_MAX_ROWS
+            work_dir: directory of the synthetic csv files and the scratch
+            output of the library
+    output:
+            results: list of profile records with the dataset size added
+    '''
+    max_rows = {**STAGE_MAX_ROWS, **(max_rows or {})}
+    if stages is not None:
+        stages = set(stages) | {'import_data'}
+        if 'train_models' in stages:
+            stages.add('perform_feature_engineering')
+    results = []
+    for size in sizes or BENCHMARK_SIZES:
+        csv_pth = write_synthetic_csv(size, seed, work_dir)
+        state = {}
+        with _scratch_directory(os.path.join(work_dir, 'scratch')):
+            for name, stage in _benchmark_stages(csv_pth):
+                if stages is not None and name not in stages:
+                    continue
+                if size > max_rows.get(name, size):
+                    logging.info("SKIP: %(name)s benchmark above %(max)d \
+rows", {'name': name, 'max': max_rows[name]})
+                    continue
+                PROFILER.start_run()
+                stage(state)
+                # the outermost record is the function itself, nested
+                # records are the library functions it calls
+                record = next(record for record in PROFILER.records
+                              if record['stage'] == name)
+                results.append({'size': size, **record})
+                logging.info("SUCCESS: Benchmarked %(name)s on %(size)d rows \
+in %(time).2fs", {'name': name, 'size': size,
+                  'time': record['wall_seconds']})
+    return results
+
+
+def import_time(module, repeat=3, heavy_modules=None):
+    '''
+    time a cold import of module in fresh interpreters
+
+    input:
+            module: name of a module of this project
+            repeat: interpreters started, the fastest import is reported
+            heavy_modules: modules to look for after the import, defaults
+            to HEAVY_MODULES
+    output:
+            result: dict with the import 'seconds' and the 'heavy_modules'
+            of heavy_modules the import loaded
+    '''
+    heavy_modules = heavy_modules or HEAVY_MODULES
+    code = (f"import json, sys, time\n"
+            f"start = time.perf_counter()\n"
+            f"import {module}\n"
+            f"print(json.dumps([time.perf_counter() - start, "
+            f"[name for name in {heavy_modules!r} if name in sys.modules]]))")
+    timings, heavy = [], []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], check=True,
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, heavy = json.loads(output.stdout.strip().splitlines()[-1])
+        timings.append(seconds)
+    logging.info("Import of %(module)s took %(seconds).3fs, loaded \
+%(heavy)s", {'module': module, 'seconds': min(timings), 'heavy': heavy})
+    return {'seconds': min(timings), 'heavy_modules': heavy}
+
+
+class _FsyncFileHandler(logging.FileHandler):
+    '''
+    file handler that waits for every record to reach the disk, standing in
+    for slow or shared log storage
+    '''
+
+    def emit(self, record):
+        super().emit(record)
+        os.fsync(self.stream.fileno())
+
+
+def logging_overhead(calls=5000, columns=20):
+    '''
+    time logging.info calls as made per column of an encoder_helper-style
+    loop. Each call is written to a file synchronously or through the queue
+    of churn_logging, with the page cache or with an fsync per record, or
+    dropped below the logger level.
+
+    input:
+            calls: logging calls timed per mode
+            columns: distinct column names the messages cycle through
+    output:
+            result: dict of mode -> dict with the 'us_per_call' of the loop
+            and the 'cpu_us_per_call' spent in the logging thread itself
+    '''
+    logger = logging.getLogger('churn_benchmark.logging_overhead')
+    logger.propagate = False
+    names = [f'column_{pos}' for pos in range(columns)]
+    modes = {'file': (logging.FileHandler, False),
+             'queue': (logging.FileHandler, True),
+             'file_fsync': (_FsyncFileHandler, False),
+             'queue_fsync': (_FsyncFileHandler, True),
+             'disabled': (logging.FileHandler, False)}
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode, (handler_class, queued) in modes.items():
+            file_handler = handler_class(
+                os.path.join(tmp_dir, f'{mode}.log'), mode='w')
+            file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            listener = None
+            if queued:
+                handler, listener = queue_logging([file_handler])
+            else:
+                handler = file_handler
+            logger.addHandler(handler)
+            logger.setLevel(logging.WARNING if mode == 'disabled'
+                            else logging.INFO)
+            wall, cpu = time.perf_counter(), time.thread_time()
+            for call in range(calls):
+                logger.info("SUCCESS: encoded %(col)s, %(rows)d rows",
+                            {'col': names[call % columns], 'rows': call})
+            cpu = time.thread_time() - cpu
+            wall = time.perf_counter() - wall
+            logger.removeHandler(handler)
+            if listener is not None:
+                listener.stop()
+            file_handler.close()
+            result[mode] = {'us_per_call': wall / calls * 1e6,
+                            'cpu_us_per_call': cpu / calls * 1e6}
+    logging.info("Logging overhead per call: %(file).2f us to file, \
+%(queue).2f us queued, %(file_fsync).2f us to file with fsync, \
+%(queue_fsync).2f us queued with fsync, %(disabled).2f us disabled",
+                 {mode: values['us_per_call']
+                  for mode, values in result.items()})
+    return result
+
+
+def compare_to_baseline(results, baseline=None,
+                        threshold=SLOWDOWN_THRESHOLD):
+    '''
+    returns a table of the results next to the baseline
+
+    input:
+            results: records returned by run_benchmarks
+            baseline: records of an earlier run_benchmarks, optional
+            threshold: slowdown ratio that flags a stage as slower
+    output:
+            table: pandas dataframe, one row per stage and size. scaling is
+            the time per row relative to the smallest size of the stage, so
+            values well above 1 show a scaling cliff.
+    '''
+    table = pd.DataFrame(results)[['stage', 'size', 'wall_seconds',
+                                   'cpu_seconds', 'peak_rss_mb',
+                                   'rows_per_sec']]
+    per_row = table['wall_seconds'] / table['size']
+    smallest = table.loc[table.groupby('stage')['size'].transform('idxmin')]
+    table['scaling'] = (per_row / (smallest['wall_seconds'] /
+                                   smallest['size']).to_numpy()).round(2)
+    if baseline:
+        base = pd.DataFrame(baseline)[['stage', 'size', 'wall_seconds']]
+        table = table.merge(base.rename(columns={
+            'wall_seconds': 'baseline_seconds'}), on=['stage', 'size'],
+            how='left')
+        table['ratio'] = (table['wall_seconds'] /
+                          table['baseline_seconds']).round(2)
+        table['flag'] = np.where(table['ratio'] > threshold, 'SLOWER', '')
+    return table
+
+
+def load_baseline(pth=BASELINE_PTH):
+    '''
+    returns the stored baseline records, or None when there is none
+    '''
+    if not os.path.exists(pth):
+        return None
+    with open(pth, encoding='utf-8') as file:
+        return json.load(file)['results']
+
+
+def save_results(results, pth):
+    '''
+    store benchmark records as JSON, e.g. as the new baseline
+    '''
+    os.makedirs(os.path.dirname(pth) or '.', exist_ok=True)
+    with open(pth, 'w', encoding='utf-8') as file:
+        json.dump({'environment': {
+            key: value for key, value in PROFILER.summary().items()
+            if key != 'stages'}, 'results': results}, file, indent=2)
+    logging.info("SUCCESS: stored benchmark results at %s", pth)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark the churn library on synthetic data")
+    PARSER.add_argument('--sizes', type=int, nargs='+',
+                        default=BENCHMARK_SIZES)
+    PARSER.add_argument('--stages', nargs='+', default=None)
+    PARSER.add_argument('--seed', type=int, default=42)
+    PARSER.add_argument('--max-train-rows', type=int,
+                        default=STAGE_MAX_ROWS['train_models'])
+    PARSER.add_argument('--baseline', default=BASELINE_PTH)
+    PARSER.add_argument('--output', default=None,
+                        help="json file the results are written to")
+    PARSER.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the new baseline")
+    PARSER.add_argument('--import-time', action='store_true',
+                        help="only time the cold import of the scoring path")
+    PARSER.add_argument('--logging-overhead', action='store_true',
+                        help="only time synchronous against queued logging")
+    ARGS = PARSER.parse_args()
+    if ARGS.logging_overhead:
+        for log_mode, timing in logging_overhead().items():
+            print(f"{log_mode:<12}{timing['us_per_call']:>9.2f} us per call"
+                  f"{timing['cpu_us_per_call']:>9.2f} us in the caller")
+        sys.exit(0)
+    if ARGS.import_time:
+        for scoring_module, avoided in SCORING_MODULES.items():
+            imported = import_time(scoring_module, heavy_modules=avoided)
+            loaded = ', '.join(imported['heavy_modules'])
+            print(f"{scoring_module:<16}{imported['seconds']:>8.3f}s  loaded "
+                  f"{loaded or 'no heavy modules'}")
+        sys.exit(0)
+    RESULTS = run_benchmarks(ARGS.sizes, ARGS.seed, ARGS.stages,
+                             {'train_models': ARGS.max_train_rows})
+    print(compare_to_baseline(RESULTS, load_baseline(ARGS.baseline))
+          .to_string(index=False))
+    if ARGS.output:
+        save_results(RESULTS, ARGS.output)
+    if ARGS.save_baseline:
+        save_results(RESULTS, ARGS.baseline)
@@ -0,0 +1,250 @@
+"""
+Distillation of the churn random forest into a compact model for serving.
+
+The best forest of the search can grow 500 trees of depth up to 100, which
+makes it large and slow to score one customer at a time. Each student model
+of DISTILL_CONFIG is a small regressor fitted on the churn probability the
+forest gives the training rows, its soft predictions, instead of the hard
+labels. The soft predictions are out-of-fold: a deep forest nearly
+memorises its own training rows, so each row is scored by a copy of the
+forest fitted without it. The students are compared with the forest on the
+test set (ROC AUC, accuracy, agreement with the forest, latency and size)
+and the fastest one whose ROC AUC is within max_auc_drop of the forest is
+exported next to the full model.
+"""
+
+import json
+import logging
+import joblib
+import numpy as np
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import accuracy_score, roc_auc_score
+from sklearn.model_selection import cross_val_predict
+from sklearn.tree import DecisionTreeRegressor
+from churn_pruning import model_size, predict_latency
+
+DISTILLED_MODEL_PTH = './models/rfc_model_distilled.pkl'
+DISTILL_REPORT_PTH = './images/results/distill_report.json'
+
+# Students fitted on the soft predictions of the forest, the number of folds
+# of the out-of-fold soft predictions, the largest accepted drop in test
+# ROC AUC and the number of timed calls per model.
+DISTILL_CONFIG = {
+    'students': {
+        'shallow_tree': (DecisionTreeRegressor, {'max_depth': 8,
+                                                 'min_samples_leaf': 20}),
+        'small_forest': (RandomForestRegressor, {'n_estimators': 30,
+                                                 'max_depth': 10,
+                                                 'min_samples_leaf': 5}),
+    },
+    'teacher_cv': 5,
+    'max_auc_drop': 0.01,
+    'repeat': 5,
+}
+
+
+class DistilledClassifier:
+    '''
+    Classifier interface over a regressor of the churn probability, so the
+    student is scored like the forest it replaces.
+
+    attributes:
+            regressor: fitted regressor of the churn probability
+            classes_: numpy array [0, 1]
+            feature_names_in_: feature names the regressor was fitted on
+            n_features_in_: number of features
+    '''
+
+    def __init__(self, regressor):
+        self.regressor = regressor
+        self.classes_ = np.array([0, 1])
+        self.feature_names_in_ = regressor.feature_names_in_
+        self.n_features_in_ = regressor.n_features_in_
+
+    def predict_proba(self, x_data):
+        '''
+        returns numpy array of the probabilities of no churn and churn
+        '''
+        churn = np.clip(self.regressor.predict(x_data), 0.0, 1.0)
+        return np.column_stack([1.0 - churn, churn])
+
+    def predict(self, x_data):
+        '''
+        returns numpy array of the predicted classes
+        '''
+        return self.classes_.take(
+            np.argmax(self.predict_proba(x_data), axis=1))
+
+
+def soft_predictions(teacher, x_train, y_train, cv=5):
+    '''
+    returns numpy array of out-of-fold churn probabilities of x_train, each
+    row scored by a copy of teacher fitted on the other folds
+
+    input:
+            teacher: classifier with predict_proba and classes_
+            x_train: pandas dataframe of the training features
+            y_train: training target
+            cv: number of folds
+    output:
+            soft: numpy array of churn probabilities
+    '''
+    proba = cross_val_predict(clone(teacher), x_train, y_train, cv=cv,
+                              method='predict_proba')
+    return proba[:, list(teacher.classes_).index(1)]
+
+
+def distill(x_train, soft, student, params=None, random_state=42):
+    '''
+    returns student fitted on the soft churn probabilities of x_train,
+    wrapped as a DistilledClassifier
+
+    input:
+            x_train: pandas dataframe of the training features
+            soft: churn probabilities of x_train, see soft_predictions
+            student: regressor class, e.g. DecisionTreeRegressor
+            params: dict of parameters of the student
+            random_state: seed of the student
+    output:
+            model: DistilledClassifier
+    '''
+    regressor = student(**(params or {}), random_state=random_state)
+    return DistilledClassifier(regressor.fit(x_train, soft))
+
+
+def _evaluate(model, x_test, y_test, teacher_labels):
+    '''
+    returns dict of test metrics, agreement with the teacher and size of a
+    fitted model
+    '''
+    proba = model.predict_proba(x_test)[:, list(model.classes_).index(1)]
+    labels = model.predict(x_test)
+    return {
+        'roc_auc': float(roc_auc_score(y_test, proba)),
+        'accuracy': float(accuracy_score(y_test, labels)),
+        'agreement': float(np.mean(labels == teacher_labels)),
+        'size_bytes': model_size(model),
+    }
+
+
+def _time(model, x_test, repeat):
+    '''
+    returns dict of the batch and single row latency of a fitted model
+    '''
+    return {
+        'batch_latency_ms': predict_latency(model, x_test, repeat) * 1000,
+        'row_latency_ms': predict_latency(model, x_test.iloc[:1],
+                                          repeat) * 1000,
+    }
+
+
+def fit_students(teacher, x_train, y_train, x_test, y_test, config=None):
+    '''
+    fit every student of config on the out-of-fold soft predictions of
+    teacher and compare them with teacher on the test set, without timing
+
+    input:
+            teacher: fitted random forest
+            x_train: pandas dataframe of the training features
+            y_train: training target
+            x_test: pandas dataframe of the test features
+            y_test: test target
+            config: dict of settings, defaults to DISTILL_CONFIG
+    output:
+            models: dict of student name -> DistilledClassifier
+            report: dict with the 'teacher' and every student's evaluation,
+            to pass to select_student
+    '''
+    config = {**DISTILL_CONFIG, **(config or {})}
+    teacher_labels = teacher.predict(x_test)
+    soft = soft_predictions(teacher, x_train, y_train, config['teacher_cv'])
+    report = {'teacher_cv': config['teacher_cv'],
+              'teacher': _evaluate(teacher, x_test, y_test, teacher_labels),
+              'students': {}, 'selected': None}
+    models = {}
+    for name, (student, params) in config['students'].items():
+        models[name] = distill(x_train, soft, student, params)
+        evaluation = _evaluate(models[name], x_test, y_test, teacher_labels)
+        evaluation['auc_delta'] = (evaluation['roc_auc']
+                                   - report['teacher']['roc_auc'])
+        report['students'][name] = evaluation
+        logging.info("SUCCESS: distilled %(name)s ROC AUC %(auc)+.4f, \
+%(size)d bytes", {'name': name, 'auc': evaluation['auc_delta'],
+                  'size': evaluation['size_bytes']})
+    return models, report
+
+
+def select_student(teacher, models, report, x_test, config=None):
+    '''
+    time teacher and the students returned by fit_students and select the
+    fastest one within max_auc_drop of the teacher's ROC AUC. Call it when
+    no other work runs, so the latencies are comparable.
+
+    input:
+            teacher: fitted random forest
+            models: dict of student name -> DistilledClassifier
+            report: dict returned by fit_students, updated in place
+            x_test: pandas dataframe of the test features
+            config: dict of settings, defaults to DISTILL_CONFIG
+    output:
+            model: selected DistilledClassifier, or None when no student is
+            accurate enough
+            report: dict with the 'teacher' and every student's evaluation
+            and the 'selected' student name
+    '''
+    config = {**DISTILL_CONFIG, **(config or {})}
+    report['teacher'].update(_time(teacher, x_test, config['repeat']))
+    for name, model in models.items():
+        report['students'][name].update(_time(model, x_test,
+                                              config['repeat']))
+        logging.info("SUCCESS: distilled %(name)s %(row).2f ms per row vs \
+%(teacher).2f ms", {'name': name,
+                    'row': report['students'][name]['row_latency_ms'],
+                    'teacher': report['teacher']['row_latency_ms']})
+    accurate = [name for name, evaluation in report['students'].items()
+                if -evaluation['auc_delta'] <= config['max_auc_drop']]
+    if not accurate:
+        logging.info("REJECT: no distilled model within %.4f ROC AUC of the \
+forest", config['max_auc_drop'])
+        return None, report
+    report['selected'] = min(
+        accurate, key=lambda name: report['students'][name]['row_latency_ms'])
+    return models[report['selected']], report
+
+
+def distill_forest(teacher, x_train, y_train, x_test, y_test, config=None):
+    '''
+    fit every student of config on the out-of-fold soft predictions of
+    teacher and select the fastest one within max_auc_drop of the teacher's
+    ROC AUC, see fit_students and select_student
+
+    input:
+            teacher: fitted random forest
+            x_train: pandas dataframe of the training features
+            y_train: training target
+            x_test: pandas dataframe of the test features
+            y_test: test target
+            config: dict of settings, defaults to DISTILL_CONFIG
+    output:
+            model: selected DistilledClassifier, or None when no student is
+            accurate enough
+            report: dict with the 'teacher' and every student's evaluation
+            and the 'selected' student name
+    '''
+    models, report = fit_students(teacher, x_train, y_train, x_test, y_test,
+                                  config)
+    return select_student(teacher, models, report, x_test, config)
+
+
+def export_distilled(model, report, model_pth=DISTILLED_MODEL_PTH,
+                     report_pth=DISTILL_REPORT_PTH):
+    '''
+    store the distilled model, when there is one, and the report as JSON
+    '''
+    with open(report_pth, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    if model is not None:
+        joblib.dump(model, model_pth)
+        logging.info("SUCCESS: stored distilled %(name)s at %(pth)s",
+                     {'name': report['selected'], 'pth': model_pth})
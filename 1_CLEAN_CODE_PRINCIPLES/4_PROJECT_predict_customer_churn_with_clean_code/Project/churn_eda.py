@@ -0,0 +1,251 @@
+"""
+Parallel rendering of the churn EDA figures.
+
+Every figure is drawn in a worker process on the headless Agg backend and
+closed as soon as it is saved. With n_jobs=1 the figures are drawn in the
+calling process, whose backend and style are left as they were. A manifest
+stores the hash of the columns each figure was drawn from and of the code of
+its plot function, so figures whose input and code did not change are
+skipped.
+"""
+
+import hashlib
+import inspect
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+EDA_DIR = './images/eda/'
+MANIFEST_PTH = './images/eda/.eda_manifest.json'
+
+
+def _use_headless_backend():
+    '''
+    switch matplotlib to the non-interactive Agg backend with seaborn styling
+    '''
+    import matplotlib  # pylint: disable=import-outside-toplevel
+    matplotlib.use('Agg', force=True)
+    import seaborn as sns  # pylint: disable=import-outside-toplevel
+    sns.set()
+
+
+def _pyplot():
+    '''
+    returns the pyplot module, imported on first use so that importing this
+    module does not load the plotting stack
+    '''
+    import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+    return plt
+
+
+def _seaborn():
+    '''
+    returns the seaborn module, imported on first use
+    '''
+    import seaborn as sns  # pylint: disable=import-outside-toplevel
+    return sns
+
+
+def _plot_hist(data, output_pth):
+    '''
+    histogram of the single column in data
+    '''
+    plt = _pyplot()
+    fig = plt.figure(figsize=(20, 10))
+    try:
+        data.iloc[:, 0].hist(ax=fig.gca())
+        fig.savefig(output_pth)
+    finally:
+        plt.close(fig)
+
+
+def _plot_normalized_counts(data, output_pth):
+    '''
+    bar plot of the share of each value of the single column in data
+    '''
+    plt = _pyplot()
+    fig = plt.figure(figsize=(20, 10))
+    try:
+        data.iloc[:, 0].value_counts('normalize').plot(kind='bar',
+                                                       ax=fig.gca())
+        fig.savefig(output_pth)
+    finally:
+        plt.close(fig)
+
+
+def _plot_density(data, output_pth):
+    '''
+    density histogram with kde of the single column in data
+    '''
+    plt, sns = _pyplot(), _seaborn()
+    fig = plt.figure(figsize=(20, 10))
+    try:
+        sns.histplot(data.iloc[:, 0], stat='density', kde=True, ax=fig.gca())
+        fig.savefig(output_pth)
+    finally:
+        plt.close(fig)
+
+
+def _plot_heatmap(data, output_pth):
+    '''
+    heatmap of the correlation between the columns of data
+    '''
+    plt, sns = _pyplot(), _seaborn()
+    fig = plt.figure(figsize=(20, 10))
+    try:
+        sns.heatmap(data.corr(),
+                    annot=False,
+                    cmap='Dark2_r',
+                    linewidths=2,
+                    ax=fig.gca())
+        fig.savefig(output_pth)
+    finally:
+        plt.close(fig)
+
+
+# name, input column (None for every numeric column), plot function, file
+EDA_PLOTS = [
+    ('churn', 'churn', _plot_hist, 'churn_distribution.png'),
+    ('Customer_Age', 'Customer_Age', _plot_hist,
+     'customer_age_distribution.png'),
+    ('Marital_Status', 'Marital_Status', _plot_normalized_counts,
+     'marital_status_distribution.png'),
+    ('Total_Trans_Ct', 'Total_Trans_Ct', _plot_density,
+     'total_transaction_distribution.png'),
+    ('correlation heat map', None, _plot_heatmap, 'heatmap.png'),
+]
+
+
+def data_hash(data):
+    '''
+    returns a sha256 hex digest of the values and column names of data
+    '''
+    digest = hashlib.sha256()
+    digest.update(repr(list(data.columns)).encode())
+    digest.update(repr(list(data.dtypes.astype(str))).encode())
+    digest.update(
+        pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def plot_hash(plot):
+    '''
+    returns a sha256 hex digest of the source code of a plot function
+    '''
+    return hashlib.sha256(inspect.getsource(plot).encode()).hexdigest()
+
+
+def _load_manifest(manifest_pth):
+    '''
+    returns the dict of figure path -> input hash from the last run
+    '''
+    try:
+        with open(manifest_pth, encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_manifest(manifest, manifest_pth):
+    '''
+    store the dict of figure path -> input hash for the next run
+    '''
+    with open(manifest_pth, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+
+def _plot_input(dff, column):
+    '''
+    returns the dataframe a plot is drawn from
+    '''
+    if column is None:
+        return dff.select_dtypes('number')
+    return dff[[column]]
+
+
+def _submit_inline(plot, data, output_pth):
+    '''
+    draw a figure in this process, returning the raised error or None
+    '''
+    try:
+        plot(data, output_pth)
+    except Exception as err:  # reported by render_eda like pool failures
+        return err
+    return None
+
+
+def _wait(future):
+    '''
+    wait for a pooled figure, returning the raised error or None
+    '''
+    try:
+        future.result()
+    except Exception as err:  # reported by render_eda like inline failures
+        return err
+    return None
+
+
+def render_eda(dff, output_dir=EDA_DIR, manifest_pth=MANIFEST_PTH,
+               n_jobs=None):
+    '''
+    render the EDA figures of dff into output_dir in a process pool,
+    skipping figures whose input data and plot code hash match the manifest
+
+    input:
+            dff: pandas dataframe
+            output_dir: directory the figures are saved in
+            manifest_pth: json file with the input hash of each figure. None
+            renders every figure without reading or writing a manifest.
+            n_jobs: number of worker processes, defaults to the cpu count.
+            1 renders in this process.
+    output:
+            rendered: list of the figure paths that were drawn
+    '''
+    manifest = _load_manifest(manifest_pth) if manifest_pth else {}
+    jobs = []
+    for name, column, plot, file_name in EDA_PLOTS:
+        logging.info("Attempting %s view.", name)
+        try:
+            data = _plot_input(dff, column)
+        except KeyError as err:
+            logging.error("FAIL: The %(col)s column is missing from the \
+dataFrame. Could not visualize. (%(err)s)", {'col': column, 'err': err})
+            raise err
+        output_pth = os.path.join(output_dir, file_name)
+        key = f"{plot_hash(plot)}-{data_hash(data)}"
+        if manifest.get(output_pth) == key and os.path.exists(output_pth):
+            logging.info("SKIP: %s view unchanged since the last run.", name)
+            continue
+        jobs.append((name, plot, data, output_pth, key))
+
+    rendered = []
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(jobs))
+    if not jobs:
+        results = []
+    elif n_jobs == 1:
+        with _pyplot().rc_context():
+            _seaborn().set()
+            results = [_submit_inline(plot, data, output_pth)
+                       for _, plot, data, output_pth, _ in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_use_headless_backend) as pool:
+            futures = [pool.submit(plot, data, output_pth)
+                       for _, plot, data, output_pth, _ in jobs]
+            results = [_wait(future) for future in futures]
+
+    for (name, _, _, output_pth, key), err in zip(jobs, results):
+        if err is not None:
+            logging.error("FAIL: The %(name)s view failed. Could not \
+visualize. More info here: %(err)s", {'name': name, 'err': err})
+            manifest.pop(output_pth, None)
+            continue
+        manifest[output_pth] = key
+        rendered.append(output_pth)
+        logging.info("SUCCESS: %(name)s view saved to %(path)s",
+                     {'name': name, 'path': output_pth})
+    if manifest_pth:
+        _save_manifest(manifest, manifest_pth)
+    return rendered
@@ -0,0 +1,108 @@
+"""
+Target encoder for the categorical columns of the churn data.
+
+The encoder learns the proportion of churn for every category from the
+integer codes of each column, counted with numpy.bincount, maps it back onto
+a DataFrame with vectorized lookups and can be persisted so scoring runs
+reuse the rates learned during training.
+"""
+
+import logging
+import joblib
+import numpy as np
+import pandas as pd
+
+ENCODER_PTH = './models/encoder.pkl'
+
+
+class TargetEncoder:
+    '''
+    Replaces each categorical column with the mean of the response for its
+    category. Categories unseen at fit time receive the overall response rate.
+
+    attributes:
+            category_lst: list of categorical columns that are encoded
+            response: name of the response column used while fitting
+            suffix: suffix appended to each encoded column name
+            rates_: dict of column name -> pandas Series of category rates
+            prior_: overall response rate used for unseen categories
+    '''
+
+    def __init__(self, category_lst, response='churn', suffix='_Churn'):
+        self.category_lst = list(category_lst)
+        self.response = response
+        self.suffix = suffix
+        self.rates_ = None
+        self.prior_ = None
+
+    def fit(self, dff):
+        '''
+        learn the response rate of every category, one column at a time
+        from its integer codes
+
+        input:
+                dff: pandas dataframe holding category_lst and response
+        output:
+                self: the fitted encoder
+        '''
+        response = dff[self.response].to_numpy(dtype=np.float64)
+        self.rates_ = {}
+        for column in self.category_lst:
+            # categorical columns reuse their codes, others are factorized;
+            # missing values get code -1 and are left out like in groupby
+            codes, categories = pd.factorize(dff[column])
+            seen = codes >= 0
+            sums = np.bincount(codes[seen], weights=response[seen],
+                               minlength=len(categories))
+            counts = np.bincount(codes[seen], minlength=len(categories))
+            self.rates_[column] = pd.Series(
+                sums / counts, index=pd.Index(categories, name=column),
+                name=self.response)
+        self.prior_ = float(dff[self.response].mean())
+        logging.info("SUCCESS: fitted target encoder on %d columns.",
+                     len(self.category_lst))
+        return self
+
+    def transform(self, dff):
+        '''
+        add an encoded `<category><suffix>` column for every fitted category
+
+        input:
+                dff: pandas dataframe holding the columns in category_lst
+        output:
+                dff: the same dataframe with the encoded float columns added
+        '''
+        if self.rates_ is None:
+            raise ValueError("TargetEncoder must be fitted before transform")
+        for category in self.category_lst:
+            encoded = dff[category].map(self.rates_[category]).astype(float)
+            unseen = encoded.isna().sum()
+            if unseen:
+                logging.info("%(count)d rows of %(col)s have unseen \
+categories, using prior %(prior).4f",
+                             {'count': unseen, 'col': category,
+                              'prior': self.prior_})
+            dff[f'{category}{self.suffix}'] = encoded.fillna(self.prior_)
+        return dff
+
+    def fit_transform(self, dff):
+        '''
+        fit the encoder on dff and return dff with the encoded columns
+        '''
+        return self.fit(dff).transform(dff)
+
+    def save(self, pth):
+        '''
+        serialize the fitted encoder to pth
+        '''
+        joblib.dump(self, pth)
+        logging.info("SUCCESS: stored target encoder at %s", pth)
+
+    @staticmethod
+    def load(pth):
+        '''
+        returns the fitted encoder serialized at pth
+        '''
+        encoder = joblib.load(pth)
+        logging.info("SUCCESS: loaded target encoder from %s", pth)
+        return encoder
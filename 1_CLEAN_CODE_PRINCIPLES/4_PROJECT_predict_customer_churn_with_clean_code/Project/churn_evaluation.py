@@ -0,0 +1,86 @@
+"""
+Prediction cache shared by the churn evaluation and reporting stages.
+
+Each model is run once per dataset with predict_proba. The class labels are
+derived from those probabilities the same way the scikit-learn classifiers
+do, so classification reports, ROC curves and threshold analysis all read
+from one inference pass.
+"""
+
+import logging
+import threading
+import time
+import numpy as np
+
+
+class PredictionCache:
+    '''
+    Stores the labels and class probabilities of each model on each dataset.
+
+    attributes:
+            datasets: dict of dataset name -> features the models score
+    '''
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self._proba = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        '''
+        returns the lock that makes a (model, dataset) pair compute once
+        '''
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def predict(self, model_name, model, dataset):
+        '''
+        returns the labels and probabilities of model on dataset, running
+        predict_proba only the first time the pair is requested
+
+        input:
+                model_name: name the predictions are stored under
+                model: fitted classifier with predict_proba and classes_
+                dataset: name of a dataset in self.datasets
+        output:
+                labels: numpy array of predicted classes
+                proba: numpy array of class probabilities
+        '''
+        key = (model_name, dataset)
+        with self._key_lock(key):
+            if key not in self._proba:
+                start = time.perf_counter()
+                proba = model.predict_proba(self.datasets[dataset])
+                self._proba[key] = proba
+                self._labels[key] = model.classes_.take(
+                    np.argmax(proba, axis=1))
+                logging.info(
+                    "SUCCESS: Scored %(model)s on %(data)s in %(time).2fs",
+                    {'model': model_name, 'data': dataset,
+                     'time': time.perf_counter() - start})
+        return self._labels[key], self._proba[key]
+
+    def predict_all(self, model_name, model):
+        '''
+        score model on every dataset and return dict of dataset -> labels
+        '''
+        return {dataset: self.predict(model_name, model, dataset)[0]
+                for dataset in self.datasets}
+
+    def labels(self, model_name, dataset):
+        '''
+        returns the cached labels of model_name on dataset
+        '''
+        return self._labels[(model_name, dataset)]
+
+    def proba(self, model_name, dataset, column=1):
+        '''
+        returns column of the cached class probabilities of model_name on
+        dataset (the churn class by default), or all of them for None
+        '''
+        proba = self._proba[(model_name, dataset)]
+        if column is None:
+            return proba
+        return proba[:, column]
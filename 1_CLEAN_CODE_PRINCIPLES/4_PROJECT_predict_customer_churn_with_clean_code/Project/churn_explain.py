@@ -0,0 +1,180 @@
+"""
+Bounded SHAP computation for the churn tree models.
+
+SHAP values are computed on at most max_rows rows, drawn stratified on the
+target when it is given, in chunks spread over worker processes. The result
+is cached on disk under a key made of the model hash and the data hash, so
+re-rendering the summary plot does not recompute them. The least recently
+used entries are removed once the cache is larger than cache_max_mb.
+"""
+
+import logging
+import os
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.model_selection import train_test_split
+
+SHAP_CACHE_DIR = './models/shap_cache'
+SHAP_MAX_ROWS = 1000
+SHAP_CACHE_MAX_MB = 200
+
+
+def sample_rows(x_data, y_data=None, max_rows=SHAP_MAX_ROWS,
+                random_state=42):
+    '''
+    returns at most max_rows rows of x_data, stratified on y_data if given
+
+    input:
+            x_data: pandas dataframe of features
+            y_data: target used to stratify the sample, optional
+            max_rows: largest number of rows returned, None keeps every row
+            random_state: seed of the sample
+    output:
+            x_sample: pandas dataframe with the sampled rows
+    '''
+    if max_rows is None or len(x_data) <= max_rows:
+        return x_data
+    if y_data is not None:
+        x_sample, _ = train_test_split(x_data, train_size=max_rows,
+                                       stratify=y_data,
+                                       random_state=random_state)
+        return x_sample.sort_index()
+    return x_data.sample(n=max_rows, random_state=random_state).sort_index()
+
+
+def _chunk_shap_values(model, chunk):
+    '''
+    returns the SHAP values of one chunk of rows for a tree model
+    '''
+    import shap  # pylint: disable=import-outside-toplevel
+    return shap.TreeExplainer(model).shap_values(chunk)
+
+
+def _concat_chunks(chunks):
+    '''
+    joins per-chunk SHAP values, which are an array or a list of arrays with
+    one entry per class depending on the shap version
+    '''
+    if isinstance(chunks[0], list):
+        return [np.concatenate([chunk[cls] for chunk in chunks])
+                for cls in range(len(chunks[0]))]
+    return np.concatenate(chunks)
+
+
+def model_fingerprint(model):
+    '''
+    returns a hash of a fitted model that is the same in every process. The
+    node records of scikit-learn trees hold uninitialized padding bytes, so
+    tree models are hashed from their node fields instead of their pickle.
+    '''
+    estimators = getattr(model, 'estimators_', [model])
+    if not all(hasattr(estimator, 'tree_') for estimator in estimators):
+        return joblib.hash(model)
+    return joblib.hash((type(model).__name__, model.get_params(),
+                        getattr(model, 'classes_', None),
+                        [(tree.children_left, tree.children_right,
+                          tree.feature, tree.threshold, tree.value)
+                         for tree in (estimator.tree_
+                                      for estimator in estimators)]))
+
+
+def shap_cache_key(model, x_data):
+    '''
+    returns the cache key of the SHAP values of model on x_data
+    '''
+    data_hash = joblib.hash(
+        (list(x_data.columns),
+         pd.util.hash_pandas_object(x_data, index=True).values))
+    return f"{model_fingerprint(model)}-{data_hash}"
+
+
+def evict_shap_cache(cache_dir=SHAP_CACHE_DIR, max_mb=SHAP_CACHE_MAX_MB):
+    '''
+    remove the least recently used cached SHAP values until the cache is at
+    most max_mb
+
+    input:
+            cache_dir: directory of the cached values
+            max_mb: largest total size of the cache, None for no limit
+    output:
+            removed: list of the removed file paths
+    '''
+    if max_mb is None or not os.path.isdir(cache_dir):
+        return []
+    entries = sorted((os.path.getmtime(pth), os.path.getsize(pth), pth)
+                     for pth in (os.path.join(cache_dir, name)
+                                 for name in os.listdir(cache_dir))
+                     if pth.endswith('.joblib'))
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, pth in entries:
+        if total <= max_mb * 1e6:
+            break
+        os.remove(pth)
+        total -= size
+        removed.append(pth)
+    if removed:
+        logging.info("Evicted %(count)d cached SHAP values, %(mb).1f MB \
+left", {'count': len(removed), 'mb': total / 1e6})
+    return removed
+
+
+def compute_shap_values(model, x_data, y_data=None, max_rows=SHAP_MAX_ROWS,
+                        n_jobs=None, chunk_size=None,
+                        cache_dir=SHAP_CACHE_DIR,
+                        cache_max_mb=SHAP_CACHE_MAX_MB):
+    '''
+    compute SHAP values of a tree model on a bounded sample of x_data
+
+    input:
+            model: fitted tree based model, e.g. a RandomForestClassifier
+            x_data: pandas dataframe of features
+            y_data: target used to stratify the sample, optional
+            max_rows: largest number of rows explained, None explains all
+            n_jobs: worker processes, defaults to the cpu count
+            chunk_size: rows per worker task, defaults to an even split
+            over the workers
+            cache_dir: directory of cached values, None disables the cache
+            cache_max_mb: largest total size of the cache
+    output:
+            shap_values: SHAP values of x_sample as returned by shap
+            x_sample: pandas dataframe of the explained rows
+    '''
+    x_sample = sample_rows(x_data, y_data, max_rows=max_rows)
+    cache_pth = None
+    if cache_dir is not None:
+        cache_pth = os.path.join(cache_dir,
+                                 f"{shap_cache_key(model, x_sample)}.joblib")
+        if os.path.exists(cache_pth):
+            logging.info("SUCCESS: Loaded SHAP values from cache %s",
+                         cache_pth)
+            os.utime(cache_pth)
+            return joblib.load(cache_pth), x_sample
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    chunk_size = chunk_size or -(-len(x_sample) // n_jobs)
+    chunks = [x_sample.iloc[start:start + chunk_size]
+              for start in range(0, len(x_sample), chunk_size)]
+    logging.info("Computing SHAP values for %(rows)d of %(total)d rows in \
+%(chunks)d chunks", {'rows': len(x_sample), 'total': len(x_data),
+                     'chunks': len(chunks)})
+    start = time.perf_counter()
+    if n_jobs == 1 or len(chunks) == 1:
+        values = [_chunk_shap_values(model, chunk) for chunk in chunks]
+    else:
+        values = Parallel(n_jobs=n_jobs)(
+            delayed(_chunk_shap_values)(model, chunk) for chunk in chunks)
+    shap_values = _concat_chunks(values)
+    logging.info("SUCCESS: Computed SHAP values in %.2fs",
+                 time.perf_counter() - start)
+
+    if cache_pth is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        joblib.dump(shap_values, cache_pth + '.partial')
+        os.replace(cache_pth + '.partial', cache_pth)
+        logging.info("SUCCESS: Cached SHAP values at %s", cache_pth)
+        evict_shap_cache(cache_dir, cache_max_mb)
+    return shap_values, x_sample
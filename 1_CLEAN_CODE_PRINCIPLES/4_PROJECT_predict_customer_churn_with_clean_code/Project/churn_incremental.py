@@ -0,0 +1,178 @@
+"""
+Incremental update of the churn models with a batch of new customers.
+
+The random forest keeps its trees and grows new ones on the new rows with
+warm_start, using the best parameters of the last search. The logistic
+regression is converted once into a standard scaler and an SGDClassifier
+with log loss that starts from the same coefficients, so later batches are
+learned with partial_fit. A stratified holdout of the new rows decides for
+each model whether the update is kept, and the decision threshold of a kept
+update is chosen again on it.
+"""
+
+import copy
+import json
+import logging
+import os
+import numpy as np
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+# Settings of incremental_update: trees added to the forest, share of the
+# new rows held out for validation, partial_fit passes over the new rows and
+# the drop in holdout ROC AUC that is still accepted.
+INCREMENTAL_CONFIG = {
+    'new_trees': 50,
+    'holdout_size': 0.3,
+    'epochs': 5,
+    'tolerance': 0.0,
+}
+
+
+def load_best_params(pth):
+    '''
+    returns the best parameters stored by the last search, or an empty dict
+    when pth does not exist
+    '''
+    if not os.path.exists(pth):
+        logging.info("No best params at %s, keeping the forest params", pth)
+        return {}
+    with open(pth, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def add_trees(forest, x_new, y_new, new_trees, params=None):
+    '''
+    returns a copy of forest with new_trees more trees grown on the new rows
+
+    input:
+            forest: fitted RandomForestClassifier, left unchanged
+            x_new: features of the new rows
+            y_new: target of the new rows
+            new_trees: number of trees to add
+            params: tree parameters of the added trees, e.g. the best
+            parameters of the last search. n_estimators is ignored.
+    output:
+            forest: the updated copy
+    '''
+    params = {name: value for name, value in (params or {}).items()
+              if name != 'n_estimators'}
+    updated = copy.deepcopy(forest)
+    updated.set_params(**params, warm_start=True,
+                       n_estimators=len(forest.estimators_) + new_trees)
+    updated.fit(x_new, y_new)
+    updated.set_params(warm_start=False)
+    logging.info("SUCCESS: Grew %(new)d trees on %(rows)d new rows, \
+%(total)d trees in total", {'new': new_trees, 'rows': len(x_new),
+                            'total': len(updated.estimators_)})
+    return updated
+
+
+def to_incremental_logistic(model, x_reference, alpha=1e-4, eta0=1e-3):
+    '''
+    returns a scaler and SGDClassifier pipeline that predicts like a fitted
+    LogisticRegression and can be updated with partial_fit
+
+    input:
+            model: fitted LogisticRegression, or a pipeline returned by this
+            function which is copied unchanged
+            x_reference: features the scaler is fitted on
+            alpha: regularization of the SGDClassifier
+            eta0: constant learning rate of the SGDClassifier
+    output:
+            pipeline: sklearn Pipeline of StandardScaler and SGDClassifier
+    '''
+    if isinstance(model, Pipeline):
+        return copy.deepcopy(model)
+    scaler = StandardScaler().fit(x_reference)
+    sgd = SGDClassifier(loss='log_loss', alpha=alpha,
+                        learning_rate='constant', eta0=eta0,
+                        random_state=42)
+    # w.x + b == (w * scale).z + (w.mean + b) for z = (x - mean) / scale
+    sgd.classes_ = model.classes_
+    sgd.coef_ = model.coef_ * scaler.scale_
+    sgd.intercept_ = model.intercept_ + model.coef_ @ scaler.mean_
+    sgd.n_features_in_ = model.n_features_in_
+    return Pipeline([('scaler', scaler), ('sgd', sgd)])
+
+
+def partial_fit_logistic(pipeline, x_new, y_new, epochs):
+    '''
+    returns a copy of pipeline whose SGDClassifier made epochs passes of
+    partial_fit over the new rows. The scaler is kept fixed so the learned
+    coefficients keep their meaning.
+    '''
+    updated = copy.deepcopy(pipeline)
+    sgd = updated.named_steps['sgd']
+    # partial_fit needs the features in the dtype of the coefficients, which
+    # come from the float64 LogisticRegression even for float32 features
+    x_scaled = np.asarray(updated.named_steps['scaler'].transform(x_new),
+                          dtype=sgd.coef_.dtype)
+    for _ in range(epochs):
+        sgd.partial_fit(x_scaled, y_new)
+    logging.info("SUCCESS: Updated logistic model with %(epochs)d passes over \
+%(rows)d new rows", {'epochs': epochs, 'rows': len(x_new)})
+    return updated
+
+
+def _holdout_proba(model, x_holdout):
+    '''
+    returns the churn probability of model on the holdout
+    '''
+    churn = list(model.classes_).index(1)
+    return model.predict_proba(x_holdout)[:, churn]
+
+
+def incremental_update(x_new, y_new, forest, logistic, params=None,
+                       config=None, random_state=42):
+    '''
+    update both models with the new rows and keep each update only if it
+    scores at least as well on a holdout of the new rows
+
+    input:
+            x_new: features of the new rows
+            y_new: target of the new rows
+            forest: fitted RandomForestClassifier
+            logistic: fitted LogisticRegression or incremental pipeline
+            params: best parameters of the last search, used for new trees
+            config: dict of settings, defaults to INCREMENTAL_CONFIG
+            random_state: seed of the holdout split
+    output:
+            results: dict of model name -> dict with the kept 'model', the
+            'old_score' and 'new_score' on the holdout, 'accepted' and
+            the 'holdout_target' and 'holdout_proba' of the kept model
+    '''
+    config = {**INCREMENTAL_CONFIG, **(config or {})}
+    x_update, x_holdout, y_update, y_holdout = train_test_split(
+        x_new, y_new, test_size=config['holdout_size'], stratify=y_new,
+        random_state=random_state)
+    candidates = {
+        'random_forest': (forest, lambda: add_trees(
+            forest, x_update, y_update, config['new_trees'], params)),
+        'logistic_regression': (logistic, lambda: partial_fit_logistic(
+            to_incremental_logistic(logistic, x_update), x_update, y_update,
+            config['epochs'])),
+    }
+    results = {}
+    for name, (old, update) in candidates.items():
+        new = update()
+        old_proba = _holdout_proba(old, x_holdout)
+        new_proba = _holdout_proba(new, x_holdout)
+        old_score = roc_auc_score(y_holdout, old_proba)
+        new_score = roc_auc_score(y_holdout, new_proba)
+        accepted = bool(new_score >= old_score - config['tolerance'])
+        results[name] = {'model': new if accepted else old,
+                         'old_score': float(old_score),
+                         'new_score': float(new_score),
+                         'accepted': accepted,
+                         'holdout_target': np.asarray(y_holdout),
+                         'holdout_proba': new_proba if accepted
+                         else old_proba}
+        logging.info("%(result)s: %(name)s holdout ROC AUC %(old).4f -> \
+%(new).4f on %(rows)d rows", {'result': 'KEEP' if accepted else 'REJECT',
+                              'name': name, 'old': old_score,
+                              'new': new_score, 'rows': len(x_holdout)})
+    return results
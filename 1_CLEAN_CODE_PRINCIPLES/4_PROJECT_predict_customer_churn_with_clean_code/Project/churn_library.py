@@ -6,52 +6,175 @@ Date: November 2022
 """
 
 # import libraries
+import argparse
+import hashlib
+import importlib.util
 import logging
 import os
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import GridSearchCV
 from sklearn.metrics import RocCurveDisplay, classification_report
 import pandas as pd
-import shap
+from pandas.api.types import is_numeric_dtype
 import joblib
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set()
+from churn_artifacts import ARRAYS_DIR, COMPRESSED_PTH, export_forest
+from churn_distill import (DISTILL_CONFIG, export_distilled, fit_students,
+                           select_student)
+from churn_encoding import ENCODER_PTH, TargetEncoder
+from churn_eda import MANIFEST_PTH, render_eda
+from churn_evaluation import PredictionCache
+from churn_explain import compute_shap_values
+from churn_incremental import incremental_update, load_best_params
+from churn_logging import setup_logging
+from churn_profiling import PROFILER, output_rows, profiled
+from churn_pruning import (PRUNED_MODEL_PTH, PRUNING_CONFIG,
+                           PRUNING_REPORT_PTH, prune_forest, time_pruning,
+                           write_pruning_report)
+from churn_reporting import (REPORT_FORMATS, TEXT_FORMATS,
+                             classification_reports, closing_figures, pyplot,
+                             report_figure, write_text_report)
+from churn_schema import DTYPES, apply_schema, read_dtypes
+from churn_stability import (STABILITY_CONFIG, STABILITY_MODELS,
+                             run_stability, write_stability_report)
+from churn_search import BEST_PARAMS_PTH, run_search
+from churn_tasks import PLOT_LOCK, run_task_graph
+from churn_threshold import (THRESHOLD_CONFIG, analyse_thresholds,
+                             validation_proba)
 
 os.environ['QT_QPA_PLATFORM'] = 'offscreen'
 
-logging.basicConfig(
-    filename="./logs/churn_library.log",
-    level=logging.INFO,
-    filemode='w',
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S')
+setup_logging("./logs/churn_library.log", level=logging.INFO, filemode='w')
 
+CACHE_DIR = './data/.cache'
 
-def import_data(pth, response='churn'):
+# Random forest search used by train_models. mode is 'grid', 'halving' or
+# 'random'; n_iter, max_resources and time_budget (seconds) bound its cost.
+# Fitted searches are cached in cache_dir and reused for identical data.
+SEARCH_CONFIG = {
+    'mode': 'grid',
+    'cv': 5,
+    'n_jobs': -1,
+    'cache_dir': './models/search_cache',
+}
+
+# SHAP values are computed on a stratified sample of at most max_rows test
+# rows, split over n_jobs processes and cached in cache_dir.
+SHAP_CONFIG = {
+    'max_rows': 1000,
+    'n_jobs': None,
+    'cache_dir': './models/shap_cache',
+}
+
+
+def _short_hash(text):
+    '''
+    returns the first 8 hex digits of the sha256 of text
+    '''
+    return hashlib.sha256(text.encode()).hexdigest()[:8]
+
+
+def _file_hash(pth, block_size=1 << 20):
+    '''
+    returns the sha256 hex digest of the content of the file at pth
+    '''
+    digest = hashlib.sha256()
+    with open(pth, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cache_path(pth, response, cache_dir, cache_key='content'):
+    '''
+    returns the parquet cache path for the csv at pth, or None when pyarrow
+    is not installed. The name is made of the csv name, a key of its path
+    and the response name, and a key of the csv version and the dtype
+    schema, so changing the csv or the schema misses the cache.
+
+    cache_key 'content' versions the csv by the sha256 of its content, which
+    hashes at about 1 GB/s, far less than parsing it. 'stat' uses its size
+    and modification time instead and skips reading the file, at a risk: a
+    rewrite of the same size within the mtime resolution, or a copy that
+    keeps the mtime (cp -p, rsync -t, tar), returns the stale cached data.
+    '''
+    if cache_key not in ('content', 'stat'):
+        raise ValueError(f"cache_key must be 'content' or 'stat', got \
+{cache_key}")
+    if importlib.util.find_spec('pyarrow') is None:
+        logging.info("pyarrow is not installed, skipping the data cache.")
+        return None
+    if cache_key == 'stat':
+        stat = os.stat(pth)
+        csv_version = f"{stat.st_size}|{stat.st_mtime_ns}"
+    else:
+        csv_version = _file_hash(pth)
+    source = _short_hash(f"{os.path.realpath(pth)}|{response}")
+    version = _short_hash(
+        f"{cache_key}|{csv_version}|{sorted(DTYPES.items())}")
+    stem = os.path.splitext(os.path.basename(pth))[0]
+    return os.path.join(cache_dir, f"{stem}-{source}-{version}.parquet")
+
+
+def _prune_cache(cache_pth):
+    '''
+    remove the cached copies of earlier versions of the csv cached at
+    cache_pth
+    '''
+    prefix = os.path.basename(cache_pth).rsplit('-', 1)[0] + '-'
+    cache_dir = os.path.dirname(cache_pth)
+    for name in os.listdir(cache_dir):
+        pth = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and name.endswith('.parquet') and \
+                pth != cache_pth:
+            os.remove(pth)
+            logging.info("Removed stale data cache %s", pth)
+
+
+@profiled(rows=output_rows)
+def import_data(pth, response='churn', engine=None, cache_dir=CACHE_DIR,
+                cache_key='content'):
     '''
     returns dataframe for the csv found at pth
 
     input:
             pth: a path to the csv
+            response: name given to the churn target column
+            engine: csv parser passed to pandas, e.g. 'pyarrow'. Defaults to
+            the pandas C parser.
+            cache_dir: directory for the parquet copy of the prepared data,
+            keyed by the content hash of the csv. None disables the cache.
+            cache_key: 'content', or 'stat' to key the cache by the size and
+            modification time of the csv, see _cache_path
     output:
             df: pandas dataframe
     '''
     try:
         logging.info("Opening %s", pth)
+        cache_pth = None
+        if cache_dir is not None:
+            cache_pth = _cache_path(pth, response, cache_dir, cache_key)
+        if cache_pth is not None and os.path.exists(cache_pth):
+            dff = pd.read_parquet(cache_pth)
+            logging.info('SUCCESS: Read %(rows)d rows of data from cache \
+%(cache)s', {'rows': len(dff), 'cache': cache_pth})
+            return dff
+        columns = pd.read_csv(pth, nrows=0).columns
         # drop index if present ignore otherwise
-        dff = pd.read_csv(pth).drop('Unnamed: 0', axis=1, errors='ignore')
+        dff = apply_schema(pd.read_csv(pth,
+                                       usecols=[col for col in columns
+                                                if col != 'Unnamed: 0'],
+                                       dtype=read_dtypes(columns),
+                                       engine=engine))
         logging.info('SUCCESS: Read in %d rows of data', len(dff))
     except FileNotFoundError as err:
         logging.error(err)
         raise err
     try:
         logging.info("Creating target varible with name: %s", response)
-        dff[response] = dff['Attrition_Flag'].apply(
-            lambda val: 0 if val == "Existing Customer" else 1)
+        dff[response] = (dff['Attrition_Flag'] != "Existing Customer"
+                         ).astype(np.int8)
         dff.drop('Attrition_Flag', axis=1, inplace=True)
         logging.info("SUCCESS: created target variable.")
     except KeyError as err:
@@ -69,14 +192,25 @@ def import_data(pth, response='churn'):
         logging.error("FAIL: %(target)s not a column in DF. %(error)s",
                       {'target': 'CLIENTNUM', 'error': err})
         raise err
+    if cache_pth is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        dff.to_parquet(cache_pth)
+        logging.info('SUCCESS: Cached prepared data at %s', cache_pth)
+        _prune_cache(cache_pth)
     return dff
 
 
-def perform_eda(dff):
+@profiled()
+def perform_eda(dff, n_jobs=None, manifest_pth=MANIFEST_PTH):
     '''
-    perform eda on df and save figures to images folder
+    perform eda on df and save figures to images folder. The figures are
+    drawn in parallel worker processes and a figure is only redrawn when the
+    hash of its input columns changed since the last run.
     input:
             df: pandas dataframe
+            n_jobs: number of worker processes, 1 draws in this process
+            manifest_pth: json file with the input hash of each figure, None
+            redraws every figure
 
     output:
             None
@@ -85,65 +219,14 @@ def perform_eda(dff):
     # print(dff.shape)
     # print(dff.isnull().sum())
 
-    try:
-        logging.info("Attempting churn view.")
-        plt.figure(figsize=(20, 10))
-        dff['churn'].hist()
-        plt.savefig('./images/eda/churn_distribution.png')
-    except KeyError as err:
-        logging.error("FAIL: The Churn column is missing from the dataFrame.\
-                Could not visualize. (%s)", err)
-        raise err
-    try:
-        logging.info("Attempting Customer_age view.")
-        plt.figure(figsize=(20, 10))
-        dff['Customer_Age'].hist()
-        plt.savefig('./images/eda/customer_age_distribution.png')
-    except KeyError as err:
-        logging.error("FAIL: The Customer_Age column is missing from the \
-                dataFrame. Could not visualize. (%s)", err)
-        raise err
-    try:
-        logging.info("Attempting Marital_Status view.")
-        plt.figure(figsize=(20, 10))
-        dff.Marital_Status.value_counts('normalize').plot(kind='bar')
-        plt.savefig('./images/eda/marital_status_distribution.png')
-    except KeyError as err:
-        logging.error("FAIL: The Marital_Status column is missing from the \
-                dataFrame. Could not visualize. (%s)", err)
-        raise err
+    rendered = render_eda(dff, output_dir='./images/eda/',
+                          manifest_pth=manifest_pth, n_jobs=n_jobs)
+    logging.info("SUCCESS: Rendered %d EDA views.", len(rendered))
 
-    try:
-        logging.info("Attempting Total_Trans_Ct view.")
-        plt.figure(figsize=(20, 10))
-        sns.histplot(dff['Total_Trans_Ct'], stat='density', kde=True)
-        plt.savefig('./images/eda/total_transaction_distribution.png')
-    except KeyError as err:
-        logging.error("FAIL: The Total_Trans_Ct column is missing from the \
-                dataFrame. Could not visualize. (%s)", err)
-        raise err
 
-    try:
-        logging.info("Attempting correlation heat map view.")
-        plt.figure(figsize=(20, 10))
-        sns.heatmap(dff.corr(),
-                    annot=False,
-                    cmap='Dark2_r',
-                    linewidths=2)
-        plt.savefig('./images/eda/heatmap.png')
-    except TypeError as err:
-        logging.error("FAIL: The correlation of the DF failed due to \
-            TypeError: %s", err)
-    except FileNotFoundError as err:
-        logging.error("FAIL: The correlation heatmap failed. \
-                Could not visualize. More info here: %s", err)
-    except Exception as err:  # Not sure why this could fail, leaving it open
-        logging.error("FAIL: The correlation heatmap failed. \
-                Could not visualize. More info here: %s", err)
-        raise err
-
-
-def encoder_helper(dff, category_lst, response='churn'):
+@profiled()
+def encoder_helper(dff, category_lst, response='churn', encoder=None,
+                   encoder_pth=ENCODER_PTH):
     '''
     helper function to turn each categorical column into a new column with
     propotion of churn for each category - associated with cell 15 from the
@@ -154,38 +237,88 @@ def encoder_helper(dff, category_lst, response='churn'):
             category_lst: list of columns that contain categorical features
             response: string of response name [optional argument that could be
             used for naming variables or index y column]
+            encoder: fitted TargetEncoder to reuse, e.g. at scoring time. A new
+            encoder is fitted on df when None.
+            encoder_pth: path the newly fitted encoder is stored at, None
+            skips persisting it
 
     output:
             df: pandas dataframe with new columns for
     '''
-
-    for category in category_lst:
-        try:
-            logging.info("Creating encoded column %s", category)
-            temp_cat_lst = []
-            groups = dff.groupby(category).mean()[response]
-
-            for val in dff[category]:
-                temp_cat_lst.append(groups.loc[val])
-
-            dff[f'{category}_Churn'] = temp_cat_lst
-            logging.info("SUCCESS: created encoded %s column.", category)
-        except KeyError as err:
-            logging.error("FAIL: %s is not a column in the DataFrame. \
-                    %(error)s", {"col": category, "error": err})
-            raise err
-        except Exception as err:
-            logging.error("FAIL: Could not create column. %s", err)
-            raise err
+    try:
+        if encoder is None:
+            logging.info("Fitting target encoder for %d columns",
+                         len(category_lst))
+            encoder = TargetEncoder(category_lst, response=response).fit(dff)
+            if encoder_pth is not None:
+                encoder.save(encoder_pth)
+        dff = encoder.transform(dff)
+        logging.info("SUCCESS: created encoded columns for %s",
+                     list(encoder.category_lst))
+    except KeyError as err:
+        logging.error("FAIL: %(col)s is not a column in the DataFrame. \
+                %(error)s", {"col": list(category_lst), "error": err})
+        raise err
+    except Exception as err:
+        logging.error("FAIL: Could not create column. %s", err)
+        raise err
     return dff
 
 
-def perform_feature_engineering(dff, response='churn'):
+def _feature_matrix(dff, response):
+    '''
+    returns the numeric features of dff as one C-contiguous float32 matrix,
+    their column names and the target as numpy array. Every column is
+    removed from dff once it is copied into the matrix, so its memory is
+    released as the matrix fills.
+    '''
+    target = dff.pop(response).to_numpy()
+    columns = [col for col, dtype in dff.dtypes.items()
+               if is_numeric_dtype(dtype)]
+    dff.drop(columns=[col for col in dff.columns if col not in columns],
+             inplace=True)
+    matrix = np.empty((len(dff), len(columns)), dtype=np.float32)
+    for pos, col in enumerate(columns):
+        matrix[:, pos] = dff.pop(col).to_numpy(dtype=np.float32)
+    logging.info('SUCCESS: Built a %(rows)d x %(cols)d float32 feature matrix \
+of %(mb).1f MB', {'rows': matrix.shape[0], 'cols': matrix.shape[1],
+                  'mb': matrix.nbytes / 1e6})
+    return matrix, columns, target
+
+
+def _split_low_memory(dff, response, test_size=0.3, random_state=42):
+    '''
+    returns the train and test features of dff as float32 frames, each
+    backed by one C-contiguous numpy matrix. The columns of dff are released
+    before the split, and the split takes rows by index instead of copying
+    frames.
+    '''
+    matrix, columns, target = _feature_matrix(dff, response)
+    train_idx, test_idx = train_test_split(np.arange(len(matrix)),
+                                           test_size=test_size,
+                                           random_state=random_state)
+    x_train, x_test = [
+        pd.DataFrame(matrix.take(idx, axis=0), columns=columns,
+                     index=dff.index[idx], copy=False)
+        for idx in (train_idx, test_idx)]
+    del matrix
+    y_train, y_test = [
+        pd.Series(target[idx], index=dff.index[idx], name=response)
+        for idx in (train_idx, test_idx)]
+    return x_train, x_test, y_train, y_test
+
+
+@profiled()
+def perform_feature_engineering(dff, response='churn', low_memory=True):
     '''
     input:
               df: pandas dataframe
               response: string of response name [optional argument that could
               be used for naming variables or index y column]
+              low_memory: build the features as float32 matrices and split
+              them by row index. The columns of df are released as they are
+              copied, so df is left without columns. False keeps the float64
+              frames of select_dtypes and leaves the features in df.
 
     output:
               X_train: X training data
@@ -193,21 +326,23 @@ def perform_feature_engineering(dff, response='churn'):
               y_train: y training data
               y_test: y testing data
     '''
-    category_lst = dff.select_dtypes(object).columns
+    category_lst = dff.select_dtypes(['object', 'category']).columns
 
     dff = encoder_helper(dff, category_lst, response=response)
 
     try:
         logging.info("Splitting DataFrame into Features and Target...")
-        target = dff.pop(response)
-        features = dff.select_dtypes(include=np.number)
-        logging.info('SUCCESS: Split dataframe into %d "X" features and "y" \
-target created.', len(features.columns))
-        logging.info("Splitting data into Train and Test sets")
-        x_train, x_test, y_train, y_test = train_test_split(features,
-                                                            target,
-                                                            test_size=0.3,
-                                                            random_state=42)
+        if low_memory:
+            x_train, x_test, y_train, y_test = _split_low_memory(dff,
+                                                                 response)
+        else:
+            target = dff.pop(response)
+            features = dff.select_dtypes(include=np.number)
+            logging.info('SUCCESS: Split dataframe into %d "X" features and \
+"y" target created.', len(features.columns))
+            logging.info("Splitting data into Train and Test sets")
+            x_train, x_test, y_train, y_test = train_test_split(
+                features, target, test_size=0.3, random_state=42)
         logging.info("SUCCESS: Data sets split into %(train_len)d training \
 rows and %(test_len)d test rows.",
                      {"train_len": len(x_train), "test_len": len(x_test)})
@@ -222,7 +357,8 @@ def classification_report_image(y_train,
                                 y_train_preds,
                                 y_test_preds,
                                 model_type,
-                                output_pth):
+                                output_pth,
+                                formats=('png',)):
     '''
     produces classification report for training and testing results and stores
     report as image in images folder
@@ -233,26 +369,38 @@ def classification_report_image(y_train,
             y_test_preds: test predictions
             model_type: String naming model type
             output_pth: path to store images of the classification report
+            formats: formats of the report, 'png' draws the image, 'json'
+            and 'html' write the report as text without drawing
 
     output:
              None
     '''
     try:
         logging.info('Starting classification report for %s', model_type)
-        plt.figure(figsize=(5, 5))
-        # plt.rc("figure", figsize=(5, 5))
-        plt.text(0.01, 1.25, str(model_type + " Test"),
-                 {'fontsize': 10},
-                 fontproperties='monospace')
-        plt.text(0.01, 0.05, str(classification_report(y_test, y_test_preds)),
-                 {'fontsize': 10}, fontproperties='monospace')
-        plt.text(0.01, 0.6, str(model_type + " Train"), {'fontsize': 10},
-                 fontproperties='monospace')
-        plt.text(0.01, 0.7, str(classification_report(y_train, y_train_preds)),
-                 {'fontsize': 10}, fontproperties='monospace')
-        plt.axis('off')
-        plt.savefig(output_pth + 'classification_report_' + model_type +
-                    '.png')
+        pth = output_pth + 'classification_report_' + model_type
+        text_formats = [fmt for fmt in formats if fmt in TEXT_FORMATS]
+        if text_formats:
+            reports = classification_reports(y_train, y_test, y_train_preds,
+                                             y_test_preds)
+            for fmt in text_formats:
+                write_text_report(reports, model_type, f'{pth}.{fmt}', fmt)
+        if 'png' in formats:
+            plt = pyplot()
+            with report_figure((5, 5)):
+                # plt.rc("figure", figsize=(5, 5))
+                plt.text(0.01, 1.25, str(model_type + " Test"),
+                         {'fontsize': 10},
+                         fontproperties='monospace')
+                plt.text(0.01, 0.05,
+                         str(classification_report(y_test, y_test_preds)),
+                         {'fontsize': 10}, fontproperties='monospace')
+                plt.text(0.01, 0.6, str(model_type + " Train"),
+                         {'fontsize': 10}, fontproperties='monospace')
+                plt.text(0.01, 0.7,
+                         str(classification_report(y_train, y_train_preds)),
+                         {'fontsize': 10}, fontproperties='monospace')
+                plt.axis('off')
+                plt.savefig(pth + '.png')
         logging.info("SUCCESS: Plot for type %(model)s saved to %(path)s",
                      {'model': model_type, 'path': output_pth})
     except Exception as err:
@@ -287,37 +435,59 @@ def feature_importance_plot(model, x_data, output_pth):
         names = [x_data.columns[i] for i in indices]
         logging.info("SUCCCSS: Gathered %d feature names to label plot.",
                      len(names))
-        # Create plot
-        plt.figure(figsize=(20, 5))
+        # Create plot, closed once it is saved
+        plt = pyplot()
+        with report_figure((20, 5)):
 
-        # Create plot title
-        plt.title("Feature Importance")
-        plt.ylabel('Importance')
+            # Create plot title
+            plt.title("Feature Importance")
+            plt.ylabel('Importance')
 
-        # Add bars
-        plt.bar(range(x_data.shape[1]), importances[indices])
+            # Add bars
+            plt.bar(range(x_data.shape[1]), importances[indices])
 
-        # Add feature names as x-axis labels
-        plt.xticks(range(x_data.shape[1]), names, rotation=90)
-        plt.savefig(output_pth)
+            # Add feature names as x-axis labels
+            plt.xticks(range(x_data.shape[1]), names, rotation=90)
+            plt.savefig(output_pth)
         logging.info("SUCCESS: Plot stored at %s", output_pth)
     except Exception as err:
         logging.error("FAIL: plot most important features: %s", err)
 
 
-def train_models(x_train, x_test, y_train, y_test):
+@profiled()
+def train_models(x_train, x_test, y_train, y_test, search_config=None,
+                 shap_config=None, pruning_config=None, distill_config=None,
+                 threshold_config=None):
     '''
-    train, store model results: images + scores, and store models
+    train, store model results: images + scores, and store models. The
+    training and reporting stages run as a task graph, so both models train
+    concurrently and the timing of each stage is logged.
     input:
               X_train: X training data
               X_test: X testing data
               y_train: y training data
               y_test: y testing data
+              search_config: dict of search settings passed to
+              churn_search.run_search, defaults to SEARCH_CONFIG
+              shap_config: dict of settings passed to
+              churn_explain.compute_shap_values, defaults to SHAP_CONFIG
+              pruning_config: dict of settings passed to
+              churn_pruning.prune_forest. The forest is retrained on its
+              most important features only when it is given; the pruned
+              forest is stored if its ROC AUC holds. Both forests are timed
+              after the task graph has finished.
+              distill_config: dict of settings passed to
+              churn_distill.distill_forest. Compact models are fitted on
+              the soft predictions of the forest only when it is given and
+              timed after the task graph has finished.
+              threshold_config: dict of settings passed to
+              churn_threshold.analyse_thresholds, defaults to
+              THRESHOLD_CONFIG
     output:
               None
     '''
-    # grid search
-    rfc = RandomForestClassifier(random_state=42)
+    # grid search, the out-of-bag probabilities choose the threshold
+    rfc = RandomForestClassifier(random_state=42, oob_score=True)
     # Use a different solver if the default 'lbfgs' fails to converge
     # Reference:
     # https://scikit-learn.org/stable/modules/linear_model.html#logistic-regression
@@ -331,96 +501,357 @@ def train_models(x_train, x_test, y_train, y_test):
         'criterion': ['gini', 'entropy']
     }
 
-    cv_rfc = GridSearchCV(estimator=rfc, param_grid=param_grid, cv=5)
-    cv_rfc.fit(x_train, y_train)
+    def fit_random_forest():
+        return run_search(rfc, param_grid, x_train, y_train,
+                          **(search_config or SEARCH_CONFIG))
+
+    def fit_logistic_regression():
+        return lrc.fit(x_train, y_train)
+
+    predictions = PredictionCache({'train': x_train, 'test': x_test})
+
+    def predict(model_name):
+        def predict_stage(model):
+            return predictions.predict_all(
+                model_name, getattr(model, 'best_estimator_', model))
+        return predict_stage
+
+    def report(model_type):
+        def report_stage(preds):
+            try:
+                with PLOT_LOCK:
+                    classification_report_image(y_train,
+                                                y_test,
+                                                preds['train'],
+                                                preds['test'],
+                                                model_type,
+                                                './images/results/',
+                                                formats=REPORT_FORMATS)
+            except Exception as err:
+                logging.error("FAIL: could not plot classification report: \
+%s", err)
+        return report_stage
+
+    def roc_curve(*_):
+        try:
+            with PLOT_LOCK, report_figure((15, 8)) as fig:
+                axis = fig.gca()
+                RocCurveDisplay.from_predictions(
+                    y_test, predictions.proba('Logistic_Regression', 'test'),
+                    name='LogisticRegression', ax=axis, alpha=0.8)
+                RocCurveDisplay.from_predictions(
+                    y_test, predictions.proba('Random_Forest', 'test'),
+                    name='RandomForestClassifier', ax=axis, alpha=0.8)
+                fig.savefig('./images/results/roc_curve_result.png')
+        except Exception as err:
+            logging.error("FAIL: could not plot Roc Auc report: %s", err)
+
+    def save_model(pth):
+        def save_stage(model):
+            try:
+                joblib.dump(getattr(model, 'best_estimator_', model), pth)
+            except Exception as err:
+                logging.error("Could not store model.pkl files: %s", err)
+                raise err
+        return save_stage
+
+    def thresholds(model_name, model_pths, chosen_on):
+        def threshold_stage(model, *_):
+            # chosen on out-of-bag or out-of-fold predictions of the
+            # training rows, so the test set only reports it
+            try:
+                config = {**THRESHOLD_CONFIG, **(threshold_config or {})}
+                analyse_thresholds(
+                    y_train, validation_proba(
+                        getattr(model, 'best_estimator_', model), x_train,
+                        y_train, config['cv'], config['n_jobs']),
+                    model_pths,
+                    f'./images/results/threshold_sweep_{model_name}.csv',
+                    config, chosen_on,
+                    (y_test, predictions.proba(model_name, 'test')))
+            except Exception as err:
+                logging.error("Could not choose a threshold: %s", err)
+                raise err
+        return threshold_stage
+
+    def export_rf(cv_rf):
+        try:
+            export_forest(cv_rf.best_estimator_, ARRAYS_DIR, COMPRESSED_PTH)
+        except Exception as err:
+            logging.error("Could not export forest artifacts: %s", err)
+            raise err
 
-    lrc.fit(x_train, y_train)
+    def shap_values(cv_rf):
+        try:
+            return compute_shap_values(cv_rf.best_estimator_, x_test, y_test,
+                                       **(shap_config or SHAP_CONFIG))
+        except Exception as err:
+            logging.error("Could not compute shap values: %s", err)
+            return None
 
-    y_train_preds_rf = cv_rfc.best_estimator_.predict(x_train)
-    y_test_preds_rf = cv_rfc.best_estimator_.predict(x_test)
+    def shap_plot(explained):
+        if explained is None:
+            return
+        try:
+            import shap  # pylint: disable=import-outside-toplevel
+            values = explained[0]
+            if getattr(values, 'ndim', 0) == 3:
+                # newer shap returns (rows, features, classes), which
+                # summary_plot would read as interaction values
+                values = [values[:, :, cls] for cls in range(values.shape[2])]
+            # summary_plot draws on a figure of its own
+            with PLOT_LOCK, closing_figures() as plt:
+                shap.summary_plot(values, explained[1], plot_type="bar",
+                                  show=False)
+                plt.savefig('./images/results/shap_values.png')
+        except Exception as err:
+            logging.error("Could not plot shap values: %s", err)
 
-    y_train_preds_lr = lrc.predict(x_train)
-    y_test_preds_lr = lrc.predict(x_test)
+    def importance_plot(cv_rf):
+        try:
+            with PLOT_LOCK:
+                feature_importance_plot(
+                    cv_rf, x_train, './images/results/feature_importances.png')
+        except Exception as err:
+            logging.error("Could not plot feature importance: %s", err)
 
-    try:
-        # scores
-        classification_report_image(y_train,
-                                    y_test,
-                                    y_train_preds_rf,
-                                    y_test_preds_rf,
-                                    'Random_Forest',
-                                    './images/results/')
-
-        classification_report_image(y_train,
-                                    y_test,
-                                    y_train_preds_lr,
-                                    y_test_preds_lr,
-                                    'Logistic_Regression',
-                                    './images/results/')
-    except Exception as err:
-        logging.error("FAIL: could not plot classification report: %s", err)
-    try:
-        # plots
-        plt.figure(figsize=(15, 8))
-        axis = plt.gca()
-        RocCurveDisplay.from_estimator(lrc,
-                                       x_test,
-                                       y_test,
-                                       ax=axis,
-                                       alpha=0.8)
-        RocCurveDisplay.from_estimator(cv_rfc,
-                                       x_test,
-                                       y_test,
-                                       ax=axis,
-                                       alpha=0.8)
-        plt.savefig('./images/results/roc_curve_result.png')
-    except Exception as err:
-        logging.error("FAIL: could not plot Roc Auc report: %s", err)
-    try:
-        # save best models
-        joblib.dump(cv_rfc.best_estimator_, './models/rfc_model.pkl')
-        joblib.dump(lrc, './models/logistic_model.pkl')
-    except Exception as err:
-        logging.error("Could not store model.pkl files: %s", err)
-        raise err
-    try:
-        explainer = shap.TreeExplainer(cv_rfc.best_estimator_)
-        shap_values = explainer.shap_values(x_test)
+    def prune_rf(cv_rf):
+        try:
+            pruned, pruning = prune_forest(cv_rf.best_estimator_, x_train,
+                                           y_train, x_test, y_test,
+                                           pruning_config, timed=False)
+            if pruning['accepted']:
+                joblib.dump(pruned, PRUNED_MODEL_PTH)
+                logging.info("SUCCESS: stored pruned forest at %s",
+                             PRUNED_MODEL_PTH)
+            return cv_rf.best_estimator_, pruned, pruning
+        except Exception as err:
+            logging.error("Could not prune the random forest: %s", err)
+            raise err
 
-        plt.figure(figsize=(15, 8))
-        axis = plt.gca()
-        shap.summary_plot(shap_values, x_test, plot_type="bar", show=False)
-        plt.savefig('./images/results/shap_values.png')
-    except Exception as err:
-        logging.error("Could not plot shap values: %s", err)
-    try:
-        feature_importance_plot(cv_rfc,
-                                x_train,
-                                './images/results/feature_importances.png')
-    except Exception as err:
-        logging.error("Could not plot feature importance: %s", err)
+    def time_pruned(model, pruned, pruning):
+        try:
+            time_pruning(model, pruned, x_test, pruning,
+                         {**PRUNING_CONFIG, **pruning_config}['repeat'])
+            write_pruning_report(pruning, PRUNING_REPORT_PTH)
+        except Exception as err:
+            logging.error("Could not time the pruned forest: %s", err)
+            raise err
 
+    def distill_rf(cv_rf):
+        try:
+            return (cv_rf.best_estimator_,
+                    *fit_students(cv_rf.best_estimator_, x_train, y_train,
+                                  x_test, y_test, distill_config))
+        except Exception as err:
+            logging.error("Could not distill the random forest: %s", err)
+            raise err
 
-def main(data_path, response):
+    def select_distilled(teacher, students, distilled):
+        try:
+            export_distilled(*select_student(teacher, students, distilled,
+                                             x_test, distill_config))
+        except Exception as err:
+            logging.error("Could not select a distilled model: %s", err)
+            raise err
+
+    # Both models train at the same time and every report starts as soon
+    # as the model it describes is ready.
+    tasks = {
+        'random_forest': (fit_random_forest, []),
+        'logistic_regression': (fit_logistic_regression, []),
+        'rf_predictions': (predict('Random_Forest'), ['random_forest']),
+        'lr_predictions': (predict('Logistic_Regression'),
+                           ['logistic_regression']),
+        'rf_report': (report('Random_Forest'), ['rf_predictions']),
+        'lr_report': (report('Logistic_Regression'), ['lr_predictions']),
+        'roc_curve': (roc_curve, ['lr_predictions', 'rf_predictions']),
+        'save_rf': (save_model('./models/rfc_model.pkl'), ['random_forest']),
+        'save_lr': (save_model('./models/logistic_model.pkl'),
+                    ['logistic_regression']),
+        'export_rf': (export_rf, ['random_forest']),
+        'rf_threshold': (thresholds('Random_Forest',
+                                    ['./models/rfc_model.pkl', ARRAYS_DIR,
+                                     COMPRESSED_PTH],
+                                    'out-of-bag training predictions'),
+                         ['random_forest', 'rf_predictions', 'save_rf',
+                          'export_rf']),
+        'lr_threshold': (thresholds('Logistic_Regression',
+                                    ['./models/logistic_model.pkl'],
+                                    'out-of-fold training predictions'),
+                         ['logistic_regression', 'lr_predictions',
+                          'save_lr']),
+        'shap_values': (shap_values, ['random_forest']),
+        'shap_plot': (shap_plot, ['shap_values']),
+        'feature_importance': (importance_plot, ['random_forest']),
+    }
+    if pruning_config is not None:
+        tasks['prune_rf'] = (prune_rf, ['random_forest'])
+    if distill_config is not None:
+        tasks['distill_rf'] = (distill_rf, ['random_forest'])
+    results, _ = run_task_graph(tasks)
+
+    # The latency comparisons run after the graph, so no other stage
+    # competes for the cores while the models are timed.
+    if pruning_config is not None:
+        time_pruned(*results['prune_rf'])
+    if distill_config is not None:
+        select_distilled(*results['distill_rf'])
+
+
+def retrain_incremental(data_path, response='churn',
+                        rf_pth='./models/rfc_model.pkl',
+                        lr_pth='./models/logistic_model.pkl',
+                        encoder_pth=ENCODER_PTH, params_pth=BEST_PARAMS_PTH,
+                        config=None, threshold_config=None):
+    '''
+    update the stored models with new customers instead of retraining. The
+    stored encoder is reused, the forest grows trees on the new rows with the
+    best params of the last search and the logistic model is updated with
+    partial_fit. An update is stored only if it does not lower the ROC AUC on
+    a holdout of the new rows, and its decision threshold is chosen again on
+    that holdout.
+
+    input:
+            data_path: csv of new customers in the format of bank_data.csv
+            response: name the classification target is given
+            rf_pth: stored random forest, replaced if its update is kept
+            lr_pth: stored logistic model, replaced if its update is kept
+            encoder_pth: target encoder stored during training
+            params_pth: best params stored by the last search
+            config: settings of churn_incremental.incremental_update
+            threshold_config: dict of settings passed to
+            churn_threshold.analyse_thresholds, defaults to
+            THRESHOLD_CONFIG
+    output:
+            results: dict of model name -> holdout scores and 'accepted'
+    '''
+    dff = import_data(data_path, response)
+    try:
+        encoder = TargetEncoder.load(encoder_pth)
+        forest = joblib.load(rf_pth)
+        logistic = joblib.load(lr_pth)
+    except FileNotFoundError as err:
+        logging.error("FAIL: Incremental retraining needs stored models, \
+run a full training first. %s", err)
+        raise err
+    dff = encoder_helper(dff, encoder.category_lst, response=response,
+                         encoder=encoder)
+    target = dff.pop(response)
+    features = dff[list(forest.feature_names_in_)]
+    results = incremental_update(features, target, forest, logistic,
+                                 params=load_best_params(params_pth),
+                                 config=config)
+    if results['random_forest']['accepted']:
+        export_forest(results['random_forest']['model'], ARRAYS_DIR,
+                      COMPRESSED_PTH)
+    for name, model_name, pths in (
+            ('random_forest', 'Random_Forest',
+             [rf_pth, ARRAYS_DIR, COMPRESSED_PTH]),
+            ('logistic_regression', 'Logistic_Regression', [lr_pth])):
+        if results[name]['accepted']:
+            joblib.dump(results[name]['model'], pths[0])
+            logging.info("SUCCESS: stored updated %(name)s at %(pth)s",
+                         {'name': name, 'pth': pths[0]})
+            # the stored threshold was chosen for the replaced model
+            analyse_thresholds(
+                results[name]['holdout_target'],
+                results[name]['holdout_proba'], pths,
+                f'./images/results/threshold_sweep_{model_name}.csv',
+                threshold_config, 'incremental update holdout')
+    return {name: {key: value for key, value in result.items()
+                   if key not in ('model', 'holdout_target', 'holdout_proba')}
+            for name, result in results.items()}
+
+
+def evaluate_stability(data_path, response='churn', config=None,
+                       params_pth=BEST_PARAMS_PTH):
+    '''
+    fit both models on repeated seeded train/test splits in parallel and
+    report the mean and spread of their test metrics
+
+    input:
+            data_path: csv of customers in the format of bank_data.csv
+            response: name the classification target is given
+            config: dict of settings, defaults to STABILITY_CONFIG
+            params_pth: best params of the last search, used by the forest
+            when they exist
+    output:
+            summary: pandas dataframe of mean, std, min and max per model
+            and metric
+    '''
+    config = {**STABILITY_CONFIG, **(config or {})}
+    dff = import_data(data_path, response)
+    category_lst = dff.select_dtypes(['object', 'category']).columns
+    # the encoder of the stored models is left as it is
+    dff = encoder_helper(dff, category_lst, response=response,
+                         encoder_pth=None)
+    matrix, _, target = _feature_matrix(dff, response)
+    forest, forest_params = STABILITY_MODELS['random_forest']
+    models = {**STABILITY_MODELS,
+              'random_forest': (forest, {**forest_params,
+                                         **load_best_params(params_pth)})}
+    runs, timing = run_stability(matrix, target, config['seeds'],
+                                 config['test_size'], config['n_jobs'],
+                                 models)
+    return write_stability_report(runs, timing)
+
+
+def main(data_path, response, incremental=False, prune=False,
+         distill=False, stability=0):
     """
     Main function to train model.
     Input
     ---
     data_path: str, the path to the csv data file
     response: str, the name the classification target should be given
+    incremental: bool, update the stored models with the rows of data_path
+    instead of running EDA and the full search
+    prune: bool, also retrain the forest on its most important features
+    and report the latency, size and metric deltas
+    distill: bool, also export a compact model fitted on the soft
+    predictions of the forest
+    stability: int, number of seeded splits to evaluate the models on
+    instead of training, 0 trains as usual
 
     Output
     ---
     "Complete" will be printed to the console after successfully
-    saving visuals and serialized models to the directory.
+    saving visuals and serialized models to the directory. The timing and
+    peak memory of each stage are written to ./logs/profiles/.
     """
-    dff = import_data(data_path, response)
-    perform_eda(dff)
-    x_train, x_test, y_train, y_test = perform_feature_engineering(dff,
-                                                                   response)
-    train_models(x_train, x_test, y_train, y_test)
+    PROFILER.start_run()
+    if stability:
+        evaluate_stability(data_path, response, {'seeds': stability})
+    elif incremental:
+        retrain_incremental(data_path, response)
+    else:
+        dff = import_data(data_path, response)
+        perform_eda(dff)
+        x_train, x_test, y_train, y_test = perform_feature_engineering(
+            dff, response)
+        train_models(x_train, x_test, y_train, y_test,
+                     pruning_config=PRUNING_CONFIG if prune else None,
+                     distill_config=DISTILL_CONFIG if distill else None)
+    PROFILER.write()
     return print("Complete")
 
 
 if __name__ == "__main__":
-    main(r"./data/bank_data.csv", 'churn')
+    PARSER = argparse.ArgumentParser(description="Train the churn models")
+    PARSER.add_argument('data_path', nargs='?',
+                        default=r"./data/bank_data.csv")
+    PARSER.add_argument('--incremental', action='store_true',
+                        help="update the stored models with new customers")
+    PARSER.add_argument('--prune', action='store_true',
+                        help="retrain the forest on its most important "
+                        "features and report the deltas")
+    PARSER.add_argument('--distill', action='store_true',
+                        help="export a compact model distilled from the "
+                        "forest")
+    PARSER.add_argument('--stability', type=int, default=0, metavar='SEEDS',
+                        help="report the spread of the metrics over SEEDS "
+                        "train/test splits instead of training")
+    ARGS = PARSER.parse_args()
+    main(ARGS.data_path, 'churn', incremental=ARGS.incremental,
+         prune=ARGS.prune, distill=ARGS.distill, stability=ARGS.stability)
@@ -0,0 +1,180 @@
+"""
+Asynchronous logging setup shared by the churn library and its tests.
+
+setup_logging replaces logging.basicConfig: the root logger gets a
+QueueHandler, and a QueueListener thread writes the queued records to the
+log file, so logging calls in loops only put a record on a queue and never
+wait for file I/O. The listener is stopped, and the queue drained, at exit.
+
+The verbosity can be set per module with levels, or with the
+CHURN_LOG_LEVELS environment variable, e.g.
+CHURN_LOG_LEVELS="churn_search=WARNING,churn_explain=DEBUG". The modules log
+through the root logger, so records are matched by the module they were
+logged from, then by logger name.
+
+Processes forked after setup_logging, such as pool workers, do not run the
+listener thread. They append to the log file directly instead, and the
+parent appends too after truncating the file once, so no process writes
+over the records of another.
+"""
+
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOG_LEVELS_ENV = 'CHURN_LOG_LEVELS'
+
+
+def _level(level):
+    '''
+    returns the number of a level given as number or name
+    '''
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError(f"Unknown log level {level}")
+    return number
+
+
+class ModuleLevelFilter(logging.Filter):
+    '''
+    Drops records below the level set for the module they were logged from.
+
+    attributes:
+            levels: dict of module or logger name -> level
+            default: level of modules without their own
+    '''
+
+    def __init__(self, levels=None, default=logging.INFO):
+        super().__init__()
+        self.levels = {name: _level(level)
+                       for name, level in (levels or {}).items()}
+        self.default = _level(default)
+
+    def filter(self, record):
+        level = self.levels.get(record.module,
+                                self.levels.get(record.name, self.default))
+        return record.levelno >= level
+
+
+def parse_levels(spec):
+    '''
+    returns dict of module -> level from "module=LEVEL,..." text
+    '''
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.partition('=')
+        levels[name.strip()] = _level(level.strip())
+    return levels
+
+
+def queue_logging(handlers, module_filter=None):
+    '''
+    returns a QueueHandler and a started QueueListener that hands its
+    records to handlers in a background thread
+
+    input:
+            handlers: list of handlers that do the writing
+            module_filter: filter applied before a record is queued
+    output:
+            handler: QueueHandler to add to a logger
+            listener: running QueueListener, stop it to drain the queue
+    '''
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    if module_filter is not None:
+        handler.addFilter(module_filter)
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    return handler, listener
+
+
+def _root_queue_handler():
+    '''
+    returns the QueueHandler setup_logging added to the root logger, or None
+    '''
+    return next((handler for handler in logging.getLogger().handlers
+                 if hasattr(handler, 'churn_listener')), None)
+
+
+def setup_logging(filename, level=logging.INFO, filemode='w', fmt=LOG_FORMAT,
+                  datefmt=DATE_FORMAT, levels=None, force=False):
+    '''
+    log to filename through a queue and a background writer thread. Like
+    logging.basicConfig, later calls keep the first setup unless force.
+
+    input:
+            filename: path of the log file
+            level: level of modules without their own
+            filemode: mode the log file is opened with
+            fmt: format of the records
+            datefmt: format of the record times
+            levels: dict of module -> level, updated with CHURN_LOG_LEVELS
+            force: replace an earlier setup
+    output:
+            listener: the QueueListener writing the file
+    '''
+    existing = _root_queue_handler()
+    if existing is not None:
+        if not force:
+            return existing.churn_listener
+        stop_logging()
+    levels = {**(levels or {}),
+              **parse_levels(os.environ.get(LOG_LEVELS_ENV, ''))}
+    module_filter = ModuleLevelFilter(levels, level)
+    if 'w' in filemode:
+        # truncate once and append from then on: a handler writing at its
+        # own offset would overwrite the records forked children append
+        with open(filename, 'w', encoding='utf-8'):
+            pass
+        filemode = filemode.replace('w', 'a')
+    file_handler = logging.FileHandler(filename, mode=filemode)
+    file_handler.setFormatter(logging.Formatter(fmt, datefmt))
+    handler, listener = queue_logging([file_handler], module_filter)
+    handler.churn_listener = listener
+    handler.churn_file_handler = file_handler
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(min([module_filter.default,
+                       *module_filter.levels.values()]))
+    return listener
+
+
+def stop_logging():
+    '''
+    write the queued records, stop the listener and close the log file
+    '''
+    handler = _root_queue_handler()
+    if handler is None:
+        return
+    logging.getLogger().removeHandler(handler)
+    handler.churn_listener.stop()
+    handler.churn_file_handler.close()
+
+
+def _log_directly_after_fork():
+    '''
+    in a forked child, replace the queue, which no thread reads there, with
+    the file handler appending to the same file
+    '''
+    handler = _root_queue_handler()
+    if handler is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(handler)
+    file_handler = logging.FileHandler(
+        handler.churn_file_handler.baseFilename, mode='a')
+    file_handler.setFormatter(handler.churn_file_handler.formatter)
+    for module_filter in handler.filters:
+        file_handler.addFilter(module_filter)
+    root.addHandler(file_handler)
+
+
+atexit.register(stop_logging)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_log_directly_after_fork)
@@ -0,0 +1,241 @@
+"""
+Per-stage timing and peak memory of the churn library.
+
+Functions decorated with profiled record their wall time, the CPU time of
+the process (all threads), the peak resident set size while they ran and
+the rows they processed per second. The records of one run are written by
+Profiler.write to a JSON file, one file per run, so stage timings can be
+compared between releases.
+
+On Linux the peak RSS is reset at the start of each stage through
+/proc/self/clear_refs, so it is the peak of that stage. The counter belongs
+to the whole process, so it is only reset when no stage runs in another
+thread. Stages that overlap with stages of other threads, as in the task
+graph of train_models, report the shared peak of the process instead
+(peak_rss_scope 'shared'). Where the counter cannot be reset the peak is
+that of the process so far (peak_rss_scope 'process').
+"""
+
+import functools
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PROFILE_DIR = './logs/profiles'
+
+
+def _reset_peak_rss():
+    '''
+    reset the kernel's peak RSS of this process, returns False if the
+    platform does not support it
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    '''
+    returns the peak resident set size of this process in MB, or None when
+    it cannot be read
+    '''
+    try:
+        with open('/proc/self/status', encoding='ascii') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1024
+
+
+def input_rows(args, result):
+    '''
+    returns the length of the first argument of a profiled call
+    '''
+    del result
+    return len(args[0]) if args and hasattr(args[0], '__len__') else None
+
+
+def output_rows(args, result):
+    '''
+    returns the length of the value returned by a profiled call
+    '''
+    del args
+    return len(result) if hasattr(result, '__len__') else None
+
+
+class Profiler:
+    '''
+    Collects the stage records of one run and writes them to JSON.
+
+    attributes:
+            records: list of dicts, one per finished stage
+            started: UTC time the run started, ISO formatted
+    '''
+
+    def __init__(self):
+        self.records = []
+        self.started = datetime.now(timezone.utc).isoformat()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # frames of the stages running in any thread, by id
+        self._running = {}
+
+    def start_run(self):
+        '''
+        drop the records of earlier runs and restart the run clock
+        '''
+        with self._lock:
+            self.records = []
+            self.started = datetime.now(timezone.utc).isoformat()
+
+    def _stack(self):
+        '''
+        returns the stages currently running in this thread, outermost first
+        '''
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def stage(self, name, rows=input_rows):
+        '''
+        returns a decorator recording each call of a function as stage name
+
+        input:
+                name: stage name stored in the record
+                rows: function of (args, result) returning the rows the call
+                processed, or None
+        output:
+                decorator: function decorator
+        '''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                stack = self._stack()
+                frame = {'name': name, 'child_peak': None, 'shared': False}
+                own = {id(entry) for entry in stack}
+                with self._lock:
+                    others = [entry for key, entry in self._running.items()
+                              if key not in own]
+                    for entry in others:
+                        entry['shared'] = True
+                    frame['shared'] = bool(others)
+                    self._running[id(frame)] = frame
+                    # resetting would clear the peaks of the other stages
+                    exact_peak = not others and _reset_peak_rss()
+                stack.append(frame)
+                wall = time.perf_counter()
+                cpu = time.process_time()
+                result, failed = None, True
+                try:
+                    result = func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    wall = time.perf_counter() - wall
+                    cpu = time.process_time() - cpu
+                    stack.pop()
+                    with self._lock:
+                        del self._running[id(frame)]
+                    peak = _peak_rss_mb()
+                    if peak is not None and frame['child_peak'] is not None:
+                        # a nested stage reset the kernel counter
+                        peak = max(peak, frame['child_peak'])
+                    if stack and peak is not None:
+                        parent = stack[-1]
+                        parent['child_peak'] = max(parent['child_peak'] or 0,
+                                                   peak)
+                    scope = 'shared' if frame['shared'] else \
+                        'stage' if exact_peak else 'process'
+                    self._record(name, wall, cpu, peak, scope,
+                                 None if failed else rows(args, result),
+                                 failed, [entry['name'] for entry in stack])
+            return wrapper
+        return decorator
+
+    def _record(self, name, wall, cpu, peak, scope, rows, failed, parents):
+        '''
+        store and log the measurements of one finished stage
+        '''
+        record = {
+            'stage': name,
+            'parent': parents[-1] if parents else None,
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'peak_rss_mb': None if peak is None else round(peak, 3),
+            'peak_rss_scope': scope,
+            'rows': rows,
+            'rows_per_sec': round(rows / wall, 3) if rows and wall else None,
+            'failed': failed,
+        }
+        with self._lock:
+            self.records.append(record)
+        logging.info("PROFILE: %(stage)s took %(wall_seconds).3fs wall, \
+%(cpu_seconds).3fs cpu, peak RSS %(peak_rss_mb)s MB, %(rows)s rows",
+                     record)
+
+    def summary(self):
+        '''
+        returns the run as a dict of run metadata and stage records
+        '''
+        with self._lock:
+            records = list(self.records)
+        return {
+            'started': self.started,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'stages': records,
+        }
+
+    def write(self, profile_dir=PROFILE_DIR):
+        '''
+        write the records of the run to
+        profile_dir/profile_<start>_<pid>.json, the start time in
+        microseconds
+
+        input:
+                profile_dir: directory of the profile files
+        output:
+                pth: path of the written file
+        '''
+        os.makedirs(profile_dir, exist_ok=True)
+        stamp = datetime.fromisoformat(self.started).strftime(
+            '%Y%m%dT%H%M%S%f')
+        pth = os.path.join(profile_dir, f'profile_{stamp}_{os.getpid()}.json')
+        with open(pth, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(), file, indent=2)
+        logging.info("SUCCESS: stored stage profile at %s", pth)
+        return pth
+
+
+# profiler of the churn library run
+PROFILER = Profiler()
+
+
+def profiled(name=None, rows=input_rows):
+    '''
+    decorator recording each call of a function as a stage of PROFILER,
+    named after the function unless name is given
+    '''
+    def decorator(func):
+        return PROFILER.stage(name or func.__name__, rows)(func)
+    return decorator
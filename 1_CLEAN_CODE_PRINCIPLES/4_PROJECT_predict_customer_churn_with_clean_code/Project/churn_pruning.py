@@ -0,0 +1,171 @@
+"""
+Importance-based feature pruning of the churn random forest.
+
+The features of the fitted forest are ranked by feature_importances_ and
+only the most important ones that together reach a share of the total
+importance are kept. A copy of the forest with the same parameters is
+retrained on these features and compared with the full forest on the test
+set: ROC AUC and F1, prediction latency and pickled size. The pruned forest
+is kept only when its ROC AUC drops by no more than max_metric_drop.
+Latency is timed by time_pruning, which train_models calls once its task
+graph has finished so no other stage competes for the cores.
+"""
+
+import json
+import logging
+import pickle
+import time
+import numpy as np
+from sklearn.base import clone
+from sklearn.metrics import f1_score, roc_auc_score
+
+PRUNED_MODEL_PTH = './models/rfc_model_pruned.pkl'
+PRUNING_REPORT_PTH = './images/results/pruning_report.json'
+
+# Settings of the pruning stage of train_models: share of the total
+# importance the kept features reach, largest accepted drop in test ROC AUC
+# and number of timed predict_proba calls per model.
+PRUNING_CONFIG = {
+    'threshold': 0.95,
+    'max_metric_drop': 0.005,
+    'repeat': 5,
+}
+
+
+def select_features(importances, names, threshold=0.95):
+    '''
+    returns the names of the most important features whose importances add
+    up to at least threshold of the total, most important first
+
+    input:
+            importances: feature_importances_ of a fitted model
+            names: feature names in the order of importances
+            threshold: share of the total importance to keep, in (0, 1]
+    output:
+            kept: list of feature names
+    '''
+    if not 0 < threshold <= 1:
+        raise ValueError(f"threshold must be in (0, 1], got {threshold}")
+    importances = np.asarray(importances, dtype=float)
+    order = np.argsort(importances)[::-1]
+    cumulative = np.cumsum(importances[order]) / importances.sum()
+    # first position where the running share reaches the threshold, the
+    # tolerance keeps float rounding from adding one more feature at 1.0
+    count = int(np.searchsorted(cumulative, threshold - 1e-12)) + 1
+    return [names[i] for i in order[:min(count, len(order))]]
+
+
+def model_size(model):
+    '''
+    returns the size of the pickled model in bytes
+    '''
+    return len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def predict_latency(model, x_data, repeat=5):
+    '''
+    returns the best of repeat timed predict_proba calls on x_data, in
+    seconds
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model.predict_proba(x_data)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _evaluate(model, x_test, y_test):
+    '''
+    returns dict of test metrics and size of a fitted model
+    '''
+    proba = model.predict_proba(x_test)[:, list(model.classes_).index(1)]
+    return {
+        'features': int(model.n_features_in_),
+        'roc_auc': float(roc_auc_score(y_test, proba)),
+        'f1': float(f1_score(y_test, model.predict(x_test))),
+        'size_bytes': model_size(model),
+    }
+
+
+def prune_forest(model, x_train, y_train, x_test, y_test, config=None,
+                 timed=True):
+    '''
+    retrain model on the features reaching the cumulative importance
+    threshold and compare it with model
+
+    input:
+            model: fitted forest with feature_importances_
+            x_train: pandas dataframe of the training features
+            y_train: training target
+            x_test: pandas dataframe of the test features
+            y_test: test target
+            config: dict of settings, defaults to PRUNING_CONFIG
+            timed: bool, also time both forests with time_pruning. Pass
+            False when other work runs at the same time and call
+            time_pruning once it is done.
+    output:
+            pruned: the retrained forest, fitted on the kept columns
+            report: dict with the kept and dropped features, the 'full' and
+            'pruned' evaluations, their 'deltas' and 'accepted'
+    '''
+    config = {**PRUNING_CONFIG, **(config or {})}
+    kept = select_features(model.feature_importances_, list(x_train.columns),
+                           config['threshold'])
+    pruned = clone(model).fit(x_train[kept], y_train)
+    full = _evaluate(model, x_test, y_test)
+    small = _evaluate(pruned, x_test[kept], y_test)
+    deltas = {name: small[name] - full[name] for name in full}
+    accepted = bool(-deltas['roc_auc'] <= config['max_metric_drop'])
+    report = {
+        'threshold': config['threshold'],
+        'kept': kept,
+        'dropped': [name for name in x_train.columns if name not in kept],
+        'full': full,
+        'pruned': small,
+        'deltas': deltas,
+        'accepted': accepted,
+    }
+    logging.info("%(result)s: pruned forest keeps %(kept)d of %(total)d \
+features, ROC AUC %(auc)+.4f, size %(size)+d bytes",
+                 {'result': 'KEEP' if accepted else 'REJECT',
+                  'kept': len(kept), 'total': x_train.shape[1],
+                  'auc': deltas['roc_auc'], 'size': deltas['size_bytes']})
+    if timed:
+        time_pruning(model, pruned, x_test, report, config['repeat'])
+    return pruned, report
+
+
+def time_pruning(model, pruned, x_test, report, repeat=5):
+    '''
+    add the predict_proba latency of the full and the pruned forest to the
+    report returned by prune_forest
+
+    input:
+            model: the full forest
+            pruned: the pruned forest returned by prune_forest
+            x_test: pandas dataframe of the test features
+            report: dict returned by prune_forest, updated in place
+            repeat: number of timed calls per forest
+    output:
+            report: the updated report
+    '''
+    report['full']['latency_ms'] = predict_latency(model, x_test,
+                                                   repeat) * 1000
+    report['pruned']['latency_ms'] = predict_latency(
+        pruned, x_test[report['kept']], repeat) * 1000
+    report['deltas']['latency_ms'] = (report['pruned']['latency_ms']
+                                      - report['full']['latency_ms'])
+    logging.info("SUCCESS: pruned forest latency %(pruned).2f ms vs \
+%(full).2f ms", {'pruned': report['pruned']['latency_ms'],
+                 'full': report['full']['latency_ms']})
+    return report
+
+
+def write_pruning_report(report, pth=PRUNING_REPORT_PTH):
+    '''
+    write the report returned by prune_forest to pth as JSON
+    '''
+    with open(pth, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    logging.info("SUCCESS: pruning report saved to %s", pth)
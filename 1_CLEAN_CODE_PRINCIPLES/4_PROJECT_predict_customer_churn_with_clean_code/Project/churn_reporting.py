@@ -0,0 +1,111 @@
+"""
+Figure lifecycle and text reports of the churn models.
+
+Every figure of the reports is opened with report_figure, which closes it as
+soon as it is saved, so pyplot does not keep one figure per report alive in
+long running processes. Classification reports can also be written as JSON
+or HTML straight from scikit-learn's output, without drawing a figure.
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import pandas as pd
+from sklearn.metrics import classification_report
+
+# formats train_models writes the classification reports in
+REPORT_FORMATS = ('png', 'json')
+TEXT_FORMATS = ('json', 'html')
+
+
+@functools.lru_cache(maxsize=None)
+def pyplot():
+    '''
+    returns matplotlib.pyplot with the seaborn style. The plotting stack is
+    imported on first use, so callers that only load models and score do not
+    pay for it.
+    '''
+    # pylint: disable=import-outside-toplevel
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set()
+    return plt
+
+
+@contextlib.contextmanager
+def report_figure(figsize):
+    '''
+    context manager yielding a new current pyplot figure that is closed on
+    exit, also when drawing or saving it fails
+
+    input:
+            figsize: (width, height) of the figure in inches
+    output:
+            fig: matplotlib Figure
+    '''
+    plt = pyplot()
+    fig = plt.figure(figsize=figsize)
+    try:
+        yield fig
+    finally:
+        plt.close(fig)
+
+
+@contextlib.contextmanager
+def closing_figures():
+    '''
+    context manager yielding pyplot that closes every figure opened inside
+    it on exit, for plotting functions that create their own figures
+    '''
+    plt = pyplot()
+    before = set(plt.get_fignums())
+    try:
+        yield plt
+    finally:
+        for number in set(plt.get_fignums()) - before:
+            plt.close(number)
+
+
+def classification_reports(y_train, y_test, y_train_preds, y_test_preds):
+    '''
+    returns dict of 'train' and 'test' -> classification_report as a dict
+    '''
+    return {
+        'train': classification_report(y_train, y_train_preds,
+                                       output_dict=True),
+        'test': classification_report(y_test, y_test_preds,
+                                      output_dict=True),
+    }
+
+
+def write_text_report(reports, model_type, pth, fmt='json'):
+    '''
+    write classification reports without drawing them
+
+    input:
+            reports: dict returned by classification_reports
+            model_type: name of the model shown in the report
+            pth: path of the written file
+            fmt: 'json' or 'html'
+    output:
+            None
+    '''
+    if fmt not in TEXT_FORMATS:
+        raise ValueError(f"Unknown report format {fmt}, use one of "
+                         f"{TEXT_FORMATS}")
+    with open(pth, 'w', encoding='utf-8') as file:
+        if fmt == 'json':
+            json.dump({'model': model_type, **reports}, file, indent=2)
+        else:
+            file.write(f"<html><body><h1>{model_type}</h1>\n")
+            for split, report in reports.items():
+                table = pd.DataFrame(
+                    {label: values for label, values in report.items()
+                     if isinstance(values, dict)}).T
+                file.write(f"<h2>{model_type} {split.title()}</h2>\n")
+                file.write(table.to_html(float_format='{:.4f}'.format))
+                file.write(f"\n<p>accuracy {report['accuracy']:.4f}</p>\n")
+            file.write("</body></html>\n")
+    logging.info("SUCCESS: %(fmt)s report for %(model)s saved to %(pth)s",
+                 {'fmt': fmt, 'model': model_type, 'pth': pth})
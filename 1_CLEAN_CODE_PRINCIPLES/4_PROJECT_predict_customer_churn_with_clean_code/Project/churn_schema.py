@@ -0,0 +1,83 @@
+"""
+Column schema of the bank customer data.
+
+read_csv wraps integers that do not fit the requested type (300 read as
+int8 becomes 44) and raises on a missing value. Only the categoricals are
+therefore typed while parsing. apply_schema casts the numbers afterwards,
+and keeps the inferred type of a column whose values do not fit.
+"""
+
+import logging
+import numpy as np
+from pandas.api.types import is_integer_dtype
+
+# Columns of the bank data with their storage type. Text columns are
+# categoricals and numbers use the smallest type that holds their range.
+DTYPES = {
+    'CLIENTNUM': 'uint32',
+    'Attrition_Flag': 'category',
+    'Customer_Age': 'int8',
+    'Gender': 'category',
+    'Dependent_count': 'int8',
+    'Education_Level': 'category',
+    'Marital_Status': 'category',
+    'Income_Category': 'category',
+    'Card_Category': 'category',
+    'Months_on_book': 'int16',
+    'Total_Relationship_Count': 'int8',
+    'Months_Inactive_12_mon': 'int8',
+    'Contacts_Count_12_mon': 'int8',
+    'Credit_Limit': 'float32',
+    'Total_Revolving_Bal': 'int32',
+    'Avg_Open_To_Buy': 'float32',
+    'Total_Amt_Chng_Q4_Q1': 'float32',
+    'Total_Trans_Amt': 'int32',
+    'Total_Trans_Ct': 'int16',
+    'Total_Ct_Chng_Q4_Q1': 'float32',
+    'Avg_Utilization_Ratio': 'float32',
+}
+
+
+def read_dtypes(columns):
+    '''
+    returns the dtypes to parse columns with: the categoricals of DTYPES
+    '''
+    return {col: dtype for col, dtype in DTYPES.items()
+            if col in columns and dtype == 'category'}
+
+
+def _fits(values, dtype):
+    '''
+    returns True if values can be cast to dtype without losing any value
+    '''
+    if not np.issubdtype(dtype, np.integer):
+        return True
+    if not is_integer_dtype(values.dtype):
+        return False
+    limits = np.iinfo(dtype)
+    return values.empty or (limits.min <= values.min() and
+                            values.max() <= limits.max)
+
+
+def apply_schema(dff):
+    '''
+    cast the numeric columns of dff to their DTYPES. A column with missing
+    or out of range values keeps its inferred type and is logged.
+
+    input:
+            dff: pandas dataframe read with read_dtypes
+    output:
+            dff: the same dataframe with the schema types
+    '''
+    for col, dtype in DTYPES.items():
+        if col not in dff.columns or dtype == 'category':
+            continue
+        dtype = np.dtype(dtype)
+        if dff[col].dtype == dtype:
+            continue
+        if _fits(dff[col], dtype):
+            dff[col] = dff[col].astype(dtype)
+        else:
+            logging.warning("Column %(col)s does not fit %(dtype)s, keeping \
+%(inferred)s", {'col': col, 'dtype': dtype, 'inferred': dff[col].dtype})
+    return dff
@@ -0,0 +1,247 @@
+"""
+Out-of-core batch scoring of new customers with the stored churn models.
+
+The input csv or parquet file is read in chunks so memory stays bounded by
+the chunk size, not the file size. Every chunk is encoded with the target
+encoder persisted during training and scored by the saved models in a
+process pool. The churn probability of each model is written to a parquet
+file keyed by CLIENTNUM, in the order of the input rows, and optionally
+upserted into the lookup store of churn_store. Models stored with a
+decision threshold by churn_threshold also get a 0/1 churn column.
+"""
+
+import argparse
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import joblib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from churn_artifacts import MappedForest
+from churn_encoding import ENCODER_PTH, TargetEncoder
+from churn_logging import setup_logging
+from churn_schema import apply_schema, read_dtypes
+from churn_store import ScoreStore
+from churn_threshold import load_threshold, threshold_path
+
+KEY_COLUMN = 'CLIENTNUM'
+# Models scored by default, name -> stored model. A directory is loaded as
+# the memory-mapped arrays written by churn_artifacts.export_forest.
+SCORING_MODELS = {
+    'random_forest': './models/rfc_model.pkl',
+    'logistic_regression': './models/logistic_model.pkl',
+}
+
+# encoder and models of a scoring process, set once by _init_worker
+_WORKER = {}
+
+
+def _load_model(pth):
+    '''
+    returns the model stored at pth, a MappedForest for an arrays directory
+    '''
+    if os.path.isdir(pth):
+        return MappedForest.load(pth, mmap_mode='r')
+    return joblib.load(pth)
+
+
+def _init_worker(encoder_pth, model_pths):
+    '''
+    load the encoder and models once in each scoring process
+    '''
+    _WORKER['encoder'] = TargetEncoder.load(encoder_pth)
+    _WORKER['models'] = {name: _load_model(pth)
+                         for name, pth in model_pths.items()}
+    _WORKER['thresholds'] = {name: load_threshold(pth)
+                             for name, pth in model_pths.items()}
+
+
+def _score_chunk(chunk):
+    '''
+    returns a dataframe of CLIENTNUM and the churn probability of every
+    model for one chunk of raw customer rows, and the churn label of every
+    model with a stored threshold
+    '''
+    features = _WORKER['encoder'].transform(chunk.copy())
+    scores = pd.DataFrame({KEY_COLUMN: chunk[KEY_COLUMN].to_numpy()})
+    for name, model in _WORKER['models'].items():
+        columns = list(model.feature_names_in_)
+        churn = list(model.classes_).index(1)
+        scores[f'{name}_proba'] = model.predict_proba(
+            features[columns])[:, churn]
+        threshold = _WORKER['thresholds'][name]
+        if threshold is not None:
+            scores[f'{name}_churn'] = (
+                scores[f'{name}_proba'] >= threshold).astype('int8')
+    return scores
+
+
+def iter_chunks(pth, chunksize=50000):
+    '''
+    yield the rows of a csv or parquet file as dataframes of chunksize rows
+
+    input:
+            pth: path of a .csv or .parquet file of customers
+            chunksize: rows per chunk
+    output:
+            chunks: iterator of pandas dataframes
+    '''
+    if str(pth).endswith(('.parquet', '.pq')):
+        parquet = pq.ParquetFile(pth)
+        columns = [col for col in parquet.schema_arrow.names
+                   if col != 'Unnamed: 0']
+        for batch in parquet.iter_batches(batch_size=chunksize,
+                                          columns=columns):
+            chunk = batch.to_pandas()
+            yield apply_schema(chunk.astype(read_dtypes(chunk.columns)))
+        return
+    columns = pd.read_csv(pth, nrows=0).columns
+    for chunk in pd.read_csv(pth,
+                             usecols=[col for col in columns
+                                      if col != 'Unnamed: 0'],
+                             dtype=read_dtypes(columns),
+                             chunksize=chunksize):
+        yield apply_schema(chunk)
+
+
+def output_schema(model_pths):
+    '''
+    returns the pyarrow schema of the scores of model_pths: CLIENTNUM as
+    int64, wide enough for any key a chunk is read with, the churn
+    probability of every model and the churn label of every model with a
+    stored threshold
+    '''
+    fields = [pa.field(KEY_COLUMN, pa.int64())]
+    for name, pth in model_pths.items():
+        fields.append(pa.field(f'{name}_proba', pa.float64()))
+        if load_threshold(pth) is not None:
+            fields.append(pa.field(f'{name}_churn', pa.int8()))
+    return pa.schema(fields)
+
+
+def score_file(input_pth, output_pth, encoder_pth=ENCODER_PTH,
+               model_pths=None, chunksize=50000, n_jobs=None,
+               store_pth=None):
+    '''
+    score every customer of input_pth and write the probabilities to a
+    parquet file keyed by CLIENTNUM. The file is written under a .partial
+    name and renamed once every chunk is scored, so a failed run leaves no
+    output behind. Every chunk is cast to output_schema, and an input
+    without rows gives an empty file with that schema.
+
+    input:
+            input_pth: csv or parquet file of customers to score
+            output_pth: parquet file the scores are written to
+            encoder_pth: target encoder stored during training
+            model_pths: dict of model name -> stored model, defaults to
+            SCORING_MODELS
+            chunksize: rows read and scored at a time
+            n_jobs: scoring processes, defaults to the cpu count
+            store_pth: SQLite score store the scores are also upserted
+            into, None skips it
+    output:
+            summary: dict with the rows scored, seconds and rows_per_sec
+    '''
+    model_pths = model_pths or SCORING_MODELS
+    n_jobs = n_jobs or os.cpu_count() or 1
+    for name, pth in model_pths.items():
+        if load_threshold(pth) is None:
+            logging.warning("No threshold stored for %(name)s at %(pth)s, \
+%(name)s_churn is not written", {'name': name,
+                                 'pth': threshold_path(pth)})
+    schema = output_schema(model_pths)
+    partial_pth = f"{output_pth}.partial"
+    completed = False
+    start = time.perf_counter()
+    rows = 0
+    writer = None
+    pool = None
+    store = None
+    try:
+        if store_pth is not None:
+            store = ScoreStore(store_pth)
+        writer = pq.ParquetWriter(partial_pth, schema)
+        if n_jobs == 1:
+            _init_worker(encoder_pth, model_pths)
+        else:
+            pool = ProcessPoolExecutor(max_workers=n_jobs,
+                                       initializer=_init_worker,
+                                       initargs=(encoder_pth, model_pths))
+        # at most two chunks per process are in flight, and results are
+        # written in input order as soon as the oldest chunk is scored
+        pending = deque()
+        chunks = iter_chunks(input_pth, chunksize)
+        while True:
+            for chunk in chunks:
+                if KEY_COLUMN not in chunk.columns:
+                    raise KeyError(f"{KEY_COLUMN} not a column in "
+                                   f"{input_pth}")
+                if chunk.empty:
+                    continue
+                if pool is None:
+                    pending.append(_score_chunk(chunk))
+                else:
+                    pending.append(pool.submit(_score_chunk, chunk))
+                if len(pending) >= 2 * n_jobs:
+                    break
+            if not pending:
+                break
+            scores = pending.popleft()
+            if pool is not None:
+                scores = scores.result()
+            writer.write_table(pa.Table.from_pandas(
+                scores, schema=schema, preserve_index=False))
+            if store is not None:
+                store.upsert(scores)
+            rows += len(scores)
+        completed = True
+    except (FileNotFoundError, KeyError) as err:
+        logging.error("FAIL: Could not score %(pth)s: %(err)s",
+                      {'pth': input_pth, 'err': err})
+        raise err
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if writer is not None:
+            writer.close()
+        if not completed and os.path.exists(partial_pth):
+            os.remove(partial_pth)
+        if store is not None:
+            store.close()
+    os.replace(partial_pth, output_pth)
+    if not rows:
+        logging.warning("No rows to score in %(pth)s, wrote an empty \
+%(output)s", {'pth': input_pth, 'output': output_pth})
+    seconds = time.perf_counter() - start
+    summary = {'rows': rows, 'seconds': seconds,
+               'rows_per_sec': rows / seconds if seconds else 0.0}
+    logging.info("SUCCESS: Scored %(rows)d rows in %(seconds).2fs \
+(%(rows_per_sec).0f rows/sec) to %(output)s", {**summary,
+                                               'output': output_pth})
+    return summary
+
+
+if __name__ == "__main__":
+    setup_logging("./logs/churn_scoring.log", filemode='a')
+    PARSER = argparse.ArgumentParser(
+        description="Score customers with the stored churn models")
+    PARSER.add_argument('input', help="csv or parquet file of customers")
+    PARSER.add_argument('output', help="parquet file of churn scores")
+    PARSER.add_argument('--encoder', default=ENCODER_PTH)
+    PARSER.add_argument('--rf', default=SCORING_MODELS['random_forest'],
+                        help="random forest pickle or arrays directory")
+    PARSER.add_argument('--lr', default=SCORING_MODELS['logistic_regression'])
+    PARSER.add_argument('--chunksize', type=int, default=50000)
+    PARSER.add_argument('--n-jobs', type=int, default=None)
+    PARSER.add_argument('--store', default=None,
+                        help="SQLite score store to upsert the scores into")
+    ARGS = PARSER.parse_args()
+    SUMMARY = score_file(ARGS.input, ARGS.output, ARGS.encoder,
+                         {'random_forest': ARGS.rf,
+                          'logistic_regression': ARGS.lr},
+                         ARGS.chunksize, ARGS.n_jobs, ARGS.store)
+    print(f"Scored {SUMMARY['rows']} rows in {SUMMARY['seconds']:.2f}s "
+          f"({SUMMARY['rows_per_sec']:.0f} rows/sec)")
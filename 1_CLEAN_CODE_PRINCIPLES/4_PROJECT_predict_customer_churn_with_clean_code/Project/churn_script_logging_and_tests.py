@@ -6,17 +6,60 @@ Date: November 2022
 """
 
 import os
+import shutil
+import json
 import logging
+import multiprocessing
+import threading
+import time
+from types import SimpleNamespace
+import joblib
 import pytest
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
 from pandas.api.types import is_numeric_dtype
+import matplotlib
+import matplotlib.pyplot as plt
 from Project.churn_library import import_data, perform_eda, encoder_helper
 from Project.churn_library import perform_feature_engineering, train_models
+from Project.churn_library import classification_report_image
+from Project.churn_library import feature_importance_plot
+# the profiler the library functions record into
+from Project.churn_library import PROFILER
+from Project.churn_library import evaluate_stability
+from Project.churn_profiling import Profiler
+from Project.churn_encoding import ENCODER_PTH, TargetEncoder
+from Project.churn_logging import (ModuleLevelFilter, parse_levels,
+                                   setup_logging)
+from Project import churn_eda
+from Project.churn_eda import render_eda
+from Project.churn_search import (build_search, evict_search_cache,
+                                  run_search, time_to_best)
+from Project.churn_tasks import critical_path, run_task_graph
+from Project.churn_explain import compute_shap_values, evict_shap_cache
+from Project.churn_evaluation import PredictionCache
+from Project.churn_artifacts import MappedForest, benchmark_load, export_forest
+from Project.churn_scoring import iter_chunks, score_file
+from Project.churn_stability import run_stability, summarize
+from Project.churn_store import ScoreStore
+from Project.churn_threshold import (analyse_thresholds, load_threshold,
+                                     threshold_metrics, threshold_path,
+                                     threshold_sweep, validation_proba)
+from Project.churn_incremental import (incremental_update,
+                                       to_incremental_logistic)
+from Project.churn_pruning import prune_forest, select_features, time_pruning
+from Project.churn_distill import distill_forest, soft_predictions
+from Project import churn_benchmark
+from Project.churn_benchmark import (SCORING_MODULES, compare_to_baseline,
+                                     import_time, logging_overhead,
+                                     run_benchmarks, synthetic_bank_data)
 
-logging.basicConfig(
-    filename='./logs/churn_library.log',
-    level=logging.INFO,
-    filemode='w',
-    format='%(name)s - %(levelname)s - %(message)s')
+setup_logging('./logs/churn_library.log',
+              level=logging.INFO,
+              filemode='w',
+              fmt='%(name)s - %(levelname)s - %(message)s')
 
 
 @pytest.fixture()
@@ -63,6 +106,67 @@ def test_import(path):
          doesn't appear to have rows and columns: %s", err)
 
 
+def test_import_cache(path, tmp_path):
+    '''
+    test import_data returns the same typed dataframe from its parquet cache
+    '''
+    dff_csv = import_data(path[0], path[1], cache_dir=tmp_path)
+    try:
+        assert len(list(tmp_path.glob('*.parquet'))) == 1
+    except AssertionError as err:
+        logging.error("FAIL import_data(): No cache file was written: %s",
+                      err)
+        raise err
+    dff_cache = import_data(path[0], path[1], cache_dir=tmp_path)
+    try:
+        assert dff_cache.equals(dff_csv)
+        assert (dff_cache.dtypes == dff_csv.dtypes).all()
+        assert dff_cache['Gender'].dtype == 'category'
+    except AssertionError as err:
+        logging.error("FAIL import_data(): The cached data differs from \
+            the csv: %s", err)
+        raise err
+    csv_pth = tmp_path / 'bank_data.csv'
+    shutil.copy(path[0], csv_pth)
+    before = import_data(csv_pth, path[1], cache_dir=tmp_path)
+    # same size and modification time, only the content changes
+    stat = os.stat(csv_pth)
+    with open(csv_pth, 'r+b') as file:
+        content = file.read()
+        flag = content.index(b'Existing Customer')
+        file.seek(flag)
+        file.write(b'Attrited Customer')
+    os.utime(csv_pth, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    after = import_data(csv_pth, path[1], cache_dir=tmp_path)
+    try:
+        assert after[path[1]].sum() == before[path[1]].sum() + 1
+        # one copy per csv, the stale copy of the rewritten csv is removed
+        assert len(list(tmp_path.glob('bank_data-*.parquet'))) == 2
+    except AssertionError as err:
+        logging.error("FAIL import_data(): The cache of the rewritten csv \
+            was not replaced: %s", err)
+        raise err
+
+
+def test_import_schema(path, tmp_path):
+    '''
+    test columns whose values do not fit their schema type keep their values
+    '''
+    raw = pd.read_csv(path[0], nrows=20)
+    raw.loc[0, 'Customer_Age'] = None
+    raw.loc[1, 'Dependent_count'] = 300
+    raw.to_csv(tmp_path / 'odd.csv', index=False)
+    dff_ = import_data(tmp_path / 'odd.csv', path[1], cache_dir=None)
+    try:
+        assert dff_['Customer_Age'].isna().sum() == 1
+        assert dff_['Dependent_count'].iloc[1] == 300
+        assert dff_['Months_on_book'].dtype == 'int16'
+    except AssertionError as err:
+        logging.error("FAIL import_data(): Values outside the schema \
+            types were changed: %s", err)
+        raise err
+
+
 def test_eda(dff):
     '''
     test perform eda function
@@ -118,13 +222,61 @@ def test_eda(dff):
         logging.error("FAIL perform_eda(): The heatmap image is empty %s", err)
 
 
+def _plot_churn_counts(data, output_pth):
+    '''
+    bar plot of the counts of the single column in data
+    '''
+    fig = plt.figure()
+    try:
+        data.iloc[:, 0].value_counts().plot(kind='bar', ax=fig.gca())
+        fig.savefig(output_pth)
+    finally:
+        plt.close(fig)
+
+
+def test_eda_skips_unchanged(dff, tmp_path, monkeypatch):
+    '''
+    test EDA views are only redrawn when their input columns change
+    '''
+    manifest = tmp_path / 'manifest.json'
+    first = render_eda(dff, tmp_path, manifest_pth=manifest, n_jobs=2)
+    second = render_eda(dff, tmp_path, manifest_pth=manifest, n_jobs=2)
+    dff['Customer_Age'] = dff['Customer_Age'] + 1
+    third = render_eda(dff, tmp_path, manifest_pth=manifest, n_jobs=2)
+    try:
+        assert len(first) == 5
+        assert not second
+        assert sorted(os.path.basename(pth) for pth in third) == \
+            ['customer_age_distribution.png', 'heatmap.png']
+    except AssertionError as err:
+        logging.error("FAIL render_eda(): Views were not skipped by input \
+            hash: %s", err)
+        raise err
+    backend = matplotlib.get_backend()
+    name, column, _, file_name = churn_eda.EDA_PLOTS[0]
+    monkeypatch.setattr(churn_eda, 'EDA_PLOTS',
+                        [(name, column, _plot_churn_counts, file_name),
+                         *churn_eda.EDA_PLOTS[1:]])
+    try:
+        matplotlib.use('svg')
+        fourth = render_eda(dff, tmp_path, manifest_pth=manifest, n_jobs=1)
+        assert matplotlib.get_backend() == 'svg'
+        assert [os.path.basename(pth) for pth in fourth] == [file_name]
+    except AssertionError as err:
+        logging.error("FAIL render_eda(): A changed plot function was not \
+            redrawn inline without switching the backend: %s", err)
+        raise err
+    finally:
+        matplotlib.use(backend)
+
+
 def test_encoder_helper(dff, path):
     '''
     test encoder helper
     '''
     logging.info("Starting encoder_helper test")
     logging.info("Building list of categorical variables")
-    category_lst = dff.select_dtypes(object).columns
+    category_lst = dff.select_dtypes(['object', 'category']).columns
     init_col_cnt = len(dff.columns)
     try:
         assert len(category_lst) > 0
@@ -147,6 +299,55 @@ def test_encoder_helper(dff, path):
             not floats: %s", err)
 
 
+def test_target_encoder(dff, path, tmp_path):
+    '''
+    test the persisted target encoder maps unseen categories to the prior
+    '''
+    category_lst = list(dff.select_dtypes(['object', 'category']).columns)
+    encoder = TargetEncoder(category_lst, response=path[1]).fit(dff)
+    encoder.save(tmp_path / 'encoder.pkl')
+    loaded = TargetEncoder.load(tmp_path / 'encoder.pkl')
+    scoring = dff.head(5).astype({category_lst[0]: object})
+    scoring.loc[scoring.index[0], category_lst[0]] = 'Unseen category'
+    scoring = loaded.transform(scoring)
+    try:
+        expected = dff.groupby(category_lst[0])[path[1]].mean()
+        assert scoring[f'{category_lst[0]}_Churn'].iloc[1] == \
+            expected[scoring[category_lst[0]].iloc[1]]
+    except AssertionError as err:
+        logging.error("FAIL TargetEncoder: Encoded rate does not match the \
+            category mean: %s", err)
+        raise err
+    try:
+        assert scoring[f'{category_lst[0]}_Churn'].iloc[0] == loaded.prior_
+    except AssertionError as err:
+        logging.error("FAIL TargetEncoder: Unseen category was not \
+            encoded with the prior: %s", err)
+        raise err
+
+
+def test_target_encoder_rates(dff, path):
+    '''
+    test the fitted rates match a groupby mean per column, for categorical
+    and object columns
+    '''
+    category_lst = list(dff.select_dtypes(['object', 'category']).columns)
+    for data in (dff, dff.astype({category: object
+                                  for category in category_lst})):
+        encoder = TargetEncoder(category_lst, response=path[1]).fit(data)
+        try:
+            for category in category_lst:
+                expected = data.groupby(category, observed=True)[
+                    path[1]].mean()
+                rates = encoder.rates_[category]
+                assert len(rates) == len(expected)
+                assert np.allclose(rates.reindex(expected.index), expected)
+        except AssertionError as err:
+            logging.error("FAIL TargetEncoder.fit(): Rates differ from the \
+groupby mean of %s: %s", category, err)
+            raise err
+
+
 def test_perform_feature_engineering(dff, path):
     '''
     test perform_feature_engineering
@@ -177,6 +378,889 @@ def test_perform_feature_engineering(dff, path):
             numeric: %s", err)
 
 
+def test_low_memory_features(dff, path):
+    '''
+    test the low memory features are float32 matrices with the same split
+    and values as the float64 frames
+    '''
+    frames = perform_feature_engineering(dff.copy(), path[1],
+                                         low_memory=False)
+    source = dff.copy()
+    matrices = perform_feature_engineering(source, path[1])
+    try:
+        assert len(source.columns) == 0
+        for x_data in matrices[:2]:
+            assert set(x_data.dtypes) == {np.dtype(np.float32)}
+            assert x_data.to_numpy().flags['C_CONTIGUOUS']
+        for frame, matrix in zip(frames, matrices):
+            assert frame.index.equals(matrix.index)
+            assert np.allclose(frame.to_numpy(dtype=np.float64),
+                               matrix.to_numpy(dtype=np.float64))
+        assert list(frames[0].columns) == list(matrices[0].columns)
+    except AssertionError as err:
+        logging.error("FAIL perform_feature_engineering(): Low memory \
+            features differ: %s", err)
+        raise err
+
+
+def test_budgeted_search(features, tmp_path):
+    '''
+    test a time budgeted random search stops early and persists cv_results_
+    '''
+    param_grid = {'n_estimators': [5, 10], 'max_depth': [2, 3, 4]}
+    search = run_search(RandomForestClassifier(random_state=42), param_grid,
+                        features[0], features[2],
+                        results_pth=tmp_path / 'cv_results.csv',
+                        params_pth=tmp_path / 'best_params.json',
+                        mode='random', n_iter=6, cv=3, time_budget=0)
+    try:
+        assert len(search.cv_results_['params']) == 1
+        assert search.best_estimator_.n_estimators == \
+            search.best_params_['n_estimators']
+    except AssertionError as err:
+        logging.error("FAIL run_search(): Time budget was not respected: %s",
+                      err)
+        raise err
+    try:
+        results = pd.read_csv(tmp_path / 'cv_results.csv')
+        assert 'mean_test_score' in results.columns
+        assert os.path.getsize(tmp_path / 'best_params.json') > 1
+    except (AssertionError, FileNotFoundError) as err:
+        logging.error("FAIL run_search(): Search results were not \
+            stored: %s", err)
+        raise err
+    grid = build_search(RandomForestClassifier(random_state=42), param_grid,
+                        cv=3, reuse_forests=False).fit(features[0],
+                                                       features[2])
+    per_candidate = (grid.cv_results_['mean_fit_time'] +
+                     grid.cv_results_['mean_score_time']) * 3
+    try:
+        assert time_to_best(search) == search.time_to_best_
+        assert time_to_best(grid) == pytest.approx(
+            per_candidate[:grid.best_index_ + 1].sum())
+    except AssertionError as err:
+        logging.error("FAIL time_to_best(): Time to the best candidate was \
+            not derived from cv_results_: %s", err)
+        raise err
+
+
+def test_search_cache(features, tmp_path, monkeypatch):
+    '''
+    test an identical search is loaded from the cache without fitting and
+    the cache is evicted by age and size
+    '''
+    param_grid = {'n_estimators': [5, 10], 'max_depth': [2, 4]}
+    cache_dir = tmp_path / 'search_cache'
+    search_type = type(build_search(
+        RandomForestClassifier(), param_grid))
+    fit = search_type.fit
+    fits = []
+
+    def counted_fit(self, *args, **kwargs):
+        fits.append(type(self).__name__)
+        return fit(self, *args, **kwargs)
+
+    monkeypatch.setattr(search_type, 'fit', counted_fit)
+
+    def search(x_train, **kwargs):
+        result = run_search(RandomForestClassifier(random_state=42),
+                            param_grid, x_train, features[2],
+                            results_pth=None, params_pth=None, cv=3,
+                            cache_dir=cache_dir, **kwargs)
+        return result, len(fits)
+
+    first, fit_count = search(features[0])
+    second, load_count = search(features[0], n_jobs=1)
+    changed, changed_count = search(features[0] * 2)
+    try:
+        assert len(os.listdir(cache_dir)) == 2
+        assert second.best_params_ == first.best_params_
+        assert np.array_equal(second.cv_results_['mean_test_score'],
+                              first.cv_results_['mean_test_score'])
+        assert (second.best_estimator_.predict(features[1]) ==
+                first.best_estimator_.predict(features[1])).all()
+        assert changed is not second
+        assert (fit_count, load_count, changed_count) == (1, 1, 2)
+    except AssertionError as err:
+        logging.error("FAIL run_search(): Cached search was not reused: %s",
+                      err)
+        raise err
+    entries = sorted(cache_dir.iterdir(), key=os.path.getmtime)
+    os.utime(entries[0], (0, 0))
+    try:
+        assert evict_search_cache(cache_dir, max_mb=None,
+                                  max_age_days=1) == [str(entries[0])]
+        assert evict_search_cache(cache_dir, max_mb=0,
+                                  max_age_days=None) == [str(entries[1])]
+    except AssertionError as err:
+        logging.error("FAIL evict_search_cache(): Unexpected evictions: %s",
+                      err)
+        raise err
+
+
+def test_nested_forest_search(features):
+    '''
+    test scoring n_estimators from forest prefixes matches a full grid search
+    '''
+    param_grid = {'n_estimators': [3, 8], 'max_depth': [2, 4]}
+    nested = build_search(RandomForestClassifier(random_state=42),
+                          param_grid, cv=3).fit(features[0], features[2])
+    full = build_search(RandomForestClassifier(random_state=42), param_grid,
+                        cv=3, reuse_forests=False).fit(features[0],
+                                                       features[2])
+    nested_scores = {tuple(sorted(params.items())): score for params, score
+                     in zip(nested.cv_results_['params'],
+                            nested.cv_results_['mean_test_score'])}
+    try:
+        assert type(nested).__name__ == 'NestedForestSearch'
+        for params, score in zip(full.cv_results_['params'],
+                                 full.cv_results_['mean_test_score']):
+            assert nested_scores[tuple(sorted(params.items()))] == \
+                pytest.approx(score)
+        assert nested.best_params_ == full.best_params_
+        repeated = build_search(RandomForestClassifier(random_state=42),
+                                {**param_grid, 'n_estimators': [8, 3, 8]},
+                                cv=3).fit(features[0], features[2])
+        assert repeated.cv_results_['params'] == nested.cv_results_['params']
+        assert np.array_equal(repeated.cv_results_['mean_test_score'],
+                              nested.cv_results_['mean_test_score'])
+    except AssertionError as err:
+        logging.error("FAIL NestedForestSearch: Prefix scores differ from \
+            GridSearchCV: %s", err)
+        raise err
+
+
+def test_task_graph():
+    '''
+    test independent stages overlap and dependents get their inputs
+    '''
+    tasks = {
+        'slow': (lambda: time.sleep(0.3) or 1, []),
+        'fast': (lambda: time.sleep(0.1) or 2, []),
+        'combine': (lambda slow, fast: slow + fast, ['slow', 'fast']),
+    }
+    results, timings = run_task_graph(tasks)
+    try:
+        assert results['combine'] == 3
+        assert timings['fast'][0] < timings['slow'][1]
+        assert critical_path(tasks, timings) == ['slow', 'combine']
+    except AssertionError as err:
+        logging.error("FAIL run_task_graph(): Stages did not run as a \
+            graph: %s", err)
+        raise err
+    with pytest.raises(ZeroDivisionError):
+        run_task_graph({'fail': (lambda: 1 / 0, []),
+                        'after': (lambda value: value, ['fail'])})
+
+
+def test_compute_shap_values(features, tmp_path):
+    '''
+    test SHAP values are bounded by max_rows, chunked and served from cache
+    '''
+    model = RandomForestClassifier(n_estimators=5, max_depth=3,
+                                   random_state=42).fit(features[0],
+                                                        features[2])
+    values, x_sample = compute_shap_values(model, features[1], features[3],
+                                           max_rows=60, n_jobs=2,
+                                           cache_dir=tmp_path)
+    try:
+        assert len(x_sample) == 60
+        assert len(values if not isinstance(values, list) else values[0]) \
+            == 60
+        assert len(list(tmp_path.glob('*.joblib'))) == 1
+    except AssertionError as err:
+        logging.error("FAIL compute_shap_values(): Sample was not bounded or \
+            cached: %s", err)
+        raise err
+    cached, cached_sample = compute_shap_values(model, features[1],
+                                                features[3], max_rows=60,
+                                                cache_dir=tmp_path)
+    try:
+        assert cached_sample.index.equals(x_sample.index)
+        assert np.array_equal(np.asarray(cached), np.asarray(values))
+    except AssertionError as err:
+        logging.error("FAIL compute_shap_values(): Cached values differ: %s",
+                      err)
+        raise err
+    compute_shap_values(model, features[1], features[3], max_rows=40,
+                        cache_dir=tmp_path)
+    entries = sorted(tmp_path.glob('*.joblib'), key=os.path.getmtime)
+    try:
+        assert len(entries) == 2
+        assert evict_shap_cache(tmp_path, max_mb=(
+            os.path.getsize(entries[1]) + 1) / 1e6) == [str(entries[0])]
+    except AssertionError as err:
+        logging.error("FAIL evict_shap_cache(): The least recently used \
+            values were not evicted: %s", err)
+        raise err
+
+
+def test_prediction_cache(features):
+    '''
+    test cached labels match predict and each model is scored only once
+    '''
+    models = {
+        'Random_Forest': RandomForestClassifier(
+            n_estimators=10, random_state=42).fit(features[0], features[2]),
+        'Logistic_Regression': LogisticRegression(max_iter=3000).fit(
+            features[0], features[2]),
+    }
+    cache = PredictionCache({'train': features[0], 'test': features[1]})
+    for name, model in models.items():
+        labels = cache.predict_all(name, model)
+        try:
+            assert (labels['test'] == model.predict(features[1])).all()
+            assert (labels['train'] == model.predict(features[0])).all()
+        except AssertionError as err:
+            logging.error("FAIL PredictionCache: %(model)s labels differ \
+                from predict: %(err)s", {'model': name, 'err': err})
+            raise err
+    proba = cache.proba('Random_Forest', 'test')
+    try:
+        # a cached pair must not touch the model again
+        assert np.array_equal(
+            cache.predict('Random_Forest', None, 'test')[1],
+            models['Random_Forest'].predict_proba(features[1]))
+        assert np.array_equal(proba, models['Random_Forest'].predict_proba(
+            features[1])[:, 1])
+    except AssertionError as err:
+        logging.error("FAIL PredictionCache: Cached probabilities differ: %s",
+                      err)
+        raise err
+
+
+def test_mapped_forest(features, tmp_path):
+    '''
+    test the memory-mapped forest predicts like the fitted forest
+    '''
+    forest = RandomForestClassifier(n_estimators=10,
+                                    random_state=42).fit(features[0],
+                                                         features[2])
+    joblib.dump(forest, tmp_path / 'rfc_model.pkl')
+    export_forest(forest, tmp_path / 'arrays', tmp_path / 'compressed.joblib')
+    mapped = MappedForest.load(tmp_path / 'arrays')
+    try:
+        assert isinstance(mapped.arrays['threshold'], np.memmap)
+        assert np.allclose(mapped.predict_proba(features[1]),
+                           forest.predict_proba(features[1]))
+        assert (mapped.predict(features[1]) ==
+                forest.predict(features[1])).all()
+    except AssertionError as err:
+        logging.error("FAIL MappedForest: Predictions differ from the \
+            forest: %s", err)
+        raise err
+    results = benchmark_load(tmp_path / 'rfc_model.pkl',
+                             tmp_path / 'compressed.joblib',
+                             tmp_path / 'arrays', repeat=1)
+    try:
+        assert set(results) == {'pickle', 'compressed', 'mmap'}
+        assert results['compressed']['megabytes'] < \
+            results['pickle']['megabytes']
+    except AssertionError as err:
+        logging.error("FAIL benchmark_load(): Missing artifacts: %s", err)
+        raise err
+
+
+def test_score_file(dff, path, tmp_path):
+    '''
+    test chunked batch scoring matches scoring the whole file at once
+    '''
+    raw = pd.read_csv(path[0], nrows=500)
+    raw.to_csv(tmp_path / 'customers.csv', index=False)
+    raw.to_parquet(tmp_path / 'customers.parquet')
+    category_lst = list(dff.select_dtypes(['object', 'category']).columns)
+    encoder = TargetEncoder(category_lst, path[1]).fit(dff)
+    encoder.save(tmp_path / 'encoder.pkl')
+    x_data = encoder.transform(dff.copy()).select_dtypes(
+        include=np.number).drop(columns=path[1])
+    forest = RandomForestClassifier(n_estimators=10, random_state=42).fit(
+        x_data, dff[path[1]])
+    export_forest(forest, tmp_path / 'arrays')
+    model_pths = {'random_forest': tmp_path / 'arrays'}
+    expected = forest.predict_proba(
+        encoder.transform(dff.head(500).copy())[x_data.columns])[:, 1]
+    for source, n_jobs in (('customers.csv', 2), ('customers.parquet', 1)):
+        summary = score_file(tmp_path / source, tmp_path / 'scores.parquet',
+                             tmp_path / 'encoder.pkl', model_pths,
+                             chunksize=128, n_jobs=n_jobs,
+                             store_pth=tmp_path / 'scores.sqlite')
+        scores = pd.read_parquet(tmp_path / 'scores.parquet')
+        with ScoreStore(tmp_path / 'scores.sqlite') as store:
+            stored = store.lookup_many(raw['CLIENTNUM'])
+            size = len(store)
+        try:
+            assert summary['rows'] == 500
+            assert summary['rows_per_sec'] > 0
+            assert (scores['CLIENTNUM'].to_numpy() ==
+                    raw['CLIENTNUM'].to_numpy()).all()
+            assert np.allclose(scores['random_forest_proba'], expected)
+            assert size == 500
+            assert np.allclose(stored['random_forest_proba'], expected)
+        except AssertionError as err:
+            logging.error("FAIL score_file(): Scores of %(source)s differ \
+                from the model: %(err)s", {'source': source, 'err': err})
+            raise err
+    try:
+        assert next(iter_chunks(tmp_path / 'customers.parquet')).dtypes \
+            .equals(next(iter_chunks(tmp_path / 'customers.csv')).dtypes)
+    except AssertionError as err:
+        logging.error("FAIL iter_chunks(): Parquet chunks are not read \
+with the schema: %s", err)
+        raise err
+    # keys past uint32 in later chunks only, and a file without rows
+    wide = raw.assign(CLIENTNUM=raw['CLIENTNUM'] + np.where(
+        raw.index >= 400, 2**32, 0))
+    wide.to_csv(tmp_path / 'wide.csv', index=False)
+    raw.head(0).to_csv(tmp_path / 'empty.csv', index=False)
+    score_file(tmp_path / 'wide.csv', tmp_path / 'wide.parquet',
+               tmp_path / 'encoder.pkl', model_pths, chunksize=128,
+               n_jobs=1)
+    score_file(tmp_path / 'empty.csv', tmp_path / 'empty.parquet',
+               tmp_path / 'encoder.pkl', model_pths, n_jobs=1)
+    try:
+        assert (pd.read_parquet(tmp_path / 'wide.parquet')['CLIENTNUM']
+                .to_numpy() == wide['CLIENTNUM'].to_numpy()).all()
+        empty = pd.read_parquet(tmp_path / 'empty.parquet')
+        assert empty.empty
+        assert list(empty.columns) == list(scores.columns)
+    except AssertionError as err:
+        logging.error("FAIL score_file(): Keys or empty output not written \
+with the output schema: %s", err)
+        raise err
+    raw.loc[300, 'Customer_Age'] = 'unknown'
+    raw.to_csv(tmp_path / 'broken.csv', index=False)
+    with pytest.raises(ValueError):
+        score_file(tmp_path / 'broken.csv', tmp_path / 'broken.parquet',
+                   tmp_path / 'encoder.pkl', model_pths, chunksize=128,
+                   n_jobs=1)
+    try:
+        assert not os.path.exists(tmp_path / 'broken.parquet')
+        assert not os.path.exists(tmp_path / 'broken.parquet.partial')
+    except AssertionError as err:
+        logging.error("FAIL score_file(): A failed run left output \
+            behind: %s", err)
+        raise err
+
+
+def test_score_store(tmp_path):
+    '''
+    test the score store answers point and bulk lookups and upserts new
+    scores in place
+    '''
+    first = pd.DataFrame({'CLIENTNUM': np.arange(1000, 3000, dtype='uint32'),
+                          'random_forest_proba': np.linspace(0, 1, 2000)})
+    second = pd.DataFrame({'CLIENTNUM': [1000, 5000],
+                           'random_forest_proba': [0.5, 0.25],
+                           'logistic_regression_proba': [0.4, 0.75]})
+    second.to_parquet(tmp_path / 'new_scores.parquet')
+    with ScoreStore(tmp_path / 'scores.sqlite') as store:
+        store.upsert(first)
+        point = store.lookup(2999)
+        plan = ' '.join(row[-1] for row in store.connection.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM scores WHERE CLIENTNUM = ?',
+            (2999,)))
+        store.refresh(tmp_path / 'new_scores.parquet')
+        bulk = store.lookup_many([5000, 1000, 7, 1001])
+        size = len(store)
+    try:
+        assert point['random_forest_proba'] == 1.0
+        # a point lookup seeks the primary key instead of scanning
+        assert 'INTEGER PRIMARY KEY' in plan
+        assert size == 2001
+        assert list(bulk.index) == [5000, 1000, 7, 1001]
+        assert bulk.loc[1000, 'random_forest_proba'] == 0.5
+        assert bulk.loc[5000, 'logistic_regression_proba'] == 0.75
+        assert np.isnan(bulk.loc[7, 'random_forest_proba'])
+        assert np.isnan(bulk.loc[1001, 'logistic_regression_proba'])
+        assert bulk.loc[1001, 'random_forest_proba'] == \
+            first['random_forest_proba'][1]
+    except AssertionError as err:
+        logging.error("FAIL ScoreStore(): Unexpected stored scores: %s", err)
+        raise err
+
+
+def test_threshold_sweep(tmp_path):
+    '''
+    test the sorted sweep matches counting each threshold separately and
+    the chosen threshold is stored next to the model
+    '''
+    rng = np.random.default_rng(0)
+    y_true = rng.integers(0, 2, 500)
+    # rounded so that many customers share a probability
+    proba = np.round(np.clip(y_true * 0.3 + rng.random(500) * 0.7, 0, 1), 2)
+    sweep = threshold_sweep(y_true, proba, offer_cost=1.0, churn_cost=10.0)
+    try:
+        assert len(sweep) == len(np.unique(proba)) + 1
+        assert sweep['threshold'].is_monotonic_decreasing
+        for row in sweep.itertuples():
+            flagged = proba >= row.threshold
+            true_pos = int(np.sum(flagged & (y_true == 1)))
+            false_neg = int(np.sum(~flagged & (y_true == 1)))
+            assert (row.tp, row.fp, row.fn) == \
+                (true_pos, int(flagged.sum()) - true_pos, false_neg)
+            assert row.cost == flagged.sum() * 1.0 + false_neg * 10.0
+    except AssertionError as err:
+        logging.error("FAIL threshold_sweep(): Sweep differs from counting \
+            each threshold %s", err)
+        raise err
+    for labels, probabilities in (([], []), (y_true, proba[:-1])):
+        with pytest.raises(ValueError):
+            threshold_sweep(labels, probabilities)
+    model_pth = tmp_path / 'model.pkl'
+    test = (y_true[:200], proba[:200])
+    chosen = analyse_thresholds(y_true, proba,
+                                [model_pth, tmp_path / 'model_arrays'],
+                                tmp_path / 'sweep.csv', {'objective': 'f1'},
+                                test=test)
+    try:
+        assert chosen['f1'] == sweep['f1'].max()
+        assert threshold_metrics(y_true, proba, chosen['threshold'], 50.0,
+                                 500.0) == chosen
+        assert load_threshold(model_pth) == chosen['threshold']
+        assert load_threshold(tmp_path / 'model_arrays') == \
+            chosen['threshold']
+        assert load_threshold(tmp_path / 'other.pkl') is None
+        assert len(pd.read_csv(tmp_path / 'sweep.csv')) == len(sweep)
+        with open(threshold_path(model_pth), encoding='utf-8') as file:
+            stored = json.load(file)
+        assert stored['chosen_on'] == 'validation'
+        assert stored['test_metrics'] == threshold_metrics(
+            *test, chosen['threshold'], 50.0, 500.0)
+    except AssertionError as err:
+        logging.error("FAIL analyse_thresholds(): Threshold not stored: %s",
+                      err)
+        raise err
+
+
+def test_validation_proba(features, monkeypatch):
+    '''
+    test a forest fitted with oob_score gives its out-of-bag probabilities
+    without fitting again, and other models are scored out of fold
+    '''
+    x_train, _, y_train, _ = features
+    forest = RandomForestClassifier(n_estimators=30, oob_score=True,
+                                    random_state=42).fit(x_train, y_train)
+    logistic = LogisticRegression(max_iter=3000).fit(x_train, y_train)
+    logistic_proba = validation_proba(logistic, x_train, y_train, cv=3)
+    fits = []
+    fit = RandomForestClassifier.fit
+    monkeypatch.setattr(RandomForestClassifier, 'fit',
+                        lambda *args, **kwargs: fits.append(1) or
+                        fit(*args, **kwargs))
+    forest_proba = validation_proba(forest, x_train, y_train, cv=3)
+    try:
+        assert not fits
+        assert np.array_equal(forest_proba,
+                              forest.oob_decision_function_[:, 1])
+        assert len(logistic_proba) == len(x_train)
+        assert not np.allclose(logistic_proba,
+                               logistic.predict_proba(x_train)[:, 1])
+    except AssertionError as err:
+        logging.error("FAIL validation_proba(): Unexpected validation \
+            probabilities: %s", err)
+        raise err
+
+
+def test_incremental_update(features):
+    '''
+    test the incremental update grows the forest and starts the logistic
+    model from the trained coefficients
+    '''
+    x_train, x_test, y_train, y_test = features
+    forest = RandomForestClassifier(n_estimators=10, random_state=42).fit(
+        x_train, y_train)
+    logistic = LogisticRegression(max_iter=3000).fit(x_train, y_train)
+    try:
+        assert np.allclose(
+            to_incremental_logistic(logistic, x_test).predict_proba(x_test),
+            logistic.predict_proba(x_test))
+    except AssertionError as err:
+        logging.error("FAIL to_incremental_logistic(): Converted model \
+            predicts differently: %s", err)
+        raise err
+    results = incremental_update(x_test, y_test, forest, logistic,
+                                 params={'max_depth': 5},
+                                 config={'new_trees': 5, 'epochs': 2})
+    try:
+        assert len(forest.estimators_) == 10
+        assert set(results) == {'random_forest', 'logistic_regression'}
+        for result in results.values():
+            assert result['accepted'] == \
+                (result['new_score'] >= result['old_score'])
+            assert 0 < len(result['holdout_proba']) == \
+                len(result['holdout_target']) < len(x_test)
+        updated = to_incremental_logistic(
+            results['logistic_regression']['model'], x_test)
+        assert hasattr(updated.named_steps['sgd'], 'coef_')
+        if results['random_forest']['accepted']:
+            assert len(results['random_forest']['model'].estimators_) == 15
+            assert results['random_forest']['model'].estimators_[-1] \
+                .max_depth == 5
+    except AssertionError as err:
+        logging.error("FAIL incremental_update(): Unexpected update: %s",
+                      err)
+        raise err
+
+
+def test_feature_pruning(features):
+    '''
+    test pruning keeps the features reaching the importance threshold and
+    reports the deltas of the retrained forest
+    '''
+    x_train, x_test, y_train, y_test = features
+    try:
+        assert select_features([0.1, 0.6, 0.3], ['a', 'b', 'c'], 0.9) == \
+            ['b', 'c']
+        assert select_features([0.1, 0.6, 0.3], ['a', 'b', 'c'], 1.0) == \
+            ['b', 'c', 'a']
+    except AssertionError as err:
+        logging.error("FAIL select_features(): Wrong features kept: %s", err)
+        raise err
+    forest = RandomForestClassifier(n_estimators=20, random_state=42).fit(
+        x_train, y_train)
+    pruned, report = prune_forest(forest, x_train, y_train, x_test, y_test,
+                                  {'threshold': 0.8, 'repeat': 1})
+    try:
+        assert list(pruned.feature_names_in_) == report['kept']
+        assert 0 < len(report['kept']) < x_train.shape[1]
+        assert set(report['kept']) | set(report['dropped']) == \
+            set(x_train.columns)
+        assert report['pruned']['features'] == len(report['kept'])
+        assert report['deltas']['size_bytes'] == \
+            report['pruned']['size_bytes'] - report['full']['size_bytes']
+        assert report['accepted'] == \
+            (report['deltas']['roc_auc'] >= -0.005)
+    except AssertionError as err:
+        logging.error("FAIL prune_forest(): Unexpected pruning report: %s",
+                      err)
+        raise err
+    pruned, report = prune_forest(forest, x_train, y_train, x_test, y_test,
+                                  {'threshold': 0.8}, timed=False)
+    try:
+        assert 'latency_ms' not in report['deltas']
+        time_pruning(forest, pruned, x_test, report, repeat=1)
+        assert report['deltas']['latency_ms'] == \
+            report['pruned']['latency_ms'] - report['full']['latency_ms']
+    except AssertionError as err:
+        logging.error("FAIL time_pruning(): Latency not added to the \
+report: %s", err)
+        raise err
+
+
+def test_distill_forest(features):
+    '''
+    test the distilled students are scored like the forest and the selected
+    one is the fastest within the ROC AUC tolerance
+    '''
+    x_train, x_test, y_train, y_test = features
+    forest = RandomForestClassifier(n_estimators=50, random_state=42).fit(
+        x_train, y_train)
+    model, report = distill_forest(forest, x_train, y_train, x_test,
+                                   y_test, {'max_auc_drop': 1.0, 'repeat': 1,
+                                            'teacher_cv': 3})
+    soft = soft_predictions(forest, x_train, y_train, cv=3)
+    try:
+        assert soft.shape == (len(x_train),)
+        # rows scored by forests fitted without them, not memorised ones
+        assert np.abs(soft - forest.predict_proba(x_train)[:, 1]).mean() > \
+            0.01
+    except AssertionError as err:
+        logging.error("FAIL soft_predictions(): Not out-of-fold: %s", err)
+        raise err
+    try:
+        assert set(report['students']) == {'shallow_tree', 'small_forest'}
+        assert report['selected'] == min(
+            report['students'],
+            key=lambda name: report['students'][name]['row_latency_ms'])
+        proba = model.predict_proba(x_test)
+        assert proba.shape == (len(x_test), 2)
+        assert np.allclose(proba.sum(axis=1), 1.0)
+        assert list(model.feature_names_in_) == list(x_train.columns)
+        for evaluation in report['students'].values():
+            assert evaluation['size_bytes'] < \
+                report['teacher']['size_bytes']
+            assert 0.5 < evaluation['agreement'] <= 1.0
+    except AssertionError as err:
+        logging.error("FAIL distill_forest(): Unexpected distilled model: \
+%s", err)
+        raise err
+    try:
+        model, report = distill_forest(forest, x_train, y_train, x_test,
+                                       y_test, {'max_auc_drop': -1.0,
+                                                'repeat': 1, 'teacher_cv': 3})
+        assert model is None and report['selected'] is None
+    except AssertionError as err:
+        logging.error("FAIL distill_forest(): Exported a model below the \
+            ROC AUC tolerance %s", err)
+        raise err
+
+
+def test_stability(features):
+    '''
+    test the seeded splits score the same in the process pool as in one
+    process and the summary spans every seed
+    '''
+    x_data = np.concatenate([features[0], features[1]])
+    target = np.concatenate([features[2], features[3]])
+    models = {'random_forest': (RandomForestClassifier, {'n_estimators': 10}),
+              'logistic_regression': (LogisticRegression, {'max_iter': 3000})}
+    runs, timing = run_stability(x_data, target, seeds=3, n_jobs=2,
+                                 models=models)
+    serial, _ = run_stability(x_data, target, seeds=3, n_jobs=1,
+                              models=models)
+    summary = summarize(runs)
+    try:
+        assert timing['n_jobs'] == 2 and timing['speedup'] > 0
+        assert len(runs) == 6
+        assert np.allclose(runs['roc_auc'], serial['roc_auc'])
+        assert runs.groupby('model')['roc_auc'].nunique().min() > 1
+        assert set(summary['model']) == set(models)
+        assert (summary['min'] <= summary['mean']).all()
+        assert (summary['mean'] <= summary['max']).all()
+        assert (summary['std'] > 0).any()
+    except AssertionError as err:
+        logging.error("FAIL run_stability(): Unexpected stability runs: %s",
+                      err)
+        raise err
+
+
+def test_evaluate_stability_keeps_encoder(path, tmp_path):
+    '''
+    test the stability evaluation does not replace the stored encoder
+    '''
+    def encoder_mtime():
+        return os.stat(ENCODER_PTH).st_mtime_ns \
+            if os.path.exists(ENCODER_PTH) else None
+
+    before = encoder_mtime()
+    summary = evaluate_stability(path[0], path[1],
+                                 config={'seeds': 2, 'n_jobs': 1},
+                                 params_pth=tmp_path / 'best_params.json')
+    try:
+        assert set(summary['model']) == {'random_forest',
+                                         'logistic_regression'}
+        assert encoder_mtime() == before
+    except AssertionError as err:
+        logging.error("FAIL evaluate_stability(): Stored encoder was \
+replaced: %s", err)
+        raise err
+
+
+def test_profiler(path, tmp_path):
+    '''
+    test the library stages are profiled and written to a JSON file
+    '''
+    PROFILER.start_run()
+    dff_ = import_data(path[0], path[1])
+    perform_feature_engineering(dff_, path[1])
+    pth = PROFILER.write(tmp_path)
+    with open(pth, encoding='utf-8') as file:
+        profile = json.load(file)
+    stages = {record['stage']: record for record in profile['stages']}
+    try:
+        assert {'import_data', 'encoder_helper',
+                'perform_feature_engineering'} <= set(stages)
+        assert stages['import_data']['rows'] == len(dff_)
+        assert stages['encoder_helper']['parent'] == \
+            'perform_feature_engineering'
+        for record in stages.values():
+            assert record['wall_seconds'] > 0
+            assert record['cpu_seconds'] >= 0
+            assert record['peak_rss_mb'] > 0
+            assert record['rows_per_sec'] > 0
+    except AssertionError as err:
+        logging.error("FAIL Profiler: Stage records are incomplete: %s", err)
+        raise err
+    profiler = Profiler()
+    barrier = threading.Barrier(2)
+    stage = profiler.stage('overlapping', rows=lambda args, result: None)(
+        lambda: barrier.wait() and None)
+    threads = [threading.Thread(target=stage) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert [record['peak_rss_scope'] for record in profiler.records] \
+            == ['shared', 'shared']
+        assert os.path.basename(pth).endswith(f'_{os.getpid()}.json')
+    except AssertionError as err:
+        logging.error("FAIL Profiler: Overlapping stages were not marked \
+            shared: %s", err)
+        raise err
+
+
+def test_benchmark(path, tmp_path, monkeypatch):
+    '''
+    test the synthetic data matches the bank data schema and the benchmark
+    compares its timings to a baseline
+    '''
+    real = pd.read_csv(path[0], nrows=100)
+    synthetic = synthetic_bank_data(500, seed=1)
+    try:
+        assert list(synthetic.columns) == list(real.columns)
+        assert synthetic.equals(synthetic_bank_data(500, seed=1))
+        for column in real.columns:
+            assert is_numeric_dtype(synthetic[column]) == \
+                is_numeric_dtype(real[column])
+        assert 0 < (synthetic['Attrition_Flag'] == 'Attrited Customer'
+                    ).mean() < 0.5
+    except AssertionError as err:
+        logging.error("FAIL synthetic_bank_data(): Data does not match the \
+            bank data schema: %s", err)
+        raise err
+    results = run_benchmarks([1000, 2000], stages=['encoder_helper'],
+                             work_dir=tmp_path)
+    table = compare_to_baseline(results, results)
+    try:
+        assert set(table['stage']) == {'import_data', 'encoder_helper'}
+        assert set(table['size']) == {1000, 2000}
+        assert (table['ratio'] == 1).all()
+        assert (table['flag'] == '').all()
+        assert (table['rows_per_sec'] > 0).all()
+    except AssertionError as err:
+        logging.error("FAIL run_benchmarks(): Unexpected table %s", err)
+        raise err
+    configs = {}
+    monkeypatch.setattr(churn_benchmark, 'train_models', PROFILER.stage(
+        'train_models')(lambda *splits, **kwargs: configs.update(kwargs)))
+    run_benchmarks([1000], stages=['train_models'], work_dir=tmp_path)
+    try:
+        assert configs['search_config']['cache_dir'] is None
+        assert configs['shap_config']['cache_dir'] is None
+    except AssertionError as err:
+        logging.error("FAIL run_benchmarks(): Training would be timed on \
+            cached searches: %s", err)
+        raise err
+
+
+def test_import_time():
+    '''
+    test the scoring path imports without the plotting and explainability
+    stack, and the scorer without scikit-learn
+    '''
+    for module, avoided in SCORING_MODULES.items():
+        result = import_time(module, repeat=1, heavy_modules=avoided)
+        try:
+            assert result['heavy_modules'] == []
+            assert result['seconds'] > 0
+        except AssertionError as err:
+            logging.error("FAIL import_time(): %(module)s import is too \
+                heavy %(result)s", {'module': module, 'result': result})
+            raise err
+
+
+def _log_from_child(message):
+    '''
+    log message from a forked process
+    '''
+    logging.info(message)
+
+
+def test_queue_logging():
+    '''
+    test the queued log setup filters by module, is kept by later calls and
+    still writes the records of forked processes
+    '''
+    module_filter = ModuleLevelFilter(
+        parse_levels('churn_search=WARNING, noisy=ERROR'), logging.INFO)
+    try:
+        assert module_filter.filter(logging.makeLogRecord(
+            {'module': 'churn_search', 'name': 'root',
+             'levelno': logging.WARNING}))
+        assert not module_filter.filter(logging.makeLogRecord(
+            {'module': 'churn_search', 'name': 'root',
+             'levelno': logging.INFO}))
+        assert not module_filter.filter(logging.makeLogRecord(
+            {'module': 'other', 'name': 'noisy', 'levelno': logging.INFO}))
+        assert module_filter.filter(logging.makeLogRecord(
+            {'module': 'churn_library', 'name': 'root',
+             'levelno': logging.INFO}))
+    except AssertionError as err:
+        logging.error("FAIL ModuleLevelFilter(): Wrong records kept: %s", err)
+        raise err
+    listener = setup_logging('./logs/churn_library.log')
+    context = multiprocessing.get_context('fork')
+    child = context.Process(target=_log_from_child,
+                            args=('queue logging child record',))
+    child.start()
+    child.join()
+    with open('./logs/churn_library.log', encoding='utf-8') as file:
+        content = file.read()
+    overhead = logging_overhead(calls=200)
+    try:
+        assert setup_logging('./logs/churn_library.log') is listener
+        assert 'queue logging child record' in content
+        assert set(overhead) == {'file', 'queue', 'file_fsync',
+                                 'queue_fsync', 'disabled'}
+        assert all(mode['us_per_call'] > 0 for mode in overhead.values())
+    except AssertionError as err:
+        logging.error("FAIL setup_logging(): Queued logging failed: %s", err)
+        raise err
+
+
+def test_forked_records_kept(tmp_path):
+    '''
+    test the records of a forked process survive the parent logging after
+    it exited
+    '''
+    pth = tmp_path / 'fork.log'
+    setup_logging(pth, force=True)
+    try:
+        logging.info("parent record before fork")
+        child = multiprocessing.get_context('fork').Process(
+            target=_log_from_child, args=('forked child record',))
+        child.start()
+        child.join()
+        logging.info("parent record after fork")
+    finally:
+        setup_logging('./logs/churn_library.log', level=logging.INFO,
+                      filemode='a',
+                      fmt='%(name)s - %(levelname)s - %(message)s',
+                      force=True)
+    with open(pth, encoding='utf-8') as file:
+        content = file.read()
+    try:
+        assert 'parent record before fork' in content
+        assert 'forked child record' in content
+        assert 'parent record after fork' in content
+    except AssertionError as err:
+        logging.error("FAIL setup_logging(): Forked record overwritten: %s",
+                      err)
+        raise err
+
+
+def test_report_figures(features, tmp_path):
+    '''
+    test repeated reports leave no figure open and text reports are written
+    without drawing
+    '''
+    x_train, x_test, y_train, y_test = features
+    forest = RandomForestClassifier(n_estimators=10, random_state=42).fit(
+        x_train, y_train)
+    for _ in range(3):
+        classification_report_image(y_train, y_test, forest.predict(x_train),
+                                    forest.predict(x_test), 'Random_Forest',
+                                    f'{tmp_path}/',
+                                    formats=('png', 'json', 'html'))
+        feature_importance_plot(SimpleNamespace(best_estimator_=forest),
+                                x_train, tmp_path / 'importances.png')
+    with open(tmp_path / 'classification_report_Random_Forest.json',
+              encoding='utf-8') as file:
+        report = json.load(file)
+    try:
+        assert plt.get_fignums() == []
+        assert 0 < report['test']['accuracy'] <= 1
+        assert os.path.getsize(
+            tmp_path / 'classification_report_Random_Forest.html') > 1
+        assert os.path.getsize(
+            tmp_path / 'classification_report_Random_Forest.png') > 1
+    except AssertionError as err:
+        logging.error("FAIL classification_report_image(): Figures left \
+            open or reports missing: %s", err)
+        raise err
+
+
 def test_train_models(features):
     '''
     test train_models
@@ -226,3 +1310,8 @@ def test_train_models(features):
         logging.error("FAIL train_models(): rfc_model is missing %s", err)
     except AssertionError as err:
         logging.error("FAIL train_models(): rfc_model is empty %s", err)
+    try:
+        assert plt.get_fignums() == []
+    except AssertionError as err:
+        logging.error("FAIL train_models(): Figures left open %s", err)
+        raise err
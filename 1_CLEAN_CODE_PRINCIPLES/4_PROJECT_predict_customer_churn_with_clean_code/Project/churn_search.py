@@ -0,0 +1,503 @@
+"""
+Hyperparameter search for the churn random forest.
+
+The search runs as an exhaustive grid, successive halving or a random search.
+For forests the grid trains only the largest n_estimators per fold and scores
+the smaller sizes from prefixes of its estimators_.
+A compute budget is set with n_iter (random) or max_resources (halving), and a
+wall-clock budget with time_budget (grid and random). Folds are evaluated in
+parallel and cv_results_ is written next to the models.
+
+Fitted searches can be cached on disk under a key made of the data, the
+estimator, the grid, the search settings and the library versions, so an
+identical rerun loads the search instead of fitting it again. The cache is
+trimmed by age and total size.
+"""
+
+import inspect
+import json
+import logging
+import os
+import platform
+import time
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+# pylint: disable-next=unused-import
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import (GridSearchCV, HalvingGridSearchCV,
+                                     ParameterGrid, ParameterSampler,
+                                     RandomizedSearchCV, check_cv,
+                                     cross_validate)
+
+SEARCH_MODES = ('grid', 'halving', 'random')
+CV_RESULTS_PTH = './models/cv_results.csv'
+BEST_PARAMS_PTH = './models/best_params.json'
+SEARCH_CACHE_DIR = './models/search_cache'
+SEARCH_CACHE_MAX_MB = 500
+SEARCH_CACHE_MAX_AGE_DAYS = 30
+
+
+class BudgetedSearch:
+    '''
+    Evaluates candidates one after another, each with parallel folds, until
+    the candidates or the wall-clock budget run out, then refits the best
+    candidate on the full data. Exposes the same result attributes as the
+    scikit-learn search classes.
+
+    attributes:
+            cv_results_: dict of per-candidate scores and fit times
+            best_params_: params of the highest scoring candidate
+            best_score_: mean cv score of the best candidate
+            best_estimator_: best candidate refitted on the full data
+            time_to_best_: seconds from start until the best candidate was
+            scored
+    '''
+
+    def __init__(self, estimator, candidates, cv=5, n_jobs=-1,
+                 time_budget=None):
+        self.estimator = estimator
+        self.candidates = candidates
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.time_budget = time_budget
+        self.cv_results_ = None
+        self.best_params_ = None
+        self.best_score_ = None
+        self.best_index_ = None
+        self.best_estimator_ = None
+        self.time_to_best_ = None
+
+    def fit(self, x_data, y_data):
+        '''
+        score candidates until the time budget is spent and refit the best
+
+        input:
+                x_data: training features
+                y_data: training target
+        output:
+                self: the fitted search
+        '''
+        start = time.perf_counter()
+        rows = []
+        for params in self.candidates:
+            elapsed = time.perf_counter() - start
+            if self.time_budget is not None and rows and \
+                    elapsed >= self.time_budget:
+                logging.info("Search budget of %(budget).0fs spent after \
+%(count)d candidates", {'budget': self.time_budget, 'count': len(rows)})
+                break
+            scores = cross_validate(clone(self.estimator).set_params(**params),
+                                    x_data, y_data, cv=self.cv,
+                                    n_jobs=self.n_jobs)
+            rows.append({'params': params,
+                         'scores': scores['test_score'],
+                         'fit_time': scores['fit_time'],
+                         'score_time': scores['score_time']})
+            mean_score = float(np.mean(scores['test_score']))
+            if self.best_score_ is None or mean_score > self.best_score_:
+                self.best_score_ = mean_score
+                self.best_params_ = params
+                self.best_index_ = len(rows) - 1
+                self.time_to_best_ = time.perf_counter() - start
+        self.cv_results_ = _cv_results(rows)
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_).fit(x_data, y_data)
+        return self
+
+
+def _score_forest_prefixes(estimator, params, sizes, x_data, y_data, train,
+                           test):
+    '''
+    fit one forest with max(sizes) trees on the train fold and return the
+    test accuracy of its first n trees for every n in sizes
+
+    output:
+            scores: array of accuracies, one per size
+            fit_time: seconds spent fitting the largest forest
+            score_time: seconds spent scoring every prefix
+    '''
+    start = time.perf_counter()
+    forest = clone(estimator).set_params(**params, n_estimators=max(sizes))
+    forest.fit(_rows(x_data, train), _rows(y_data, train))
+    fit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    x_test = np.asarray(_rows(x_data, test), dtype=np.float32)
+    y_test = np.asarray(_rows(y_data, test))
+    proba_sum = np.zeros((len(test), len(forest.classes_)))
+    scores = []
+    for count, tree in enumerate(forest.estimators_, start=1):
+        proba_sum += tree.predict_proba(x_test)
+        if count in sizes:
+            y_pred = forest.classes_.take(np.argmax(proba_sum, axis=1))
+            scores.append(np.mean(y_pred == y_test))
+    return np.array(scores), fit_time, time.perf_counter() - start
+
+
+def _rows(data, index):
+    '''
+    returns the rows at the positions in index of a dataframe or array
+    '''
+    return data.iloc[index] if hasattr(data, 'iloc') else data[index]
+
+
+class NestedForestSearch:
+    '''
+    Grid search for forests that fits only the largest n_estimators for each
+    combination of the other parameters. The first n trees of a forest are
+    the forest that n_estimators=n with the same random_state would build, so
+    every smaller size is scored from a prefix of estimators_ instead of a
+    separate fit. Repeated n_estimators values are scored once. Scores are
+    accuracies, as in GridSearchCV's default.
+
+    attributes:
+            cv_results_: dict of per-candidate scores and fit times. The fit
+            time of a smaller size is its share of the largest forest.
+            best_params_: params of the highest scoring candidate
+            best_score_: mean cv score of the best candidate
+            best_estimator_: best candidate refitted on the full data
+    '''
+
+    def __init__(self, estimator, param_grid, cv=5, n_jobs=-1):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.cv_results_ = None
+        self.best_params_ = None
+        self.best_score_ = None
+        self.best_index_ = None
+        self.best_estimator_ = None
+
+    def fit(self, x_data, y_data):
+        '''
+        score every grid point from one forest per fold and refit the best
+
+        input:
+                x_data: training features
+                y_data: training target
+        output:
+                self: the fitted search
+        '''
+        sizes = sorted(set(self.param_grid['n_estimators']))
+        base_grid = list(ParameterGrid(
+            {name: values for name, values in self.param_grid.items()
+             if name != 'n_estimators'}))
+        folds = list(check_cv(self.cv, y_data, classifier=True).split(
+            x_data, y_data))
+        logging.info("Fitting %(forests)d forests of %(trees)d trees for %(\
+points)d grid points", {'forests': len(base_grid) * len(folds),
+                        'trees': max(sizes),
+                        'points': len(base_grid) * len(sizes) * len(folds)})
+        fold_results = Parallel(n_jobs=self.n_jobs)(
+            delayed(_score_forest_prefixes)(self.estimator, params, sizes,
+                                            x_data, y_data, train, test)
+            for params in base_grid for train, test in folds)
+
+        rows = []
+        for base_idx, params in enumerate(base_grid):
+            results = fold_results[base_idx * len(folds):
+                                   (base_idx + 1) * len(folds)]
+            scores = np.array([result[0] for result in results])
+            fit_times = np.array([result[1] for result in results])
+            score_times = np.array([result[2] for result in results])
+            for size_idx, size in enumerate(sizes):
+                rows.append({'params': {**params, 'n_estimators': size},
+                             'scores': scores[:, size_idx],
+                             'fit_time': fit_times * size / max(sizes),
+                             'score_time': score_times / len(sizes)})
+        self.cv_results_ = _cv_results(rows)
+        self.best_index_ = int(np.argmax(self.cv_results_['mean_test_score']))
+        self.best_params_ = rows[self.best_index_]['params']
+        self.best_score_ = float(
+            self.cv_results_['mean_test_score'][self.best_index_])
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_).fit(x_data, y_data)
+        return self
+
+
+def _cv_results(rows):
+    '''
+    returns a cv_results_ dict in the scikit-learn layout from scored rows
+    '''
+    scores = np.array([row['scores'] for row in rows])
+    mean_scores = scores.mean(axis=1)
+    results = {
+        'params': [row['params'] for row in rows],
+        'mean_fit_time': np.array([row['fit_time'].mean() for row in rows]),
+        'std_fit_time': np.array([row['fit_time'].std() for row in rows]),
+        'mean_score_time': np.array([row['score_time'].mean()
+                                     for row in rows]),
+        'mean_test_score': mean_scores,
+        'std_test_score': scores.std(axis=1),
+        'rank_test_score': (pd.Series(mean_scores).rank(
+            method='min', ascending=False).astype(int).to_numpy()),
+    }
+    for split in range(scores.shape[1]):
+        results[f'split{split}_test_score'] = scores[:, split]
+    for name in {name for row in rows for name in row['params']}:
+        results[f'param_{name}'] = np.array(
+            [row['params'].get(name) for row in rows], dtype=object)
+    return results
+
+
+def build_search(estimator, param_grid, mode='grid', cv=5, n_jobs=-1,
+                 n_iter=10, max_resources=None, time_budget=None,
+                 random_state=42, reuse_forests=True):
+    '''
+    returns an unfitted search object for estimator over param_grid
+
+    input:
+            estimator: scikit-learn estimator to tune
+            param_grid: dict of parameter name -> list of values
+            mode: one of 'grid', 'halving' or 'random'
+            cv: number of cross validation folds
+            n_jobs: parallel fold evaluations, -1 uses every core
+            n_iter: number of sampled candidates in random mode
+            max_resources: largest n_estimators given to a halving
+            candidate, defaults to the largest value in param_grid
+            time_budget: seconds after which no new candidate is scored, for
+            grid and random mode
+            random_state: seed for candidate sampling
+            reuse_forests: score the n_estimators of a forest grid from
+            prefixes of its largest forest
+    output:
+            search: object with fit, cv_results_ and best_estimator_
+    '''
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {SEARCH_MODES}, got {mode}")
+    if mode == 'halving':
+        if time_budget is not None:
+            raise ValueError("time_budget is not supported in halving mode, "
+                             "set max_resources instead")
+        grid = dict(param_grid)
+        sizes = grid.pop('n_estimators', [estimator.get_params().get(
+            'n_estimators', 100)])
+        return HalvingGridSearchCV(estimator=estimator, param_grid=grid,
+                                   resource='n_estimators',
+                                   max_resources=max_resources or max(sizes),
+                                   min_resources='exhaust',
+                                   cv=cv, n_jobs=n_jobs,
+                                   random_state=random_state)
+    if time_budget is not None:
+        if mode == 'grid':
+            candidates = list(ParameterGrid(param_grid))
+        else:
+            candidates = list(ParameterSampler(param_grid, n_iter=n_iter,
+                                               random_state=random_state))
+        return BudgetedSearch(estimator, candidates, cv=cv, n_jobs=n_jobs,
+                              time_budget=time_budget)
+    if mode == 'random':
+        return RandomizedSearchCV(estimator=estimator,
+                                  param_distributions=param_grid,
+                                  n_iter=n_iter, cv=cv, n_jobs=n_jobs,
+                                  random_state=random_state)
+    if reuse_forests and len(param_grid.get('n_estimators', [])) > 1 and \
+            isinstance(estimator, (RandomForestClassifier,
+                                   ExtraTreesClassifier)):
+        return NestedForestSearch(estimator, param_grid, cv=cv, n_jobs=n_jobs)
+    return GridSearchCV(estimator=estimator, param_grid=param_grid, cv=cv,
+                        n_jobs=n_jobs)
+
+
+def data_fingerprint(x_data, y_data):
+    '''
+    returns a hash of the values, index, columns and dtypes of the training
+    data
+    '''
+    parts = []
+    for data in (x_data, y_data):
+        if isinstance(data, pd.Series):
+            data = data.to_frame()
+        if isinstance(data, pd.DataFrame):
+            parts.append((list(data.columns),
+                          [str(dtype) for dtype in data.dtypes],
+                          pd.util.hash_pandas_object(data,
+                                                     index=True).values))
+        else:
+            parts.append(np.asarray(data))
+    return joblib.hash(parts)
+
+
+def search_cache_key(estimator, param_grid, x_train, y_train,
+                     **search_kwargs):
+    '''
+    returns the cache key of a search: the data fingerprint, the estimator
+    and its params, the grid, the search settings except n_jobs and the
+    versions of the libraries that fit it
+    '''
+    defaults = {name: param.default for name, param in
+                inspect.signature(build_search).parameters.items()
+                if param.default is not inspect.Parameter.empty}
+    settings = {name: value for name, value in
+                {**defaults, **search_kwargs}.items() if name != 'n_jobs'}
+    versions = {'python': platform.python_version(),
+                'sklearn': sklearn.__version__, 'numpy': np.__version__,
+                'pandas': pd.__version__, 'joblib': joblib.__version__}
+    return joblib.hash((type(estimator).__name__,
+                        estimator.get_params(deep=True),
+                        {name: list(values)
+                         for name, values in sorted(param_grid.items())},
+                        sorted(settings.items()), versions,
+                        data_fingerprint(x_train, y_train)))
+
+
+def evict_search_cache(cache_dir=SEARCH_CACHE_DIR,
+                       max_mb=SEARCH_CACHE_MAX_MB,
+                       max_age_days=SEARCH_CACHE_MAX_AGE_DAYS):
+    '''
+    remove cached searches not used for max_age_days, then the least
+    recently used ones until the cache is at most max_mb
+
+    input:
+            cache_dir: directory of the cached searches
+            max_mb: largest total size of the cache, None for no limit
+            max_age_days: largest age since last use, None for no limit
+    output:
+            removed: list of the removed file paths
+    '''
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = sorted((os.path.getmtime(pth), os.path.getsize(pth), pth)
+                     for pth in (os.path.join(cache_dir, name)
+                                 for name in os.listdir(cache_dir))
+                     if pth.endswith('.joblib'))
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for used, size, pth in entries:
+        too_old = max_age_days is not None and \
+            now - used > max_age_days * 86400
+        too_big = max_mb is not None and total > max_mb * 1e6
+        if not (too_old or too_big):
+            continue
+        os.remove(pth)
+        total -= size
+        removed.append(pth)
+    if removed:
+        logging.info("Evicted %(count)d cached searches, %(mb).1f MB left",
+                     {'count': len(removed), 'mb': total / 1e6})
+    return removed
+
+
+def _load_cached_search(cache_pth):
+    '''
+    returns the search cached at cache_pth and marks it as used, or None
+    when there is no usable entry
+    '''
+    if cache_pth is None or not os.path.exists(cache_pth):
+        return None
+    try:
+        search = joblib.load(cache_pth)
+    except Exception as err:  # a broken entry is refitted and replaced
+        logging.error("FAIL: Could not load cached search %(pth)s: %(err)s",
+                      {'pth': cache_pth, 'err': err})
+        return None
+    os.utime(cache_pth)
+    return search
+
+
+def time_to_best(search):
+    '''
+    returns the seconds a fitted search spent until its best candidate was
+    scored, None when it cannot be told. BudgetedSearch measures it. For the
+    other searches it is the fit and score time of the candidates in
+    cv_results_ up to the best one, summed over the folds, i.e. the time
+    on one core. A cached search returns the time of its original fit.
+    '''
+    measured = getattr(search, 'time_to_best_', None)
+    if measured is not None:
+        return measured
+    results = search.cv_results_
+    best_index = getattr(search, 'best_index_', None)
+    if best_index is None or 'mean_fit_time' not in results or \
+            'mean_score_time' not in results:
+        return None
+    n_splits = sum(1 for name in results if name.startswith('split') and
+                   name.endswith('_test_score'))
+    per_candidate = (np.asarray(results['mean_fit_time']) +
+                     np.asarray(results['mean_score_time'])) * n_splits
+    return float(per_candidate[:best_index + 1].sum())
+
+
+def run_search(estimator, param_grid, x_train, y_train,
+               results_pth=CV_RESULTS_PTH, params_pth=BEST_PARAMS_PTH,
+               cache_dir=None, cache_max_mb=SEARCH_CACHE_MAX_MB,
+               cache_max_age_days=SEARCH_CACHE_MAX_AGE_DAYS,
+               **search_kwargs):
+    '''
+    fit a search for estimator, persist its cv_results_ and best params and
+    log the time it took to get the best model
+
+    input:
+            estimator: scikit-learn estimator to tune
+            param_grid: dict of parameter name -> list of values
+            x_train: training features
+            y_train: training target
+            results_pth: csv path for cv_results_, None skips writing it
+            params_pth: json path for best_params_, None skips writing it
+            cache_dir: directory of cached searches, None disables the cache
+            cache_max_mb: largest total size of the cache
+            cache_max_age_days: cached searches unused for longer are removed
+            search_kwargs: mode, cv, n_jobs, n_iter, max_resources,
+            time_budget, random_state and reuse_forests passed to
+            build_search
+    output:
+            search: the fitted search object
+    '''
+    search = build_search(estimator, param_grid, **search_kwargs)
+    mode = search_kwargs.get('mode', 'grid')
+    cache_pth = None
+    if cache_dir is not None:
+        cache_pth = os.path.join(cache_dir, search_cache_key(
+            estimator, param_grid, x_train, y_train, **search_kwargs) +
+            '.joblib')
+    start = time.perf_counter()
+    cached = _load_cached_search(cache_pth)
+    if cached is not None:
+        search = cached
+        logging.info("SUCCESS: Loaded %(mode)s search from cache %(pth)s in \
+%(time).2fs", {'mode': mode, 'pth': cache_pth,
+               'time': time.perf_counter() - start})
+    else:
+        logging.info("Starting %(mode)s search with %(search)s",
+                     {'mode': mode, 'search': type(search).__name__})
+        search.fit(x_train, y_train)
+    elapsed = time.perf_counter() - start
+    best_time = time_to_best(search)
+    logging.info("SUCCESS: %(mode)s search scored %(count)d candidates in \
+%(elapsed).1fs, time-to-best-model %(best_time)s, best score %(score).4f \
+with %(params)s",
+                 {'mode': mode, 'count': len(search.cv_results_['params']),
+                  'elapsed': elapsed,
+                  'best_time': 'unavailable' if best_time is None
+                  else f"{best_time:.1f}s",
+                  'score': search.best_score_,
+                  'params': search.best_params_})
+    if results_pth is not None:
+        pd.DataFrame(search.cv_results_).to_csv(results_pth, index=False)
+        logging.info("SUCCESS: stored cv_results_ at %s", results_pth)
+    if params_pth is not None:
+        with open(params_pth, 'w', encoding='utf-8') as file:
+            json.dump(_json_params(search.best_params_), file, indent=2)
+        logging.info("SUCCESS: stored best params at %s", params_pth)
+    if cache_pth is not None and cached is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        joblib.dump(search, cache_pth + '.partial')
+        os.replace(cache_pth + '.partial', cache_pth)
+        logging.info("SUCCESS: Cached search at %s", cache_pth)
+        evict_search_cache(cache_dir, cache_max_mb, cache_max_age_days)
+    return search
+
+
+def _json_params(params):
+    '''
+    returns params with numpy scalars converted to python values
+    '''
+    return {name: value.item() if isinstance(value, np.generic) else value
+            for name, value in params.items()}
@@ -0,0 +1,207 @@
+"""
+Stability of the churn models over repeated train/test splits.
+
+perform_feature_engineering makes one 70/30 split with random_state=42, so
+a single run says nothing about how much the scores vary. run_stability
+fits both models on one split per seed in a process pool and summarizes
+the mean, standard deviation and range of each metric over the seeds.
+
+The encoded float32 feature matrix and the target are copied once into
+shared memory. Every worker maps them instead of receiving a pickled copy
+per split, so memory does not grow with the number of processes and tasks
+only carry their seed. The forest fits with one thread per process, so the
+seeds, not the trees, are spread over the cores.
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import (accuracy_score, f1_score, precision_score,
+                             recall_score, roc_auc_score)
+from sklearn.model_selection import train_test_split
+
+STABILITY_REPORT_PTH = './images/results/stability_report.json'
+STABILITY_RUNS_PTH = './images/results/stability_runs.csv'
+
+# Splits evaluated (seeds 0 .. seeds - 1), their test share and the worker
+# processes, None for one per cpu.
+STABILITY_CONFIG = {
+    'seeds': 10,
+    'test_size': 0.3,
+    'n_jobs': None,
+}
+
+# Models fitted on every split, name -> (class, parameters). The forest
+# parameters are updated with the best parameters of the last search.
+STABILITY_MODELS = {
+    'random_forest': (RandomForestClassifier, {'n_estimators': 200}),
+    'logistic_regression': (LogisticRegression, {'solver': 'lbfgs',
+                                                 'max_iter': 3000}),
+}
+METRICS = ('roc_auc', 'f1', 'precision', 'recall', 'accuracy')
+
+# shared arrays and models of a worker process, set once by _attach
+_WORKER = {}
+
+
+def _share(array):
+    '''
+    returns a shared memory block holding a copy of array and the spec
+    (name, shape, dtype) workers attach to it with
+    '''
+    block = shared_memory.SharedMemory(create=True,
+                                       size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach(specs, models):
+    '''
+    map the shared arrays of specs into this process
+    '''
+    _WORKER['blocks'] = []
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _WORKER['blocks'].append(block)
+        _WORKER[key] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+    _WORKER['models'] = models
+
+
+def _fit_seed(seed, test_size):
+    '''
+    returns the test metrics of every model fitted on the split of seed, one
+    record per model
+    '''
+    x_data, target = _WORKER['x'], _WORKER['y']
+    train_idx, test_idx = train_test_split(np.arange(len(target)),
+                                           test_size=test_size,
+                                           random_state=seed)
+    x_train, x_test = x_data.take(train_idx, axis=0), x_data.take(test_idx,
+                                                                  axis=0)
+    y_train, y_test = target[train_idx], target[test_idx]
+    records = []
+    for name, (model_class, params) in _WORKER['models'].items():
+        start = time.perf_counter()
+        model = model_class(**params)
+        if 'random_state' in model.get_params():
+            model.set_params(random_state=seed)
+        if 'n_jobs' in model.get_params():
+            model.set_params(n_jobs=1)
+        model.fit(x_train, y_train)
+        labels = model.predict(x_test)
+        proba = model.predict_proba(x_test)[:, list(model.classes_).index(1)]
+        records.append({
+            'seed': seed,
+            'model': name,
+            'roc_auc': roc_auc_score(y_test, proba),
+            'f1': f1_score(y_test, labels),
+            'precision': precision_score(y_test, labels, zero_division=0),
+            'recall': recall_score(y_test, labels),
+            'accuracy': accuracy_score(y_test, labels),
+            'seconds': time.perf_counter() - start,
+        })
+    return records
+
+
+def summarize(runs):
+    '''
+    returns pandas dataframe of the mean, std, min and max of every metric
+    per model, one row per model and metric
+    '''
+    summary = runs.melt(id_vars=['seed', 'model'], value_vars=list(METRICS),
+                        var_name='metric').groupby(['model', 'metric'])
+    return summary['value'].agg(['mean', 'std', 'min', 'max']).reset_index()
+
+
+def run_stability(x_data, target, seeds=10, test_size=0.3, n_jobs=None,
+                  models=None):
+    '''
+    fit the models on one seeded train/test split per seed, spread over a
+    process pool that shares one copy of the features
+
+    input:
+            x_data: 2d numpy array of encoded features
+            target: numpy array of 0/1 churn labels
+            seeds: number of splits, seeded 0 .. seeds - 1
+            test_size: share of the rows in each test set
+            n_jobs: worker processes, defaults to the cpu count
+            models: dict of name -> (class, params), defaults to
+            STABILITY_MODELS
+    output:
+            runs: pandas dataframe of the metrics of every seed and model
+            timing: dict of wall 'seconds', summed 'task_seconds' of the
+            fits and scoring, 'n_jobs' and the 'speedup' of the pool over
+            running the tasks one after another
+    '''
+    models = models or STABILITY_MODELS
+    n_jobs = min(n_jobs or os.cpu_count() or 1, seeds)
+    x_data = np.ascontiguousarray(x_data, dtype=np.float32)
+    target = np.ascontiguousarray(target)
+    start = time.perf_counter()
+    if n_jobs == 1:
+        _WORKER.update(x=x_data, y=target, models=models)
+        try:
+            records = [record for seed in range(seeds)
+                       for record in _fit_seed(seed, test_size)]
+        finally:
+            _WORKER.clear()
+    else:
+        blocks, specs = [], {}
+        try:
+            for key, array in (('x', x_data), ('y', target)):
+                block, specs[key] = _share(array)
+                blocks.append(block)
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_attach,
+                                     initargs=(specs, models)) as pool:
+                records = [record for seed_records in pool.map(
+                    _fit_seed, range(seeds), [test_size] * seeds)
+                    for record in seed_records]
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    seconds = time.perf_counter() - start
+    runs = pd.DataFrame(records)
+    task_seconds = float(runs['seconds'].sum())
+    timing = {'seconds': seconds, 'task_seconds': task_seconds,
+              'n_jobs': n_jobs,
+              'speedup': task_seconds / seconds if seconds else 0.0}
+    logging.info("SUCCESS: Evaluated %(seeds)d splits in %(seconds).2fs on \
+%(n_jobs)d processes, %(speedup).2fx the serial fit time",
+                 {**timing, 'seeds': seeds})
+    return runs, timing
+
+
+def write_stability_report(runs, timing, report_pth=STABILITY_REPORT_PTH,
+                           runs_pth=STABILITY_RUNS_PTH):
+    '''
+    store the metrics of every run as csv and their summary with the timing
+    as JSON
+
+    input:
+            runs: dataframe returned by run_stability
+            timing: dict returned by run_stability
+            report_pth: path of the JSON summary
+            runs_pth: path of the csv of all runs
+    output:
+            summary: dataframe returned by summarize
+    '''
+    summary = summarize(runs)
+    runs.to_csv(runs_pth, index=False)
+    with open(report_pth, 'w', encoding='utf-8') as file:
+        json.dump({'timing': timing,
+                   'seeds': int(runs['seed'].nunique()),
+                   'summary': summary.to_dict(orient='records')}, file,
+                  indent=2)
+    for row in summary.itertuples():
+        logging.info("STABILITY: %(model)s %(metric)s %(mean).4f +/- \
+%(std).4f [%(min).4f, %(max).4f]", row._asdict())
+    return summary
@@ -0,0 +1,168 @@
+"""
+On-disk store of the churn scores of each customer, keyed by CLIENTNUM.
+
+import_data drops CLIENTNUM, so the models' output cannot be traced back to
+a customer without rescoring. score_file can write every scored chunk into
+a SQLite table whose INTEGER PRIMARY KEY is CLIENTNUM, i.e. the rowid of
+the table's B-tree. A point lookup is then one index search, and a bulk
+lookup is one query per 500 keys. New scores are upserted: customers that
+are scored again are updated in place and new customers are added, so the
+store is refreshed incrementally without a rebuild.
+"""
+
+import argparse
+import logging
+import sqlite3
+from datetime import datetime, timezone
+import pandas as pd
+import pyarrow.parquet as pq
+from churn_logging import setup_logging
+
+STORE_PTH = './models/scores.sqlite'
+KEY_COLUMN = 'CLIENTNUM'
+# keys per bulk lookup query, below SQLite's limit of bound parameters
+LOOKUP_BATCH = 500
+
+
+class ScoreStore:
+    '''
+    SQLite table of CLIENTNUM, one churn probability column per model and
+    the UTC time each customer was last scored.
+
+    attributes:
+            pth: path of the SQLite database
+            columns: score columns of the table, in table order
+    '''
+
+    def __init__(self, pth=STORE_PTH):
+        self.pth = pth
+        self.connection = sqlite3.connect(pth, check_same_thread=False)
+        # readers are not blocked while a scoring run writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS scores ('
+            f'{KEY_COLUMN} INTEGER PRIMARY KEY, scored_at TEXT)')
+        self.columns = self._score_columns()
+
+    def _score_columns(self):
+        '''
+        returns the score columns of the table
+        '''
+        return [row[1] for row in
+                self.connection.execute('PRAGMA table_info(scores)')
+                if row[1] not in (KEY_COLUMN, 'scored_at')]
+
+    def close(self):
+        '''
+        close the connection to the database
+        '''
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM scores').fetchone()[0]
+
+    def upsert(self, scores):
+        '''
+        insert new customers and update the scores of known ones
+
+        input:
+                scores: pandas dataframe of CLIENTNUM and score columns, as
+                written by churn_scoring.score_file
+        output:
+                rows: number of rows written
+        '''
+        if KEY_COLUMN not in scores.columns:
+            raise KeyError(f"{KEY_COLUMN} not a column of the scores")
+        columns = [col for col in scores.columns if col != KEY_COLUMN]
+        with self.connection:
+            for column in columns:
+                if column not in self.columns:
+                    self.connection.execute(
+                        f'ALTER TABLE scores ADD COLUMN "{column}" REAL')
+                    self.columns.append(column)
+            quoted = ', '.join(f'"{col}"' for col in columns)
+            updates = ', '.join(f'"{col}" = excluded."{col}"'
+                                for col in columns + ['scored_at'])
+            stamp = datetime.now(timezone.utc).isoformat()
+            keys = scores[KEY_COLUMN].astype('int64').tolist()
+            values = scores[columns].astype('float64').to_numpy().tolist()
+            self.connection.executemany(
+                f'INSERT INTO scores ({KEY_COLUMN}, {quoted}, scored_at) '
+                f'VALUES ({", ".join("?" * (len(columns) + 2))}) '
+                f'ON CONFLICT({KEY_COLUMN}) DO UPDATE SET {updates}',
+                ([key, *row, stamp] for key, row in zip(keys, values)))
+        logging.info("SUCCESS: stored %(rows)d scores in %(pth)s",
+                     {'rows': len(scores), 'pth': self.pth})
+        return len(scores)
+
+    def lookup(self, clientnum):
+        '''
+        returns dict of score column -> value of one customer, or None when
+        the customer was never scored
+        '''
+        row = self.connection.execute(
+            f'SELECT * FROM scores WHERE {KEY_COLUMN} = ?',
+            (int(clientnum),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip([KEY_COLUMN, 'scored_at', *self.columns], row))
+
+    def lookup_many(self, clientnums):
+        '''
+        returns pandas dataframe of the stored scores of the customers,
+        indexed by CLIENTNUM in the order asked. Customers that were never
+        scored have missing values.
+        '''
+        keys = [int(key) for key in clientnums]
+        rows = []
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            rows.extend(self.connection.execute(
+                f'SELECT * FROM scores WHERE {KEY_COLUMN} IN '
+                f'({", ".join("?" * len(batch))})', batch))
+        found = pd.DataFrame(rows,
+                             columns=[KEY_COLUMN, 'scored_at', *self.columns])
+        return found.set_index(KEY_COLUMN).reindex(
+            pd.Index(keys, name=KEY_COLUMN))
+
+    def refresh(self, scores_pth, batch_size=50000):
+        '''
+        upsert the scores of a parquet file written by score_file
+
+        input:
+                scores_pth: parquet file of CLIENTNUM and score columns
+                batch_size: rows upserted per transaction
+        output:
+                rows: number of rows written
+        '''
+        rows = 0
+        for batch in pq.ParquetFile(scores_pth).iter_batches(
+                batch_size=batch_size):
+            rows += self.upsert(batch.to_pandas())
+        return rows
+
+
+if __name__ == "__main__":
+    setup_logging("./logs/churn_scoring.log", filemode='a')
+    PARSER = argparse.ArgumentParser(
+        description="Load or query the stored churn scores")
+    PARSER.add_argument('--store', default=STORE_PTH)
+    PARSER.add_argument('--refresh', metavar='SCORES',
+                        help="parquet file of scores to upsert")
+    PARSER.add_argument('clientnums', nargs='*', type=int,
+                        help="customers to look up")
+    ARGS = PARSER.parse_args()
+    with ScoreStore(ARGS.store) as STORE:
+        if ARGS.refresh:
+            print(f"Stored {STORE.refresh(ARGS.refresh)} scores, "
+                  f"{len(STORE)} customers in {ARGS.store}")
+        if ARGS.clientnums:
+            print(STORE.lookup_many(ARGS.clientnums).to_string())
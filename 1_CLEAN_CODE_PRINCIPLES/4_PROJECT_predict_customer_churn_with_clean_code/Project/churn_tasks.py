@@ -0,0 +1,124 @@
+"""
+Small task graph runner used to overlap the churn training stages.
+
+A task starts in a thread pool as soon as every task it depends on has
+finished. The start and end of each task are logged together with the
+critical path, the chain of dependencies that decided the total run time.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# pyplot keeps a global current figure, so tasks that draw with it must not
+# run at the same time. Hold this lock around any pyplot drawing in a task.
+PLOT_LOCK = threading.Lock()
+
+
+def _timed(func, args):
+    '''
+    call func(*args) and return its result with perf_counter start and end
+    '''
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    except Exception as err:  # re-raised by run_task_graph with its timing
+        return err, start, time.perf_counter(), True
+    return result, start, time.perf_counter(), False
+
+
+def critical_path(tasks, timings):
+    '''
+    returns the names of the chain of tasks that ended last, following at
+    each step the dependency that finished last
+
+    input:
+            tasks: dict of task name -> (function, list of dependency names)
+            timings: dict of task name -> (start, end) in seconds
+    output:
+            path: list of task names from the first stage to the last
+    '''
+    if not timings:
+        return []
+    name = max(timings, key=lambda task: timings[task][1])
+    path = [name]
+    while True:
+        deps = [dep for dep in tasks[name][1] if dep in timings]
+        if not deps:
+            break
+        name = max(deps, key=lambda task: timings[task][1])
+        path.append(name)
+    return path[::-1]
+
+
+def run_task_graph(tasks, max_workers=None):
+    '''
+    run tasks in a thread pool, each as soon as its dependencies finished
+
+    input:
+            tasks: dict of task name -> (function, list of dependency names).
+            The function is called with the results of its dependencies in
+            the listed order.
+            max_workers: number of threads, defaults to one per task
+    output:
+            results: dict of task name -> returned value
+            timings: dict of task name -> (start, end) seconds since launch
+    '''
+    for name, (_, deps) in tasks.items():
+        unknown = [dep for dep in deps if dep not in tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks {unknown}")
+
+    launch = time.perf_counter()
+    results, timings, errors = {}, {}, {}
+    pending = dict(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as pool:
+        while pending or running:
+            for name in list(pending):
+                func, deps = pending[name]
+                if any(dep in errors for dep in deps):
+                    logging.error("SKIP: %s stage, a dependency failed.",
+                                  name)
+                    errors[name] = None
+                    del pending[name]
+                elif all(dep in results for dep in deps):
+                    logging.info("Starting %s stage.", name)
+                    running[pool.submit(
+                        _timed, func, [results[dep] for dep in deps])] = name
+                    del pending[name]
+            if not running:
+                if pending:
+                    raise ValueError(
+                        f"Tasks {list(pending)} depend on a cycle")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                value, start, end, failed = future.result()
+                timings[name] = (start - launch, end - launch)
+                if failed:
+                    logging.error("FAIL: %(name)s stage after %(time).2fs: \
+%(err)s", {'name': name, 'time': end - start, 'err': value})
+                    errors[name] = value
+                else:
+                    logging.info("SUCCESS: %(name)s stage in %(time).2fs",
+                                 {'name': name, 'time': end - start})
+                    results[name] = value
+
+    path = critical_path(tasks, timings)
+    logging.info("Stage timings (start-end, seconds): %s",
+                 ', '.join(f"{name} {start:.2f}-{end:.2f}"
+                           for name, (start, end) in sorted(
+                               timings.items(), key=lambda item: item[1])))
+    logging.info("Critical path %(total).2fs: %(path)s",
+                 {'total': max((end for _, end in timings.values()),
+                               default=0.0),
+                  'path': ' -> '.join(
+                      f"{name} ({timings[name][1] - timings[name][0]:.2f}s)"
+                      for name in path)})
+    failures = [err for err in errors.values() if err is not None]
+    if failures:
+        raise failures[0]
+    return results, timings
@@ -0,0 +1,242 @@
+"""
+Decision threshold analysis of the churn models.
+
+The predicted churn probabilities are sorted once, and cumulative sums of
+the sorted labels give the confusion matrix at every distinct probability
+used as threshold, in O(n log n) for the whole sweep. Precision, recall, F1
+and the expected retention cost are computed from it. The cost counts a
+retention offer for every customer flagged as churning and the loss of every
+churner that is missed. The threshold is chosen on validation predictions,
+the out-of-bag probabilities of the forest and out-of-fold predictions of
+the logistic regression during training, and only reported on the test
+set. It is stored next to the model, and churn_scoring uses it to label the
+customers it scores.
+"""
+
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+# Objective the threshold is chosen by ('f1' or 'cost'), the cost of a
+# retention offer to a flagged customer, the loss of a missed churner and
+# the folds and processes of the out-of-fold validation predictions of a
+# model without out-of-bag probabilities.
+THRESHOLD_CONFIG = {
+    'objective': 'cost',
+    'offer_cost': 50.0,
+    'churn_cost': 500.0,
+    'cv': 5,
+    'n_jobs': -1,
+}
+THRESHOLD_OBJECTIVES = ('f1', 'cost')
+
+
+def threshold_sweep(y_true, proba, offer_cost=50.0, churn_cost=500.0):
+    '''
+    returns the metrics of flagging every customer whose churn probability
+    is at least the threshold, for every distinct probability
+
+    input:
+            y_true: array of 0/1 churn labels
+            proba: array of predicted churn probabilities
+            offer_cost: cost of a retention offer to a flagged customer
+            churn_cost: loss of a churner that is not flagged
+    output:
+            sweep: pandas dataframe of threshold, tp, fp, fn, precision,
+            recall, f1 and cost, highest threshold first. The first row
+            flags nobody.
+    '''
+    y_true = np.asarray(y_true).astype(np.int64)
+    proba = np.asarray(proba, dtype=np.float64)
+    if len(proba) == 0 or len(y_true) != len(proba):
+        raise ValueError(f"Need as many labels as probabilities and at least "
+                         f"one, got {len(y_true)} labels and {len(proba)} "
+                         f"probabilities")
+    order = np.argsort(proba, kind='mergesort')[::-1]
+    proba, y_true = proba[order], y_true[order]
+    # last position of each distinct probability in descending order
+    last = np.r_[np.flatnonzero(np.diff(proba)), len(proba) - 1]
+    true_pos = np.r_[0, np.cumsum(y_true)[last]]
+    flagged = np.r_[0, last + 1]
+    false_pos = flagged - true_pos
+    false_neg = true_pos[-1] - true_pos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(flagged > 0, true_pos / flagged, 1.0)
+        recall = np.where(true_pos[-1] > 0, true_pos / true_pos[-1], 0.0)
+        f1_score = np.where(true_pos > 0, 2 * true_pos /
+                            (2 * true_pos + false_pos + false_neg), 0.0)
+    return pd.DataFrame({
+        'threshold': np.r_[np.inf, proba[last]],
+        'tp': true_pos,
+        'fp': false_pos,
+        'fn': false_neg,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1_score,
+        'cost': flagged * offer_cost + false_neg * churn_cost,
+    })
+
+
+def threshold_metrics(y_true, proba, threshold, offer_cost=50.0,
+                      churn_cost=500.0):
+    '''
+    returns the metrics of flagging every customer whose churn probability
+    is at least threshold, as a dict with the columns of threshold_sweep
+    '''
+    y_true = np.asarray(y_true).astype(bool)
+    flagged = np.asarray(proba, dtype=np.float64) >= threshold
+    true_pos = int(np.sum(flagged & y_true))
+    false_pos = int(flagged.sum()) - true_pos
+    false_neg = int(y_true.sum()) - true_pos
+    return {
+        'threshold': float(threshold),
+        'tp': float(true_pos),
+        'fp': float(false_pos),
+        'fn': float(false_neg),
+        'precision': float(true_pos / flagged.sum()) if flagged.any()
+        else 1.0,
+        'recall': float(true_pos / y_true.sum()) if y_true.any() else 0.0,
+        'f1': (2 * true_pos / (2 * true_pos + false_pos + false_neg)
+               if true_pos else 0.0),
+        'cost': float(flagged.sum() * offer_cost + false_neg * churn_cost),
+    }
+
+
+def validation_proba(model, x_train, y_train, cv=5, n_jobs=None):
+    '''
+    returns numpy array of validation churn probabilities of x_train. A
+    forest fitted on x_train with oob_score=True returns its out-of-bag
+    probabilities, each row scored by the trees that did not sample it,
+    without fitting anything. Any other model scores each row by a copy
+    fitted on the other folds.
+
+    input:
+            model: classifier fitted on x_train with predict_proba and
+            classes_
+            x_train: pandas dataframe of the training features
+            y_train: training target
+            cv: number of folds
+            n_jobs: processes fitting the folds
+    output:
+            proba: numpy array of churn probabilities
+    '''
+    churn = list(model.classes_).index(1)
+    oob = getattr(model, 'oob_decision_function_', None)
+    # a row no tree left out has no out-of-bag probability
+    if oob is not None and len(oob) == len(x_train) and \
+            not np.isnan(oob[:, churn]).any():
+        return oob[:, churn]
+    # imported here, churn_scoring loads thresholds without scikit-learn
+    # pylint: disable=import-outside-toplevel
+    from sklearn.base import clone
+    from sklearn.model_selection import cross_val_predict
+    proba = cross_val_predict(clone(model), x_train, y_train, cv=cv,
+                              n_jobs=n_jobs, method='predict_proba')
+    return proba[:, churn]
+
+
+def choose_threshold(sweep, objective='cost'):
+    '''
+    returns the row of sweep with the highest F1 or the lowest cost, as a
+    dict
+    '''
+    if objective not in THRESHOLD_OBJECTIVES:
+        raise ValueError(f"Unknown objective {objective}, use one of "
+                         f"{THRESHOLD_OBJECTIVES}")
+    best = sweep['f1'].idxmax() if objective == 'f1' \
+        else sweep['cost'].idxmin()
+    return {name: float(value) for name, value in sweep.loc[best].items()}
+
+
+def threshold_path(model_pth):
+    '''
+    returns the path the threshold of the model stored at model_pth is
+    kept at, e.g. ./models/rfc_model_threshold.json
+    '''
+    return os.path.splitext(str(model_pth).rstrip('/\\'))[0] + \
+        '_threshold.json'
+
+
+def save_threshold(model_pth, chosen, objective, config=None,
+                   chosen_on='validation', test_metrics=None):
+    '''
+    store the chosen threshold next to the model stored at model_pth
+
+    input:
+            model_pth: path of the stored model
+            chosen: row returned by choose_threshold
+            objective: objective the threshold was chosen by
+            config: cost settings of the sweep
+            chosen_on: description of the predictions it was chosen on
+            test_metrics: metrics of the threshold on the test set, see
+            threshold_metrics
+    output:
+            pth: path of the written file
+    '''
+    pth = threshold_path(model_pth)
+    with open(pth, 'w', encoding='utf-8') as file:
+        json.dump({'threshold': chosen['threshold'], 'objective': objective,
+                   'chosen_on': chosen_on, 'metrics': chosen,
+                   'test_metrics': test_metrics, 'config': config or {}},
+                  file, indent=2)
+    logging.info("SUCCESS: stored threshold %(threshold).4f of %(model)s at \
+%(pth)s", {'threshold': chosen['threshold'], 'model': model_pth,
+           'pth': pth})
+    return pth
+
+
+def load_threshold(model_pth):
+    '''
+    returns the threshold stored next to model_pth, or None when there is
+    none
+    '''
+    pth = threshold_path(model_pth)
+    if not os.path.exists(pth):
+        return None
+    with open(pth, encoding='utf-8') as file:
+        return json.load(file)['threshold']
+
+
+def analyse_thresholds(y_true, proba, model_pth, sweep_pth, config=None,
+                       chosen_on='validation', test=None):
+    '''
+    sweep the thresholds of one model on validation predictions, store the
+    sweep as csv and the chosen threshold next to the model
+
+    input:
+            y_true: array of 0/1 churn labels of the validation rows
+            proba: array of predicted churn probabilities of these rows
+            model_pth: path of the stored model, or list of the paths of
+            every format the same model is stored in
+            sweep_pth: path of the csv of the sweep
+            config: dict of settings, defaults to THRESHOLD_CONFIG
+            chosen_on: description of the validation rows, stored with the
+            threshold
+            test: optional tuple of the test labels and probabilities the
+            chosen threshold is reported on
+    output:
+            chosen: row of the sweep at the chosen threshold, as a dict
+    '''
+    config = {**THRESHOLD_CONFIG, **(config or {})}
+    sweep = threshold_sweep(y_true, proba, config['offer_cost'],
+                            config['churn_cost'])
+    sweep.to_csv(sweep_pth, index=False)
+    chosen = choose_threshold(sweep, config['objective'])
+    test_metrics = None if test is None else threshold_metrics(
+        *test, chosen['threshold'], config['offer_cost'],
+        config['churn_cost'])
+    model_pths = model_pth if isinstance(model_pth, (list, tuple)) \
+        else [model_pth]
+    for pth in model_pths:
+        save_threshold(pth, chosen, config['objective'], config, chosen_on,
+                       test_metrics)
+    logging.info("SUCCESS: %(model)s threshold %(threshold).4f precision \
+%(precision).3f recall %(recall).3f f1 %(f1).3f cost %(cost).0f on %(on)s",
+                 {**chosen, 'model': model_pths[0], 'on': chosen_on})
+    if test_metrics is not None:
+        logging.info("SUCCESS: %(model)s threshold %(threshold).4f on the \
+test set precision %(precision).3f recall %(recall).3f f1 %(f1).3f cost \
+%(cost).0f", {**test_metrics, 'model': model_pths[0]})
+    return chosen
@@ -1,11 +1,20 @@
 import json
+import logging
 import mlflow
 import tempfile
 import os
 import wandb
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
+from step_cache import StepCache, code_hash, remote_code
+from step_graph import run_graph
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+# Steps of the pipeline. The order they run in follows from the artifacts
+# they read and write, see step_graph.py
 _steps = [
     "download",
     "basic_cleaning",
@@ -19,6 +28,31 @@ _steps = [
 ]
 
 
+def run_step(cache, step, uri, parameters, inputs=(), outputs=(), version=None,
+             fingerprint_parameters=None):
+    """
+    Run a step with mlflow, unless it already produced its outputs from the same
+    input artifacts, parameters and code.
+
+    Local steps are identified by the hash of their code, remote components by
+    their URI and commit. A remote component run from a branch or without a
+    version always runs.
+    """
+    code = code_hash(uri) if os.path.isdir(uri) else remote_code(uri, version)
+    fingerprint = cache.fingerprint(
+        step, inputs, fingerprint_parameters or parameters, code
+    )
+    if fingerprint is None:
+        logger.info(f"Running {step}: its inputs or code cannot be fingerprinted")
+    elif cache.is_fresh(step, fingerprint):
+        logger.info(f"Skipping {step}: outputs exist for fingerprint {fingerprint[:12]}")
+        return None
+
+    run = mlflow.run(uri, "main", version=version, parameters=parameters)
+    cache.record(step, fingerprint, outputs)
+    return run
+
+
 # This automatically reads in the configuration
 @hydra.main(config_name='config')
 def go(config: DictConfig):
@@ -33,15 +67,25 @@ def go(config: DictConfig):
 
     root_path = hydra.utils.get_original_cwd()
 
+    # Steps are skipped when their inputs, parameters and code did not change
+    cache = StepCache(
+        os.path.join(root_path, config['main']['step_cache']),
+        config['main']['project_name'],
+        enabled=config['main']['skip_unchanged'],
+    )
+
+    # Selected steps, each with the artifacts it reads and writes. The order
+    # they run in follows from these artifacts.
+    steps = {}
+
     # Move to a temporary directory
     with tempfile.TemporaryDirectory() as tmp_dir:
 
         if "download" in active_steps:
             # Download file and load in W&B
-            _ = mlflow.run(
-                f"{config['main']['components_repository']}/get_data",
+            steps["download"] = dict(
+                uri=f"{config['main']['components_repository']}/get_data",
                 # os.path.join(root_path, "components/get_data"), #NOTE github URL not working.
-                "main",
                 version="main",
                 parameters={
                     "sample": config["etl"]["sample"],
@@ -49,12 +93,12 @@ def go(config: DictConfig):
                     "artifact_type": "raw_data",
                     "artifact_description": "Raw file as downloaded"
                 },
+                outputs=["sample.csv"],
             )
 
         if "basic_cleaning" in active_steps:
-            _ = mlflow.run(
-                os.path.join(hydra.utils.get_original_cwd(), "src", "basic_cleaning"),
-                "main",
+            steps["basic_cleaning"] = dict(
+                uri=os.path.join(hydra.utils.get_original_cwd(), "src", "basic_cleaning"),
                 parameters={
                     "input_artifact": "sample.csv:latest",
                     "output_artifact": "clean_sample.csv",
@@ -63,12 +107,13 @@ def go(config: DictConfig):
                     "min_price": config['etl']['min_price'],
                     "max_price": config['etl']['max_price']
                 },
+                inputs=["sample.csv:latest"],
+                outputs=["clean_sample.csv"],
             )
 
         if "data_check" in active_steps:
-            _ = mlflow.run(
-                os.path.join(hydra.utils.get_original_cwd(), "src", "data_check"),
-                "main",
+            steps["data_check"] = dict(
+                uri=os.path.join(hydra.utils.get_original_cwd(), "src", "data_check"),
                 parameters={
                     "csv": "clean_sample.csv:latest",
                     "ref": "clean_sample.csv:reference",
@@ -77,18 +122,20 @@ def go(config: DictConfig):
                     "max_price": config['etl']['max_price']
 
                 },
+                inputs=["clean_sample.csv:latest", "clean_sample.csv:reference"],
             )
 
         if "data_split" in active_steps:
-            _ = mlflow.run(
-                f"{config['main']['components_repository']}/train_val_test_split",
-                "main",
+            steps["data_split"] = dict(
+                uri=f"{config['main']['components_repository']}/train_val_test_split",
                 parameters={
                     "input": "clean_sample.csv:latest",
                     "test_size": config["modeling"]["test_size"],
                     "random_seed": config['modeling']['random_seed'],
                     "stratify_by": config['modeling']['stratify_by']
                 },
+                inputs=["clean_sample.csv:latest"],
+                outputs=["trainval_data.csv", "test_data.csv"],
             )
 
         if "train_random_forest" in active_steps:
@@ -101,32 +148,49 @@ def go(config: DictConfig):
             # NOTE: use the rf_config we just created as the rf_config parameter for the train_random_forest
             # step
 
-            _ = mlflow.run(
-                os.path.join(hydra.utils.get_original_cwd(),  "src", "train_random_forest"),
-                "main",
-                parameters={
-                    "trainval_artifact": "trainval_data.csv:latest",
-                    "val_size": config['modeling']['val_size'],
-                    "random_seed": config['modeling']['random_seed'],
-                    "stratify_by": config['modeling']['stratify_by'],
-                    "rf_config": rf_config,
-                    "max_tfidf_features": config['modeling']['max_tfidf_features'],
-                    "output_artifact": "random_forest_export"
+            parameters = {
+                "trainval_artifact": "trainval_data.csv:latest",
+                "val_size": config['modeling']['val_size'],
+                "random_seed": config['modeling']['random_seed'],
+                "stratify_by": config['modeling']['stratify_by'],
+                "rf_config": rf_config,
+                "max_tfidf_features": config['modeling']['max_tfidf_features'],
+                "output_artifact": "random_forest_export"
+            }
+            steps["train_random_forest"] = dict(
+                uri=os.path.join(hydra.utils.get_original_cwd(),  "src", "train_random_forest"),
+                parameters=parameters,
+                inputs=["trainval_data.csv:latest"],
+                outputs=["random_forest_export"],
+                # do not train on data that failed the checks
+                after=["data_check"],
+                # the content of the random forest configuration, not the path of its file
+                fingerprint_parameters={
+                    **parameters,
+                    "rf_config": OmegaConf.to_container(config["modeling"]["random_forest"]),
                 },
             )
 
         if "test_regression_model" in active_steps:
-            _ = mlflow.run(
+            steps["test_regression_model"] = dict(
                 # NOTE: The components repository here has older sklearn package that 
                 # does not support remainder_fearures=drop. So using the local
                 # f"{config['main']['components_repository']}/test_regression_model",
-                os.path.join(hydra.utils.get_original_cwd(),  "components", "test_regression_model"),
-                "main",
+                uri=os.path.join(hydra.utils.get_original_cwd(),  "components", "test_regression_model"),
                 parameters={
                     "mlflow_model": "random_forest_export:prod",
                     "test_dataset": "test_data.csv:latest"
                 },
+                inputs=["random_forest_export:prod", "test_data.csv:latest"],
             )
 
+        # Steps whose inputs are ready run in parallel, e.g. data_check and data_split
+        run_graph(
+            steps,
+            lambda name, step: run_step(cache, name, **step),
+            max_parallel=config['main']['max_parallel_steps'],
+        )
+
+
 if __name__ == "__main__":
     go()
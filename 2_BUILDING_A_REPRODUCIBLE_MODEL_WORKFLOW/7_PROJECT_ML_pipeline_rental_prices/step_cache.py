@@ -0,0 +1,146 @@
+"""
+Content-addressed skipping of the pipeline steps run by main.py.
+
+Each step is fingerprinted from the W&B digests of its input artifacts, its
+parameters and a hash of its code. After a step succeeds, its fingerprint
+and the digests of the artifacts it produced are written to a manifest.
+On the next run, the step is skipped when its fingerprint is unchanged and
+its outputs are still the latest versions in W&B.
+
+A step that reruns and logs different output moves the ``:latest`` alias.
+That changes the input digests of the steps after it, so they rerun too.
+Steps whose inputs did not change are skipped.
+
+A remote component is only identified by its commit. One run from a branch
+such as ``main``, or without a version, has no fixed code, so it always runs.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger()
+
+# Files of a step directory that make up its code. Other files there, like
+# the data and model exports a step writes next to its code, are ignored.
+CODE_FILES = ("MLproject",)
+CODE_SUFFIXES = (".py", ".yml", ".yaml")
+
+# A full git commit hash, the only version that pins a remote component
+COMMIT_PATTERN = re.compile(r"[0-9a-f]{40}")
+
+
+def code_hash(step_dir):
+    """
+    Hash of the MLproject, conda and python files at the top of a step directory
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(step_dir)):
+        path = os.path.join(step_dir, name)
+        if os.path.isfile(path) and (name in CODE_FILES or name.endswith(CODE_SUFFIXES)):
+            digest.update(name.encode())
+            with open(path, "rb") as fp:
+                digest.update(hashlib.sha256(fp.read()).digest())
+    return digest.hexdigest()
+
+
+def remote_code(uri, version):
+    """
+    Identity of a remote component, None unless its version is a commit hash
+    """
+    if version is None or not COMMIT_PATTERN.fullmatch(str(version)):
+        return None
+    return f"{uri}@{version}"
+
+
+class StepCache:
+    """
+    Manifest of the fingerprint and output artifact digests of each step that ran.
+    Steps running in parallel threads can record into the same manifest.
+    The W&B API is only imported and created when the first artifact is looked up,
+    unless an api with an artifact method is given.
+    """
+
+    def __init__(self, path, project, enabled=True, api=None):
+        self.path = path
+        self.project = project
+        self.enabled = enabled
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.entries = json.load(fp)
+        self._api = api
+        self._lock = threading.Lock()
+        self._api_lock = threading.Lock()
+
+    def _wandb_api(self):
+        """
+        The W&B API, created once even when parallel steps look up artifacts at the same time
+        """
+        with self._api_lock:
+            if self._api is None:
+                import wandb
+
+                self._api = wandb.Api()
+        return self._api
+
+    def artifact_digest(self, reference):
+        """
+        Digest of a W&B artifact such as "clean_sample.csv:latest", None if it does not exist
+        """
+        if ":" not in reference:
+            reference = f"{reference}:latest"
+        try:
+            return self._wandb_api().artifact(f"{self.project}/{reference}").digest
+        except Exception as err:  # a missing artifact raises a wandb CommError
+            logger.info(f"Artifact {reference} not found: {err}")
+            return None
+
+    def fingerprint(self, step, inputs, parameters, code):
+        """
+        Fingerprint of a step, None if one of its input artifacts does not exist yet
+        or its code is not known
+        """
+        if code is None:
+            return None
+        digests = {reference: self.artifact_digest(reference) for reference in inputs}
+        if any(digest is None for digest in digests.values()):
+            return None
+        payload = json.dumps(
+            {"step": step, "inputs": digests, "parameters": parameters, "code": code},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def is_fresh(self, step, fingerprint):
+        """
+        True if the step already ran with this fingerprint and its outputs are still the latest
+        """
+        entry = self.entries.get(step)
+        if not self.enabled or fingerprint is None or entry is None:
+            return False
+        if entry["fingerprint"] != fingerprint:
+            return False
+        return all(
+            digest is not None and self.artifact_digest(name) == digest
+            for name, digest in entry["outputs"].items()
+        )
+
+    def record(self, step, fingerprint, outputs):
+        """
+        Store the fingerprint of a step that ran and the digests of its output artifacts.
+        Nothing is stored when an output could not be found, so the step runs again.
+        """
+        digests = {name: self.artifact_digest(name) for name in outputs}
+        with self._lock:
+            if fingerprint is None or any(digest is None for digest in digests.values()):
+                self.entries.pop(step, None)
+            else:
+                self.entries[step] = {"fingerprint": fingerprint, "outputs": digests}
+            tmp_path = f"{self.path}.partial"
+            with open(tmp_path, "w") as fp:
+                json.dump(self.entries, fp, indent=2)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,144 @@
+"""
+Dependency graph of the pipeline steps run by main.py.
+
+Every step declares the W&B artifacts it reads and writes. A step depends on
+the selected steps that write an artifact it reads, whatever the alias
+(``clean_sample.csv:latest`` is written by ``basic_cleaning`` as
+``clean_sample.csv``). A step can also list in ``after`` steps that must
+finish first without producing its inputs, such as the data checks that gate
+training. Steps run in a thread pool as soon as their
+dependencies finished, at most max_parallel at a time. The timings of the
+steps and the critical path, i.e. the chain of steps that decided the total
+run time, are logged at the end.
+"""
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger()
+
+
+def artifact_name(reference):
+    """
+    Name of an artifact reference without its alias or version
+    """
+    return reference.split(":", 1)[0]
+
+
+def dependencies(steps):
+    """
+    Steps each step depends on, from the artifacts the steps read and write
+    """
+    producers = {}
+    for name, step in steps.items():
+        for output in step.get("outputs", ()):
+            producers[artifact_name(output)] = name
+    deps = {}
+    for name, step in steps.items():
+        producing = {
+            producers[artifact_name(reference)]
+            for reference in step.get("inputs", ())
+            if artifact_name(reference) in producers
+        }
+        ordered = {dep for dep in step.get("after", ()) if dep in steps}
+        deps[name] = sorted((producing | ordered) - {name})
+    return deps
+
+
+def critical_path(deps, timings):
+    """
+    Chain of steps that ended last, following at each step the dependency that finished last
+    """
+    if not timings:
+        return []
+    name = max(timings, key=lambda step: timings[step]["end"])
+    path = [name]
+    while True:
+        ran = [dep for dep in deps[name] if dep in timings]
+        if not ran:
+            break
+        name = max(ran, key=lambda step: timings[step]["end"])
+        path.append(name)
+    return path[::-1]
+
+
+def run_graph(steps, run, max_parallel=2):
+    """
+    Run every step as soon as the steps it depends on finished, at most
+    max_parallel at a time. run is called with the name and the declaration of
+    the step without "after", and returns None when the step was skipped.
+    Steps after a failed step are not started, and the first failure is raised
+    once the running steps finished. Steps that depend on each other in a cycle
+    can never start, so they raise a ValueError.
+
+    Returns dict of step -> start, end (seconds since launch) and whether it was skipped
+    """
+    if max_parallel < 1:
+        raise ValueError(f"max_parallel must be at least 1, got {max_parallel}")
+    deps = dependencies(steps)
+    launch = time.perf_counter()
+    timings, failed = {}, {}
+    pending = list(steps)
+    running = {}
+
+    def timed(name):
+        start = time.perf_counter()
+        result = run(name, {key: value for key, value in steps[name].items() if key != "after"})
+        return start, time.perf_counter(), result is None
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        while pending or running:
+            for name in list(pending):
+                if any(dep in failed for dep in deps[name]):
+                    logger.error(f"Not running {name}: a step it depends on failed")
+                    failed[name] = None
+                    pending.remove(name)
+                elif all(dep in timings for dep in deps[name]) and len(running) < max_parallel:
+                    logger.info(f"Starting step {name}")
+                    running[pool.submit(timed, name)] = name
+                    pending.remove(name)
+            if not running:
+                if pending:
+                    raise ValueError(f"Steps {pending} depend on each other and can never start")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    start, end, skipped = future.result()
+                except Exception as err:
+                    logger.error(f"Step {name} failed: {err}")
+                    failed[name] = err
+                    continue
+                timings[name] = {
+                    "start": start - launch,
+                    "end": end - launch,
+                    "skipped": skipped,
+                }
+
+    log_summary(deps, timings)
+    errors = [err for err in failed.values() if err is not None]
+    if errors:
+        raise errors[0]
+    return timings
+
+
+def log_summary(deps, timings):
+    """
+    Log the start, end and duration of every step and the critical path
+    """
+    logger.info("Step timings (seconds since launch):")
+    for name, timing in sorted(timings.items(), key=lambda item: item[1]["start"]):
+        status = "skipped" if timing["skipped"] else "ran"
+        logger.info(
+            f"  {name:<24} {timing['start']:>8.1f} {timing['end']:>8.1f} "
+            f"{timing['end'] - timing['start']:>8.1f}  {status}"
+        )
+    path = critical_path(deps, timings)
+    total = max((timing["end"] for timing in timings.values()), default=0.0)
+    logger.info(
+        f"Critical path {total:.1f}s: "
+        + " -> ".join(
+            f"{name} ({timings[name]['end'] - timings[name]['start']:.1f}s)" for name in path
+        )
+    )
@@ -0,0 +1,125 @@
+import sys
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from step_cache import StepCache, remote_code
+
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+
+@pytest.fixture
+def digests():
+    return {
+        "clean_sample.csv:latest": "input-1",
+        "trainval_data.csv": "output-1",
+    }
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch, digests):
+    cache = StepCache(str(tmp_path / "step_cache.json"), "project")
+    # The W&B lookup is replaced by the digests fixture, a missing key is a missing artifact
+    monkeypatch.setattr(cache, "artifact_digest", digests.get)
+    return cache
+
+
+def test_remote_code_needs_a_commit():
+    assert remote_code("https://github.com/org/repo#split", COMMIT) == \
+        f"https://github.com/org/repo#split@{COMMIT}"
+    assert remote_code("https://github.com/org/repo#split", "main") is None
+    assert remote_code("https://github.com/org/repo#split", None) is None
+
+
+def test_fingerprint(cache, digests):
+    inputs = ["clean_sample.csv:latest"]
+    fingerprint = cache.fingerprint("data_split", inputs, {"test_size": 0.2}, "code")
+
+    assert fingerprint == cache.fingerprint("data_split", inputs, {"test_size": 0.2}, "code")
+    assert fingerprint != cache.fingerprint("data_split", inputs, {"test_size": 0.3}, "code")
+    assert fingerprint != cache.fingerprint("data_split", inputs, {"test_size": 0.2}, "other")
+
+    digests["clean_sample.csv:latest"] = "input-2"
+    assert fingerprint != cache.fingerprint("data_split", inputs, {"test_size": 0.2}, "code")
+
+    assert cache.fingerprint("data_split", ["missing.csv:latest"], {}, "code") is None
+    assert cache.fingerprint("data_split", inputs, {}, None) is None
+
+
+def test_is_fresh(cache, digests):
+    fingerprint = cache.fingerprint("data_split", ["clean_sample.csv:latest"], {}, "code")
+    assert not cache.is_fresh("data_split", fingerprint)
+
+    cache.record("data_split", fingerprint, ["trainval_data.csv"])
+    assert cache.is_fresh("data_split", fingerprint)
+    assert not cache.is_fresh("data_split", "other")
+    assert not cache.is_fresh("data_split", None)
+
+    # Another run moved the latest alias of the output
+    digests["trainval_data.csv"] = "output-2"
+    assert not cache.is_fresh("data_split", fingerprint)
+
+
+def test_is_fresh_without_output_digest(cache, digests):
+    fingerprint = cache.fingerprint("data_split", ["clean_sample.csv:latest"], {}, "code")
+    del digests["trainval_data.csv"]
+    cache.record("data_split", fingerprint, ["trainval_data.csv"])
+    assert "data_split" not in cache.entries
+
+    # A manifest written before outputs were checked on record
+    cache.entries["data_split"] = {
+        "fingerprint": fingerprint,
+        "outputs": {"trainval_data.csv": None},
+    }
+    assert not cache.is_fresh("data_split", fingerprint)
+
+
+def test_record_is_reloaded(cache, monkeypatch, digests):
+    fingerprint = cache.fingerprint("data_split", ["clean_sample.csv:latest"], {}, "code")
+    cache.record("data_split", fingerprint, ["trainval_data.csv"])
+
+    reloaded = StepCache(cache.path, "project")
+    monkeypatch.setattr(reloaded, "artifact_digest", digests.get)
+    assert reloaded.is_fresh("data_split", fingerprint)
+
+    disabled = StepCache(cache.path, "project", enabled=False)
+    monkeypatch.setattr(disabled, "artifact_digest", digests.get)
+    assert not disabled.is_fresh("data_split", fingerprint)
+
+
+def test_artifact_digest_uses_given_api(tmp_path):
+    names = []
+
+    def artifact(name):
+        names.append(name)
+        if name.startswith("project/missing.csv"):
+            raise ValueError("artifact not found")
+        return types.SimpleNamespace(digest=f"digest of {name}")
+
+    cache = StepCache(str(tmp_path / "step_cache.json"), "project",
+                      api=types.SimpleNamespace(artifact=artifact))
+    assert cache.artifact_digest("sample.csv") == "digest of project/sample.csv:latest"
+    assert cache.artifact_digest("sample.csv:reference") == \
+        "digest of project/sample.csv:reference"
+    assert cache.artifact_digest("missing.csv") is None
+    assert names == ["project/sample.csv:latest", "project/sample.csv:reference",
+                     "project/missing.csv:latest"]
+
+
+def test_wandb_api_created_once(tmp_path, monkeypatch):
+    created = []
+
+    def api():
+        created.append(1)
+        # Leaves time for the other threads to ask for the API
+        time.sleep(0.05)
+        return types.SimpleNamespace(artifact=lambda name: types.SimpleNamespace(digest=name))
+
+    monkeypatch.setitem(sys.modules, "wandb", types.SimpleNamespace(Api=api))
+    cache = StepCache(str(tmp_path / "step_cache.json"), "project")
+    with ThreadPoolExecutor(4) as pool:
+        digests = list(pool.map(cache.artifact_digest, ["sample.csv"] * 8))
+    assert digests == ["project/sample.csv:latest"] * 8
+    assert len(created) == 1
@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from step_graph import critical_path, dependencies, run_graph
+
+STEPS = {
+    "download": {"outputs": ["sample.csv"]},
+    "basic_cleaning": {"inputs": ["sample.csv:latest"], "outputs": ["clean_sample.csv"]},
+    "data_check": {"inputs": ["clean_sample.csv:latest", "clean_sample.csv:reference"]},
+    "data_split": {"inputs": ["clean_sample.csv:latest"], "outputs": ["trainval_data.csv"]},
+    "train_random_forest": {
+        "inputs": ["trainval_data.csv:latest"],
+        "after": ["data_check", "test_regression_model"],
+    },
+}
+
+
+def test_dependencies():
+    assert dependencies(STEPS) == {
+        "download": [],
+        "basic_cleaning": ["download"],
+        "data_check": ["basic_cleaning"],
+        "data_split": ["basic_cleaning"],
+        # test_regression_model is not selected, so it is not waited for
+        "train_random_forest": ["data_check", "data_split"],
+    }
+
+
+def test_dependencies_on_unselected_producer():
+    steps = {name: STEPS[name] for name in ("data_check", "data_split")}
+    assert dependencies(steps) == {"data_check": [], "data_split": []}
+
+
+def test_critical_path():
+    deps = dependencies(STEPS)
+    timings = {
+        "download": {"start": 0.0, "end": 1.0},
+        "basic_cleaning": {"start": 1.0, "end": 2.0},
+        "data_check": {"start": 2.0, "end": 5.0},
+        "data_split": {"start": 2.0, "end": 3.0},
+        "train_random_forest": {"start": 5.0, "end": 9.0},
+    }
+    assert critical_path(deps, timings) == [
+        "download", "basic_cleaning", "data_check", "train_random_forest"
+    ]
+    assert critical_path(deps, {}) == []
+
+
+def test_run_graph_order():
+    calls = []
+
+    def run(name, step):
+        calls.append((name, step))
+        return None if name == "download" else name
+
+    timings = run_graph(STEPS, run, max_parallel=2)
+
+    deps = dependencies(STEPS)
+    assert set(timings) == set(STEPS)
+    for name, step_deps in deps.items():
+        for dep in step_deps:
+            assert timings[dep]["end"] <= timings[name]["start"]
+    assert timings["download"]["skipped"]
+    assert not timings["train_random_forest"]["skipped"]
+    # run gets the declaration without "after"
+    assert all("after" not in step for _, step in calls)
+
+
+def test_run_graph_limits_parallel_steps():
+    steps = {f"step_{index}": {} for index in range(4)}
+    lock = threading.Lock()
+    running, most = [0], [0]
+
+    def run(name, step):
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return name
+
+    run_graph(steps, run, max_parallel=2)
+    assert most[0] == 2
+
+
+def test_run_graph_failure_skips_dependent_steps():
+    started = []
+
+    def run(name, step):
+        started.append(name)
+        if name == "data_split":
+            raise RuntimeError("split failed")
+        return name
+
+    with pytest.raises(RuntimeError, match="split failed"):
+        run_graph(STEPS, run, max_parallel=2)
+    assert "train_random_forest" not in started
+    assert {"download", "basic_cleaning", "data_check", "data_split"} <= set(started)
+
+
+def test_run_graph_rejects_no_parallel_steps():
+    with pytest.raises(ValueError):
+        run_graph(STEPS, lambda name, step: name, max_parallel=0)
+
+
+def test_run_graph_rejects_cycles():
+    steps = {
+        "first": {"inputs": ["b.csv"], "outputs": ["a.csv"]},
+        "second": {"inputs": ["a.csv"], "outputs": ["b.csv"]},
+        "other": {},
+    }
+    with pytest.raises(ValueError, match="can never start"):
+        run_graph(steps, lambda name, step: name, max_parallel=2)